@@ -12,6 +12,8 @@ MIP_CONVERT_CFG_FMT = 'mip_convert.{}.cfg'
 MIP_CONVERT_DATE_FORMAT = ('{0.year:04d}-{0.month:02d}-{0.day:02d}-'
                            '{0.hour:02d}-{0.minute:02d}-{0.second:02d}')
 NEMO_SUBSTREAMS = ['grid-T', 'grid-U', 'grid-V', 'grid-W', 'scalar', 'diaptr']
+STAGING_COPY_BUFFER_SIZE = 16 * 1024 * 1024  # bytes, when sendfile is unavailable
+STAGING_COPY_THREADS = 4  # default number of concurrent staging copies
 STREAM_FILES_PER_MONTH = {
     'ap4': 1, 'ap5': 1, 'apu': 1,  # Monthly streams
     'ap6': 3, 'ap7': 3, 'ap8': 3, 'ap9': 3,  # Daily 6hr, 3hr, 1hr
@@ -3,14 +3,18 @@
 Routines to perform actions such as running mip_convert or managing the
 log files
 """
+import errno
 import glob
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import shutil
 import subprocess
 
-from mip_convert_wrapper import LOG_DIRECTORY_PERMISSIONS
+from mip_convert_wrapper import LOG_DIRECTORY_PERMISSIONS, STAGING_COPY_THREADS
 from mip_convert_wrapper.common import print_env, setup_logger
+from mip_convert_wrapper.file_management import (
+    copy_file, replace_path, remove_path)
 
 
 def manage_logs(stream, component, mip_convert_config_dir,
@@ -174,3 +178,84 @@ def manage_critical_issues(exit_code, mip_convert_config_dir, timestamp,
     logger.info('Wrote "{}" critical issues to log file "{}"'.format(
         len(critical_issues_list), critical_issues_file))
     return 0
+
+
+def promote_staged_output(output_staging_dir, output_dir,
+                          num_threads=STAGING_COPY_THREADS):
+    """
+    Replace each component directory (or file) in output_dir with the
+    one MIP Convert wrote in output_staging_dir.
+
+    The new output is first moved next to the old one with os.rename,
+    which does not copy any data, or, if output_dir is on another file
+    system, copied there file by file, up to num_threads files at a time.
+    The old output is only replaced once the new one is complete, by
+    renaming, so output_dir never holds a partial or empty copy: if the
+    copy fails the old output is left as it was and the error is raised.
+
+    Parameters
+    ----------
+    output_staging_dir : str
+        Location MIP Convert wrote its output to.
+    output_dir : str
+        Final location of the output.
+    num_threads : int
+        Maximum number of files copied at the same time.
+    """
+    logger = logging.getLogger(__name__)
+    setup_logger(logger)
+    if not os.path.isdir(output_dir):
+        logger.info('Creating "{}"'.format(output_dir))
+        os.makedirs(output_dir)
+    for dir1 in sorted(os.listdir(output_staging_dir)):
+        full_comp_dir_path = os.path.join(output_staging_dir, dir1)
+        out_comp_dir_path = os.path.join(output_dir, dir1)
+        new_comp_dir_path = out_comp_dir_path + '.promote_new'
+        remove_path(new_comp_dir_path)
+        try:
+            os.rename(full_comp_dir_path, new_comp_dir_path)
+            logger.info('moved component directory from {src} to {dest}'
+                        ''.format(src=full_comp_dir_path,
+                                  dest=new_comp_dir_path))
+        except OSError as error:
+            if error.errno != errno.EXDEV:
+                raise
+            logger.info('copying component directory from {src} to {dest}'
+                        ''.format(src=full_comp_dir_path,
+                                  dest=new_comp_dir_path))
+            try:
+                _copy_path(full_comp_dir_path, new_comp_dir_path,
+                           num_threads)
+            except BaseException:
+                remove_path(new_comp_dir_path)
+                raise
+        replace_path(new_comp_dir_path, out_comp_dir_path)
+        logger.info('promoted component directory {}'
+                    ''.format(out_comp_dir_path))
+
+
+def _copy_path(src, dest, num_threads):
+    """
+    Copy a file or a directory tree, copying up to num_threads files at
+    a time.
+    """
+    if not os.path.isdir(src):
+        copy_file(src, dest)
+        return
+    copies = []
+    for root, subdirs, filenames in os.walk(src):
+        dest_root = os.path.join(dest, os.path.relpath(root, src))
+        os.makedirs(dest_root)
+        copies.extend((os.path.join(root, filename),
+                       os.path.join(dest_root, filename))
+                      for filename in filenames)
+    pool = ThreadPool(max(1, min(num_threads, len(copies))))
+    try:
+        # map raises the first error of any copy, once all are done
+        pool.map(lambda copy: copy_file(*copy), copies)
+    finally:
+        pool.close()
+        pool.join()
+    for root, subdirs, _ in os.walk(src):
+        dest_root = os.path.join(dest, os.path.relpath(root, src))
+        shutil.copystat(root, dest_root)
@@ -7,18 +7,19 @@ from datetime import datetime
 import logging
 import os
 import sys
-import shutil
 
-from mip_convert_wrapper import TIMESTAMP_FORMAT
+from mip_convert_wrapper import TIMESTAMP_FORMAT, STAGING_COPY_THREADS
 from mip_convert_wrapper.config_updater import (
     calculate_mip_convert_run_bounds, setup_cfg_file)
 from mip_convert_wrapper.common import print_env, setup_logger
-from mip_convert_wrapper.file_management import (link_data,
+from mip_convert_wrapper.file_management import (link_many,
                                                  get_all_files,
                                                  get_file_paths,
-                                                 copy_to_staging_dir)
+                                                 copy_files_to_staging_dir)
+from mip_convert_wrapper.file_index import get_file_index
 from mip_convert_wrapper.actions import (
-    run_mip_convert, manage_logs, manage_critical_issues)
+    run_mip_convert, manage_logs, manage_critical_issues,
+    promote_staged_output)
 
 
 def main():
@@ -55,6 +56,8 @@ def main():
     stream_time_overrides = os.environ['STREAM_TIME_OVERRIDES']
     suite_name = os.environ['SUITE_NAME']
     staging_dir = os.environ.get('STAGING_DIR', '')
+    staging_copy_threads = int(os.environ.get('STAGING_COPY_THREADS',
+                                              STAGING_COPY_THREADS))
 
     # Calculate start and end dates for this step
     # Final date is the 1st of January in the year after final_year (the final
@@ -95,32 +98,40 @@ def main():
                                     input_dir,
                                     work_dir,
                                     )
+    # index the input directory once for all the expected files; the
+    # index is shared with the other tasks through the proc directory
+    file_index = get_file_index(suite_name, stream, input_dir,
+                                cdds_convert_proc_dir)
+    logger.info('Indexed {} files of stream {} in "{}"'.format(
+        len(file_index), stream, os.path.join(input_dir, suite_name)))
     num_files_processed = 0
+    found_files = []
     for _, _, target_filename in expected_files:
         (expected_file,
          expected_dir,
          new_input_dir) = get_file_paths(target_filename,
                                          suite_name,
                                          stream, input_dir,
-                                         work_dir)
-        if staging_dir:
-            if expected_file:
-                copy_to_staging_dir(expected_file,
-                                    expected_dir, new_input_dir, )
-                num_files_processed += 1
-        else:
-            if expected_file:
-                # Set up symlinks to the data
-                try:
-                    link_data(expected_file,
-                              expected_dir,
-                              new_input_dir,
-                              )
-                    num_files_processed += 1
-                except Exception as error:
-                    logger.critical('link_data failed with error: "{}"'.format(error))
-                    logger.info(print_env())
-                    raise error
+                                         work_dir,
+                                         file_index=file_index)
+        if expected_file:
+            found_files.append((expected_file, expected_dir))
+    if staging_dir:
+        if found_files:
+            # copy the whole set of files at once
+            num_files_processed = copy_files_to_staging_dir(
+                [expected_file for expected_file, _ in found_files],
+                new_input_dir, staging_copy_threads)
+    elif found_files:
+        # Set up symlinks to the data, all in one go
+        try:
+            num_files_processed = link_many(
+                [expected_file for expected_file, _ in found_files],
+                new_input_dir)
+        except Exception as error:
+            logger.critical('link_many failed with error: "{}"'.format(error))
+            logger.info(print_env())
+            raise error
     logger.info("Number of processed files: {}".format(num_files_processed))
 
     # If nothing linked then log a critical failure and exit
@@ -157,19 +168,8 @@ def main():
 
     # move file from staging directory to output directory
     if staging_dir:
-        component_dir_list = os.listdir(output_staging_dir)
-        for dir1 in component_dir_list:
-            full_comp_dir_path = os.path.join(output_staging_dir, dir1)
-            out_comp_dir_path = os.path.join(output_dir, dir1)
-            if os.path.isdir(out_comp_dir_path):
-                logger.info('deleting old directory output directory: {0}'
-                            ''.format(out_comp_dir_path))
-                shutil.rmtree(out_comp_dir_path)
-            logger.info('copying component directory from {src} to {dest}'
-                        ''.format(src=full_comp_dir_path,
-                                  dest=out_comp_dir_path))
-            shutil.copytree(full_comp_dir_path,
-                            out_comp_dir_path)
+        promote_staged_output(output_staging_dir, output_dir,
+                              staging_copy_threads)
 
     # Tidy up the log files even if this task fails.
     manage_logs(stream, component, cdds_convert_proc_dir,
@@ -0,0 +1,299 @@
+# (C) British Crown Copyright 2019, Met Office.
+"""
+Persistent index of the model output files under $INPUT/$SUITENAME,
+shared by all the tasks of a conversion through an SQLite database in
+the CDDS convert proc directory.
+
+Any task refreshes the index before using it: only the directories whose
+mtime changed since they were last listed are listed again, so after the
+first task of a cycle the refresh costs one stat per directory. The
+database is in WAL mode, so tasks reading the index are not blocked by a
+task refreshing it, and refreshes are serialised by SQLite's write lock.
+"""
+import logging
+import os
+import re
+import sqlite3
+
+from mip_convert_wrapper.common import setup_logger
+from mip_convert_wrapper.file_management import build_file_index, _list_dir
+
+DB_FILENAME = 'input_file_index.db'
+# seconds to wait for another task to finish refreshing the index
+LOCK_TIMEOUT = 600
+# file name patterns of the UM, CICE and NEMO output streams, e.g.
+# ar050a.p41850jan.pp (ap4), cice_ar050i_1m_18500101-18500201.nc (inm)
+# and nemo_ar050o_1m_18500101-18500201_grid-T.nc (onm)
+STREAM_PATTERNS = [
+    (re.compile(r'^\w+a\.p(\w)\d{4}'), 'ap'),
+    (re.compile(r'^cice_\w+i_1(\w)_'), 'in'),
+    (re.compile(r'^nemo_\w+o_1(\w)_'), 'on'),
+]
+# bumped whenever _SCHEMA changes; an index with another version is
+# rebuilt from scratch
+SCHEMA_VERSION = 1
+_SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS dirs (
+        suite TEXT,
+        path TEXT,
+        parent TEXT,
+        mtime REAL,
+        PRIMARY KEY (suite, path)
+    )""",
+    'CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (suite, parent)',
+    # every copy of a file is kept, see _FIRST_FOUND for the one used
+    """CREATE TABLE IF NOT EXISTS files (
+        suite TEXT,
+        stream TEXT,
+        filename TEXT,
+        path TEXT,
+        dirname TEXT,
+        PRIMARY KEY (suite, path)
+    )""",
+    'CREATE INDEX IF NOT EXISTS files_dirname ON files (suite, dirname)',
+    'CREATE INDEX IF NOT EXISTS files_filename '
+    'ON files (suite, stream, filename)',
+]
+# order of the directories in the walk of build_file_index (depth first,
+# sorted), i.e. of their paths compared component by component
+_FIRST_FOUND = "replace(dirname, '/', char(1))"
+
+
+def stream_of(filename):
+    """
+    Return the stream a model output file belongs to.
+
+    Parameters
+    ----------
+    filename : str
+        Name of the file, e.g. `ar050a.p41850jan.pp`.
+
+    Returns
+    -------
+    : str or None
+        Stream name, e.g. `ap4`, or None if the file name is not one of
+        a UM, CICE or NEMO output file.
+    """
+    for pattern, prefix in STREAM_PATTERNS:
+        match = pattern.match(filename)
+        if match:
+            return prefix + match.group(1)
+    return None
+
+
+class FileIndex(object):
+    """
+    SQLite index of the model output files of one or more suites, keyed
+    by suite, stream and file name.
+    """
+
+    def __init__(self, db_file, timeout=LOCK_TIMEOUT):
+        """
+        Parameters
+        ----------
+        db_file : str
+            Path to the SQLite database (created if needed).
+        timeout : float
+            Seconds to wait for the lock held by another task.
+        """
+        self.db_file = db_file
+        # transactions are managed explicitly, see refresh
+        self.conn = sqlite3.connect(db_file, timeout=timeout,
+                                    isolation_level=None)
+        self.conn.text_factory = str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            version = self.conn.execute('PRAGMA user_version').fetchone()[0]
+            if version != SCHEMA_VERSION:
+                self.conn.execute('DROP TABLE IF EXISTS dirs')
+                self.conn.execute('DROP TABLE IF EXISTS files')
+                self.conn.execute(
+                    'PRAGMA user_version = {}'.format(SCHEMA_VERSION))
+            for statement in _SCHEMA:
+                self.conn.execute(statement)
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+
+    def close(self):
+        self.conn.close()
+
+    def refresh(self, suite_name, input_dir):
+        """
+        Bring the index of $INPUT/$SUITENAME up to date with a single
+        walk of its sub-directories (following symlinks), listing again
+        only the directories that changed since they were last listed.
+
+        Parameters
+        ----------
+        suite_name : str
+            Suite name, e.g. `u-ar050`.
+        input_dir : str
+            The base directory of the current file directory
+                (this excludes the suite name and the stream name)
+
+        Returns
+        -------
+        : int
+            Number of directories that were listed.
+        """
+        suite_dir = os.path.join(input_dir, suite_name)
+        listed = 0
+        # one task refreshes at a time, readers are not blocked (WAL)
+        self.conn.execute('BEGIN IMMEDIATE')
+        try:
+            known = dict(self.conn.execute(
+                'SELECT path, mtime FROM dirs WHERE suite = ?',
+                (suite_name,)).fetchall())
+            to_visit = [(suite_dir, None)]
+            while to_visit:
+                dirname, parent = to_visit.pop()
+                try:
+                    mtime = os.stat(dirname).st_mtime
+                except OSError:
+                    self._drop_tree(suite_name, dirname)
+                    continue
+                if known.get(dirname) == mtime:
+                    # unchanged: its files and sub-directories are known
+                    to_visit.extend(
+                        (row[0], dirname) for row in self.conn.execute(
+                            'SELECT path FROM dirs '
+                            'WHERE suite = ? AND parent = ?',
+                            (suite_name, dirname)).fetchall())
+                    continue
+                subdirs, filenames = _list_dir(dirname)
+                listed += 1
+                self.conn.execute(
+                    'INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                    (suite_name, dirname, parent, mtime))
+                # sub-directories that disappeared since the last listing
+                subpaths = [os.path.join(dirname, subdir)
+                            for subdir in subdirs]
+                for row in self.conn.execute(
+                        'SELECT path FROM dirs WHERE suite = ? AND parent = ?',
+                        (suite_name, dirname)).fetchall():
+                    if row[0] not in subpaths:
+                        self._drop_tree(suite_name, row[0])
+                to_visit.extend((subpath, dirname)
+                                for subpath in reversed(subpaths))
+                # files directly in $INPUT/$SUITENAME are not used
+                if dirname != suite_dir:
+                    self._index_files(suite_name, dirname, filenames)
+            self.conn.execute('COMMIT')
+        except BaseException:
+            self.conn.execute('ROLLBACK')
+            raise
+        return listed
+
+    def _index_files(self, suite_name, dirname, filenames):
+        """
+        Replace the files of a single directory in the index.
+        """
+        self.conn.execute('DELETE FROM files WHERE suite = ? AND dirname = ?',
+                          (suite_name, dirname))
+        rows = []
+        for filename in filenames:
+            stream = stream_of(filename)
+            if stream is not None:
+                rows.append((suite_name, stream, filename,
+                             os.path.join(dirname, filename), dirname))
+        self.conn.executemany(
+            'INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?)', rows)
+
+    def _drop_tree(self, suite_name, dirname):
+        """
+        Remove a directory, its sub-directories and their files from the
+        index.
+        """
+        pattern = dirname.replace('%', r'\%').replace('_', r'\_') + '/%'
+        for table, column in [('dirs', 'path'), ('files', 'dirname')]:
+            self.conn.execute(
+                'DELETE FROM {0} WHERE suite = ? AND ({1} = ? OR '
+                "{1} LIKE ? ESCAPE '\\')".format(table, column),
+                (suite_name, dirname, pattern))
+
+    def lookup(self, suite_name, stream, filename):
+        """
+        Return the location of a single file; if there is more than one
+        copy of it, the first one found by `build_file_index`.
+
+        Returns
+        -------
+        : tuple or None
+            (full path to file, full path to the directory containing
+            it), or None if the file is not in the index.
+        """
+        row = self.conn.execute(
+            'SELECT path, dirname FROM files '
+            'WHERE suite = ? AND stream = ? AND filename = ? '
+            'ORDER BY {} LIMIT 1'.format(_FIRST_FOUND),
+            (suite_name, stream, filename)).fetchone()
+        if row is None:
+            return None
+        return row[0], row[1]
+
+    def stream_files(self, suite_name, stream):
+        """
+        Return the files of one stream in the form of `build_file_index`.
+
+        Returns
+        -------
+        : dict
+            Mapping of file name to (full path to file, full path to the
+            directory containing it).
+        """
+        files = {}
+        for row in self.conn.execute(
+                'SELECT filename, path, dirname FROM files '
+                'WHERE suite = ? AND stream = ? '
+                'ORDER BY {} DESC'.format(_FIRST_FOUND),
+                (suite_name, stream)):
+            # the first copy found comes last and wins
+            files[row[0]] = (row[1], row[2])
+        return files
+
+
+def get_file_index(suite_name, stream, input_dir, cdds_convert_proc_dir):
+    """
+    Return the index of the files of a stream, from the index shared
+    with the other tasks in the CDDS convert proc directory (refreshed
+    first), or from a walk of the input directory if the shared index
+    can not be used.
+
+    Parameters
+    ----------
+    suite_name : str
+        Suite name, e.g. `u-ar050`.
+    stream : str
+        Stream name, e.g. `ap5`, `inm`.
+    input_dir : str
+        The base directory of the current file directory
+            (this excludes the suite name and the stream name)
+    cdds_convert_proc_dir : str
+        Location of the shared index database.
+
+    Returns
+    -------
+    : dict
+        Mapping of file name to (full path to file, full path to the
+        directory containing it), see `build_file_index`.
+    """
+    logger = logging.getLogger(__name__)
+    setup_logger(logger)
+    db_file = os.path.join(cdds_convert_proc_dir, DB_FILENAME)
+    try:
+        file_index = FileIndex(db_file)
+        try:
+            listed = file_index.refresh(suite_name, input_dir)
+            logger.info('Listed {} changed directories for file index "{}"'
+                        ''.format(listed, db_file))
+            return file_index.stream_files(suite_name, stream)
+        finally:
+            file_index.close()
+    except sqlite3.Error as error:
+        # e.g. a file system without the locking SQLite needs
+        logger.warning('Unable to use file index "{}": "{}"'
+                       ''.format(db_file, error))
+        return build_file_index(suite_name, input_dir)
@@ -4,15 +4,28 @@ Routines for generating links to data files in order to restrict the
 volume of data that MIP Convert can see and attempt to read
 """
 import calendar
+import errno
 import shutil
 from datetime import datetime
 import itertools
 import logging
+from multiprocessing.pool import ThreadPool
 import os
 import glob
+import tempfile
+import time
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
 
 from mip_convert_wrapper import (
-    TIME_UNIT, STREAM_FILES_PER_MONTH, NEMO_SUBSTREAMS)
+    TIME_UNIT, STREAM_FILES_PER_MONTH, NEMO_SUBSTREAMS,
+    STAGING_COPY_BUFFER_SIZE, STAGING_COPY_THREADS)
 from mip_convert_wrapper.common import setup_logger
 
 
@@ -58,7 +71,79 @@ def get_all_files(suite_name, stream, start_date, end_date, input_dir, work_dir)
     return expected_files
 
 
-def get_file_paths(target_filename, suite_name, stream, input_dir, work_dir):
+def build_file_index(suite_name, input_dir):
+    """
+    Index the files in a generic input directory tree in a single pass.
+
+    The input directory must be of type $INPUT/$SUITENAME but inside it can
+    be of Met Office type (stream/file) or it can be of Jasmin type
+    (YYYYMMDDT0000Z/files); every sub-directory of $INPUT/$SUITENAME is
+    walked once (following symlinks) and every file found is recorded.
+
+    Parameters
+    ----------
+    suite_name: str
+        Suite name (eg u-ab204)
+    input_dir: str
+        The base directory of the current file directory
+            (this excludes the suite name and the stream name)
+
+    Returns
+    -------
+    : dict
+        Mapping of file name to (full path to file, full path to the
+        directory containing it); if a file name is found more than once
+        the first one found is kept.
+    """
+    file_index = {}
+    suite_dir = os.path.join(input_dir, suite_name)
+    if not os.path.isdir(suite_dir):
+        return file_index
+    to_visit = [os.path.join(suite_dir, subdir)
+                for subdir in sorted(os.listdir(suite_dir))
+                if os.path.isdir(os.path.join(suite_dir, subdir))]
+    to_visit.reverse()
+    while to_visit:
+        dirname = to_visit.pop()
+        subdirs, filenames = _list_dir(dirname)
+        for filename in filenames:
+            if filename not in file_index:
+                file_index[filename] = (os.path.join(dirname, filename),
+                                        dirname)
+        to_visit.extend(os.path.join(dirname, subdir)
+                        for subdir in reversed(subdirs))
+    return file_index
+
+
+def _list_dir(dirname):
+    """
+    Return the sorted names of the sub-directories and of the files in a
+    directory, following symlinks; uses scandir where available so that
+    no extra stat is needed per entry.
+    """
+    subdirs = []
+    filenames = []
+    try:
+        if scandir is not None:
+            for entry in scandir(dirname):
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                else:
+                    filenames.append(entry.name)
+        else:
+            for name in os.listdir(dirname):
+                if os.path.isdir(os.path.join(dirname, name)):
+                    subdirs.append(name)
+                else:
+                    filenames.append(name)
+    except OSError:
+        # unreadable or vanished directory, as os.walk does
+        pass
+    return sorted(subdirs), sorted(filenames)
+
+
+def get_file_paths(target_filename, suite_name, stream, input_dir, work_dir,
+                   file_index=None):
     """
     Find files in a generic input directory tree.
 
@@ -80,6 +165,10 @@ def get_file_paths(target_filename, suite_name, stream, input_dir, work_dir):
             (this excludes the suite name and the stream name)
     work_dir: str
         The base firectory for copying or symlinking
+    file_index: dict, optional
+        Index of the input directory tree as returned by
+        `build_file_index`; built here if not supplied, so callers
+        looking up many files should build it once and pass it in.
 
     Returns
     -------
@@ -90,110 +179,249 @@ def get_file_paths(target_filename, suite_name, stream, input_dir, work_dir):
     new_input_location = os.path.join(work_dir, suite_name, stream)
 
     # find files with arbitrary paths
-    full_path_file = None
-    full_path_dir = None
-    suite_dir = os.path.join(input_dir, suite_name)
-    for root, subdirs, ext in os.walk(suite_dir, followlinks=True):
-        for subdir in subdirs:
-            root_subdir = os.path.join(suite_dir, subdir)
-            for _, _, filenames in os.walk(root_subdir, followlinks=True):
-                for filename in filenames:
-                    if filename == target_filename:
-                        full_path_dir = root_subdir
-                        full_path_file = os.path.join(root_subdir,
-                                                      filename)
-                        break
+    if file_index is None:
+        file_index = build_file_index(suite_name, input_dir)
+    full_path_file, full_path_dir = file_index.get(target_filename,
+                                                   (None, None))
 
     return (full_path_file, full_path_dir, new_input_location)
 
 
-def copy_to_staging_dir(expected_file,
-                        old_input_location,
-                        new_input_location,
-                        ):
+def copy_files_to_staging_dir(expected_files, new_input_location,
+                              num_threads=STAGING_COPY_THREADS):
     """
-    Copy data from old_input_location to new_input_location. These values
-    should be constructed using the get_paths function in this module.
+    Copy a whole set of files to new_input_location, up to num_threads
+    files at a time. Files already in new_input_location with the same
+    size and modification time as the original are not copied again;
+    each copy is written under a temporary name and renamed once
+    complete, so an interrupted copy is never taken as up to date.
+
     Parameters
     ----------
     expected_files : list
-        List of expected files conversion.
-    old_input_location : str
-        Location of input files.
+        Full paths of the files to copy.
     new_input_location : str
         Location to copy input files to.
+    num_threads : int
+        Maximum number of files copied at the same time.
 
     Returns
     -------
     : int
-        Number of files copied.
+        Number of files staged (copied or already up to date).
     """
-
     logger = logging.getLogger(__name__)
     setup_logger(logger)
 
-    # make new directory
     logger.info('Setting up staging directory:\n {dir}\n'
                 ''.format(dir=new_input_location))
     if not os.path.exists(new_input_location):
         logger.info('Creating "{}"'.format(new_input_location))
         os.makedirs(new_input_location)
 
-    # perform copies
-    full_path_src = expected_file
-    full_path_dest = new_input_location
-    logger.info('copying file from {src} to {dest}'
-                ''.format(src=full_path_src,
-                          dest=full_path_dest))
+    start_time = time.time()
+    pool = ThreadPool(max(1, min(num_threads, len(expected_files))))
     try:
-        shutil.copy(full_path_src, full_path_dest)
-    except IOError:
-        logger.warn('Unable to copy file: {0}'.format(full_path_src))
+        results = pool.map(
+            lambda src: _stage_file(src, new_input_location), expected_files)
+    finally:
+        pool.close()
+        pool.join()
+    elapsed = time.time() - start_time
+
+    num_copied = 0
+    num_skipped = 0
+    bytes_copied = 0
+    for src, (status, size) in zip(expected_files, results):
+        if status == 'copied':
+            num_copied += 1
+            bytes_copied += size
+        elif status == 'skipped':
+            num_skipped += 1
+        else:
+            logger.warning('Unable to copy file: {0}: {1}'.format(src, status))
+    rate = bytes_copied / (1024. * 1024.) / elapsed if elapsed > 0 else 0.
+    logger.info('Copied {} files ({:.1f} MB) in {:.1f} s ({:.1f} MB/s), '
+                '{} files already up to date'
+                ''.format(num_copied, bytes_copied / (1024. * 1024.),
+                          elapsed, rate, num_skipped))
+    return num_copied + num_skipped
+
+
+def _stage_file(src, new_input_location):
+    """
+    Copy a single file to new_input_location unless an identical copy
+    (same size and modification time) is already there.
 
+    Returns
+    -------
+    : tuple
+        ('copied' or 'skipped', number of bytes) or (error message, 0).
+    """
+    dest = os.path.join(new_input_location, os.path.basename(src))
+    try:
+        src_stat = os.stat(src)
+        try:
+            dest_stat = os.stat(dest)
+        except OSError:
+            dest_stat = None
+        if (dest_stat is not None and
+                dest_stat.st_size == src_stat.st_size and
+                int(dest_stat.st_mtime) == int(src_stat.st_mtime)):
+            return 'skipped', 0
+        copy_file(src, dest)
+    except (IOError, OSError) as error:
+        return str(error), 0
+    return 'copied', src_stat.st_size
+
+
+def copy_file(src, dest):
+    """
+    Copy a file with its permissions and modification time (so a later
+    run can tell the copy is up to date). The copy is written under a
+    temporary name and renamed once complete, so dest is never a
+    partial copy.
+
+    Parameters
+    ----------
+    src : str
+        Full path of the file to copy.
+    dest : str
+        Full path of the copy.
+    """
+    tmp_dest = dest + '.part'
+    try:
+        with open(src, 'rb') as fsrc:
+            with open(tmp_dest, 'wb') as fdest:
+                size = os.fstat(fsrc.fileno()).st_size
+                if not _sendfile(fsrc, fdest, size):
+                    shutil.copyfileobj(fsrc, fdest, STAGING_COPY_BUFFER_SIZE)
+        shutil.copystat(src, tmp_dest)
+        os.rename(tmp_dest, dest)
+    except BaseException:
+        if os.path.exists(tmp_dest):
+            os.remove(tmp_dest)
+        raise
+
+
+def _sendfile(fsrc, fdest, size):
+    """
+    Copy size bytes from fsrc to fdest inside the kernel with
+    os.sendfile, where available.
 
-def link_data(expected_file,
-              old_input_location,
-              new_input_location,
-              ):
+    Returns
+    -------
+    : bool
+        False if sendfile can not be used (nothing has been copied).
     """
-    Identify data to be used and set up soft links only to the files
-    that need to be read for this particular job step.
+    if not hasattr(os, 'sendfile'):
+        return False
+    offset = 0
+    while offset < size:
+        try:
+            sent = os.sendfile(fdest.fileno(), fsrc.fileno(), offset,
+                               size - offset)
+        except OSError as error:
+            if offset == 0 and error.errno in (errno.EINVAL, errno.ENOSYS):
+                # e.g. a file system not supporting it
+                return False
+            raise
+        if sent == 0:
+            break
+        offset += sent
+    return True
+
+
+def link_many(expected_files, new_input_location):
+    """
+    Set up the soft links to all the files that need to be read for
+    this particular job step in one pass.
+
+    The links are created in a new temporary directory next to
+    new_input_location, which is then renamed into its place, so
+    new_input_location only ever holds a complete set of links and no
+    links left over from a previous attempt. The files are not checked
+    for existence, as they come from the index of the input directory.
 
     Parameters
     ----------
-    suite_name : str
-        Suite name, e.g. `u-ar050`.
-    stream : str
-        Stream name, e.g. `ap5`, `inm`.
-    start_date : datetime
-        Start of this job step.
-    end_date : datetime
-        End of this job step.
-    task_work_dir : str
-        Working location for this cylc task, i.e. where to put the
-        symlinks.
-    input_dir : str
-        Location to look for data.
+    expected_files : list
+        Full paths of the files to link to.
+    new_input_location : str
+        The location to use for the symlinks.
 
     Returns
     -------
     : int
-        Number of source files found.
-    : str
-        Location where symlinks have been created.
+        Number of symlinks created.
     """
     logger = logging.getLogger(__name__)
     setup_logger(logger)
+    logger.info('Setting up symlink directory "{}"'.format(new_input_location))
+    parent_dir, dirname = os.path.split(os.path.normpath(new_input_location))
+    if not os.path.isdir(parent_dir):
+        logger.info('Creating "{}"'.format(parent_dir))
+        os.makedirs(parent_dir)
+    new_links_dir = tempfile.mkdtemp(prefix=dirname + '.link_new_',
+                                     dir=parent_dir)
+    try:
+        linked = set()
+        for expected_file in expected_files:
+            link_name = os.path.basename(expected_file)
+            if link_name in linked:
+                continue
+            os.symlink(expected_file, os.path.join(new_links_dir, link_name))
+            linked.add(link_name)
+        # mkdtemp creates the directory with mode 0700
+        os.chmod(new_links_dir, 0o755)
+        replace_path(new_links_dir, os.path.join(parent_dir, dirname))
+    except BaseException:
+        if os.path.isdir(new_links_dir):
+            shutil.rmtree(new_links_dir)
+        raise
+    logger.info('Linked {} files in "{}"'.format(len(linked),
+                                                  new_input_location))
+    return len(linked)
+
+
+def replace_path(new_path, path):
+    """
+    Put new_path (a file or a directory) in place of path.
+
+    A directory can not be renamed over a non-empty one, so an existing
+    path is moved aside first, moved back if new_path can not be put in
+    place and removed otherwise; path is never left missing.
+
+    Parameters
+    ----------
+    new_path : str
+        Full path of the replacement, on the same file system as path.
+    path : str
+        Full path to replace (need not exist).
+    """
+    old_path = None
+    if os.path.lexists(path):
+        old_path = path + '.replace_old'
+        remove_path(old_path)
+        os.rename(path, old_path)
+    try:
+        os.rename(new_path, path)
+    except OSError:
+        if old_path is not None:
+            os.rename(old_path, path)
+        raise
+    if old_path is not None:
+        remove_path(old_path)
 
 
-    # Set up the symlink directory
-    _setup_symlink_directory(new_input_location)
-    # Identify files to link to and create links
-    _create_symlinks(expected_file,
-                     old_input_location,
-                     new_input_location,
-                     )
-    return new_input_location
+def remove_path(path):
+    """
+    Remove a file, a symlink or a directory tree, if it exists.
+    """
+    if os.path.isdir(path) and not os.path.islink(path):
+        shutil.rmtree(path)
+    elif os.path.lexists(path):
+        os.remove(path)
 
 
 def _expected_ap(runid, stream, start_date, end_date):
@@ -315,68 +543,3 @@ def _expected_common(file_name_formatter, runid, stream, start_date, end_date,
                           end_date_num + file_date_step, file_date_step):
         yield file_name_formatter(date_num, runid, stream,
                                   file_date_step, **kwargs)
-
-
-def _setup_symlink_directory(new_input_location):
-    """
-    Create or empty the directory for the symlinks to be created and
-    return its location.
-
-    Parameters
-    ----------
-    new_input_location : path to directory to create symlinks in
-
-    Returns
-    -------
-    : str
-        Name of the directory that has been created.
-    """
-    logger = logging.getLogger(__name__)
-    logger.info('Setting up symlink directory "{}"'.format(new_input_location))
-    if not os.path.exists(new_input_location):
-        logger.info('Creating "{}"'.format(new_input_location))
-        os.makedirs(new_input_location)
-
-
-def _create_symlinks(expected_file,
-                     old_input_location,
-                     new_input_location,
-                     ):
-    """
-    Create the symlinks required for MIP Convert to run this task.
-
-    Parameters
-    ----------
-    expected_file : str
-        Single file expected for this task.
-    old_input_location : str
-        The location of the input filest the symlinks point to.
-    new_input_location : str
-        The location to use for the symlinks.
-
-    Returns
-    -------
-    None
-    """
-    logger = logging.getLogger(__name__)
-    logger.info('Looking for files in "{}"'.format(old_input_location))
-    full_path_filename = expected_file
-    full_path_link = os.path.join(new_input_location,
-                                  os.path.basename(expected_file))
-    # If there is a pre-existing link in the new_input_location then
-    # remove it.
-    if os.path.exists(full_path_link):
-        logger.info('Removing existing symlink "{}"'
-                    ''.format(full_path_link))
-        os.remove(full_path_link)
-        # create link if the file exists
-    if os.path.exists(full_path_filename):
-        msg1 = 'linking from {file} to {link}'\
-            ''.format(file=full_path_filename,
-                      link=full_path_link)
-        logger.info(msg1)
-
-        os.symlink(full_path_filename, full_path_link)
-    else:
-        logger.warning('Could not create symlink for "{}": '
-                       'file not found.'.format(expected_file))
@@ -0,0 +1,90 @@
+# (C) British Crown Copyright 2019, Met Office.
+"""
+Tests of mip_convert_wrapper.actions
+"""
+import errno
+import mock
+import os
+import shutil
+import tempfile
+import unittest
+
+from mip_convert_wrapper.actions import promote_staged_output
+
+
+class TestPromoteStagedOutput(unittest.TestCase):
+    """
+    Test moving the output from the staging directory to the output
+    directory.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.staging_dir = os.path.join(self.tmp_dir, 'staging')
+        self.output_dir = os.path.join(self.tmp_dir, 'output')
+        self._write(self.staging_dir, 'ocean', 'Omon', 'tos', 'new')
+        self._write(self.staging_dir, 'ocean', 'Omon', 'sos', 'new')
+        self._write(self.staging_dir, 'atmos', 'Amon', 'tas', 'new')
+        self._write(self.output_dir, 'ocean', 'Omon', 'tos', 'old')
+        self._write(self.output_dir, 'ocean', 'Omon', 'zos', 'old')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _write(self, *args):
+        dirname = os.path.join(*args[:-2])
+        if not os.path.isdir(dirname):
+            os.makedirs(dirname)
+        with open(os.path.join(dirname, args[-2] + '.nc'), 'w') as fhandle:
+            fhandle.write(args[-1])
+
+    def _contents(self, top):
+        contents = {}
+        for root, _, filenames in os.walk(top):
+            for filename in filenames:
+                path = os.path.join(root, filename)
+                with open(path) as fhandle:
+                    contents[os.path.relpath(path, top)] = fhandle.read()
+        return contents
+
+    def _expected(self):
+        return {os.path.join('ocean', 'Omon', 'tos.nc'): 'new',
+                os.path.join('ocean', 'Omon', 'sos.nc'): 'new',
+                os.path.join('atmos', 'Amon', 'tas.nc'): 'new'}
+
+    def test_rename(self):
+        promote_staged_output(self.staging_dir, self.output_dir)
+        self.assertEqual(self._expected(), self._contents(self.output_dir))
+        self.assertEqual([], os.listdir(self.staging_dir))
+
+    def test_copy_across_file_systems(self):
+        rename = os.rename
+
+        def cross_device_rename(src, dest):
+            if src.startswith(self.staging_dir):
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            return rename(src, dest)
+
+        with mock.patch('os.rename', side_effect=cross_device_rename):
+            promote_staged_output(self.staging_dir, self.output_dir,
+                                  num_threads=2)
+        self.assertEqual(self._expected(), self._contents(self.output_dir))
+        # the staged output is copied, not moved
+        self.assertEqual(self._expected(), self._contents(self.staging_dir))
+
+    @mock.patch('mip_convert_wrapper.actions.copy_file')
+    @mock.patch('os.rename')
+    def test_failed_copy_keeps_output(self, mock_os_rename,
+                                      mock_copy_file):
+        mock_os_rename.side_effect = OSError(errno.EXDEV,
+                                             'Invalid cross-device link')
+        mock_copy_file.side_effect = IOError(errno.ENOSPC,
+                                             'No space left on device')
+        old_output = self._contents(self.output_dir)
+        self.assertRaises(IOError, promote_staged_output,
+                          self.staging_dir, self.output_dir)
+        self.assertEqual(old_output, self._contents(self.output_dir))
+        self.assertEqual(['ocean'], os.listdir(self.output_dir))
+
+
+if __name__ == '__main__':
+    unittest.main()
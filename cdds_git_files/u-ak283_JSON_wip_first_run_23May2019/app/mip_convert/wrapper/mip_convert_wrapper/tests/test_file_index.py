@@ -0,0 +1,187 @@
+# (C) British Crown Copyright 2019, Met Office.
+"""
+Tests of mip_convert_wrapper.file_index
+"""
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from mip_convert_wrapper.file_index import (
+    FileIndex, get_file_index, stream_of)
+from mip_convert_wrapper.file_management import build_file_index
+
+
+class TestStreamOf(unittest.TestCase):
+    """
+    Test the stream derived from the file names.
+    """
+    def test_um(self):
+        self.assertEqual('ap4', stream_of('ar050a.p41850jan.pp'))
+        self.assertEqual('ap7', stream_of('ar050a.p718500111.pp'))
+
+    def test_cice(self):
+        self.assertEqual(
+            'inm', stream_of('cice_ar050i_1m_18500101-18500201.nc'))
+
+    def test_nemo(self):
+        self.assertEqual(
+            'ond', stream_of('nemo_ar050o_1d_18500101-18500201_grid-T.nc'))
+
+    def test_other(self):
+        self.assertIsNone(stream_of('mip_convert.ap4.cfg'))
+
+
+class TestFileIndex(unittest.TestCase):
+    """
+    Test the index shared between tasks.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.input_dir = os.path.join(self.tmp_dir, 'input')
+        self.suite_name = 'u-ar050'
+        self.suite_dir = os.path.join(self.input_dir, self.suite_name)
+        self.ap4_dir = os.path.join(self.suite_dir, 'ap4')
+        self.onm_dir = os.path.join(self.suite_dir, 'onm')
+        os.makedirs(self.ap4_dir)
+        os.makedirs(self.onm_dir)
+        self.ap4_files = ['ar050a.p41850jan.pp', 'ar050a.p41850feb.pp']
+        self.onm_files = ['nemo_ar050o_1m_18500101-18500201_grid-T.nc']
+        for dirname, filenames in [(self.ap4_dir, self.ap4_files),
+                                   (self.onm_dir, self.onm_files)]:
+            for filename in filenames:
+                self._touch(os.path.join(dirname, filename))
+        self.db_file = os.path.join(self.tmp_dir, 'file_index.db')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _touch(self, path):
+        open(path, 'w').close()
+        # make the change visible whatever the mtime resolution
+        dirname = os.path.dirname(path)
+        mtime = os.stat(dirname).st_mtime + 10
+        os.utime(dirname, (mtime, mtime))
+
+    def test_refresh_and_lookup(self):
+        file_index = FileIndex(self.db_file)
+        self.assertEqual(3, file_index.refresh(self.suite_name,
+                                               self.input_dir))
+        self.assertEqual(
+            (os.path.join(self.ap4_dir, self.ap4_files[0]), self.ap4_dir),
+            file_index.lookup(self.suite_name, 'ap4', self.ap4_files[0]))
+        self.assertIsNone(
+            file_index.lookup(self.suite_name, 'ap5', self.ap4_files[0]))
+        expected = dict(
+            (filename, (os.path.join(self.ap4_dir, filename), self.ap4_dir))
+            for filename in self.ap4_files)
+        self.assertEqual(expected,
+                         file_index.stream_files(self.suite_name, 'ap4'))
+        file_index.close()
+
+    def test_refresh_unchanged(self):
+        FileIndex(self.db_file).refresh(self.suite_name, self.input_dir)
+        # another task: nothing changed, nothing is listed again
+        file_index = FileIndex(self.db_file)
+        self.assertEqual(0, file_index.refresh(self.suite_name,
+                                               self.input_dir))
+        self.assertEqual(
+            2, len(file_index.stream_files(self.suite_name, 'ap4')))
+
+    def test_refresh_new_file(self):
+        file_index = FileIndex(self.db_file)
+        file_index.refresh(self.suite_name, self.input_dir)
+        self._touch(os.path.join(self.ap4_dir, 'ar050a.p41850mar.pp'))
+        self.assertEqual(1, file_index.refresh(self.suite_name,
+                                               self.input_dir))
+        self.assertEqual(
+            3, len(file_index.stream_files(self.suite_name, 'ap4')))
+
+    def test_refresh_removed_directory(self):
+        file_index = FileIndex(self.db_file)
+        file_index.refresh(self.suite_name, self.input_dir)
+        shutil.rmtree(self.onm_dir)
+        mtime = os.stat(self.suite_dir).st_mtime + 10
+        os.utime(self.suite_dir, (mtime, mtime))
+        file_index.refresh(self.suite_name, self.input_dir)
+        self.assertEqual({}, file_index.stream_files(self.suite_name, 'onm'))
+        self.assertEqual(
+            2, len(file_index.stream_files(self.suite_name, 'ap4')))
+
+    def _move(self, filename, src_dir, dest_dir):
+        if not os.path.isdir(dest_dir):
+            os.makedirs(dest_dir)
+        os.rename(os.path.join(src_dir, filename),
+                  os.path.join(dest_dir, filename))
+        for dirname in [src_dir, dest_dir, self.suite_dir]:
+            mtime = os.stat(dirname).st_mtime + 10
+            os.utime(dirname, (mtime, mtime))
+
+    def test_refresh_file_moved(self):
+        cycle_dir = os.path.join(self.suite_dir, '18500101T0000Z')
+        filename = self.ap4_files[0]
+        file_index = FileIndex(self.db_file)
+        file_index.refresh(self.suite_name, self.input_dir)
+        # to a directory listed before, then after, the one it left
+        for src_dir, dest_dir in [(self.ap4_dir, cycle_dir),
+                                  (cycle_dir, self.ap4_dir)]:
+            self._move(filename, src_dir, dest_dir)
+            file_index.refresh(self.suite_name, self.input_dir)
+            self.assertEqual(
+                (os.path.join(dest_dir, filename), dest_dir),
+                file_index.lookup(self.suite_name, 'ap4', filename))
+            self.assertEqual(
+                2, len(file_index.stream_files(self.suite_name, 'ap4')))
+
+    def test_refresh_duplicate_removed(self):
+        cycle_dir = os.path.join(self.suite_dir, '18500101T0000Z')
+        filename = self.ap4_files[0]
+        os.makedirs(cycle_dir)
+        self._touch(os.path.join(cycle_dir, filename))
+        file_index = FileIndex(self.db_file)
+        file_index.refresh(self.suite_name, self.input_dir)
+        # the copy build_file_index finds first is used
+        self.assertEqual(
+            build_file_index(self.suite_name, self.input_dir)[filename],
+            file_index.lookup(self.suite_name, 'ap4', filename))
+        self.assertEqual(
+            (os.path.join(cycle_dir, filename), cycle_dir),
+            file_index.stream_files(self.suite_name, 'ap4')[filename])
+        shutil.rmtree(cycle_dir)
+        mtime = os.stat(self.suite_dir).st_mtime + 10
+        os.utime(self.suite_dir, (mtime, mtime))
+        file_index.refresh(self.suite_name, self.input_dir)
+        self.assertEqual(
+            (os.path.join(self.ap4_dir, filename), self.ap4_dir),
+            file_index.lookup(self.suite_name, 'ap4', filename))
+
+    def test_old_schema(self):
+        # an index written with another schema is rebuilt
+        FileIndex(self.db_file).refresh(self.suite_name, self.input_dir)
+        conn = sqlite3.connect(self.db_file)
+        conn.execute('PRAGMA user_version = 0')
+        conn.close()
+        file_index = FileIndex(self.db_file)
+        self.assertEqual(3, file_index.refresh(self.suite_name,
+                                               self.input_dir))
+
+    def test_get_file_index(self):
+        expected = dict(
+            (filename, (os.path.join(self.onm_dir, filename), self.onm_dir))
+            for filename in self.onm_files)
+        self.assertEqual(expected,
+                         get_file_index(self.suite_name, 'onm',
+                                        self.input_dir, self.tmp_dir))
+
+    def test_get_file_index_no_database(self):
+        # the index can not be created: fall back to walking the tree
+        proc_dir = os.path.join(self.tmp_dir, 'no_such_dir')
+        file_index = get_file_index(self.suite_name, 'ap4', self.input_dir,
+                                    proc_dir)
+        self.assertEqual(os.path.join(self.ap4_dir, self.ap4_files[0]),
+                         file_index[self.ap4_files[0]][0])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,15 +3,18 @@
 Tests of mip_convert_wrapper.file_management
 """
 import calendar
-import datetime
+import errno
 import unittest
 import mock
 import os
+import shutil
+import tempfile
 
 from mip_convert_wrapper import TIME_UNIT, NEMO_SUBSTREAMS
 from mip_convert_wrapper.file_management import (
     _expected_ap, _expected_in, _expected_on,
-    get_paths, copy_to_staging_dir, link_data,
+    get_all_files, build_file_index, get_file_paths,
+    copy_files_to_staging_dir, link_many, replace_path,
     )
 
 
@@ -20,9 +23,9 @@ class TestMisc(unittest.TestCase):
     Test miscellaneous helper functions in the file_management.py module.
     """
 
-    def test_get_paths(self):
+    def test_get_all_files(self):
         """
-        Tests the file_management.get_paths function.
+        Tests the file_management.get_all_files function.
         """
         suite_name = 'u-RUNID'
         stream = 'ap4'
@@ -33,14 +36,12 @@ class TestMisc(unittest.TestCase):
         input_dir = os.path.sep + os.path.join('path', 'to', 'input', 'dir')
         work_dir = os.path.sep + os.path.join('path', 'to', 'work', 'dir')
 
-        (expected_files_test,
-         old_input_location_test,
-         new_input_location_test,) = get_paths(suite_name,
-                                               stream,
-                                               start_date,
-                                               end_date,
-                                               input_dir,
-                                               work_dir)
+        expected_files_test = get_all_files(suite_name,
+                                            stream,
+                                            start_date,
+                                            end_date,
+                                            input_dir,
+                                            work_dir)
 
         expected_files_exp = generate_expected(_ap_formatter_1,
                                                step,
@@ -48,85 +49,242 @@ class TestMisc(unittest.TestCase):
                                                length1,
                                                )
 
-        old_input_exp = os.path.join(input_dir,
-                                     suite_name,
-                                     stream,
-                                     )
-        new_input_exp = os.path.join(work_dir,
-                                     suite_name,
-                                     stream,
-                                     )
-
-        self.assertEqual(old_input_location_test,
-                         old_input_exp,
-                         'old_input_location not correct')
-
-        self.assertEqual(new_input_location_test,
-                         new_input_exp,
-                         'new_input_location not correct')
-
         self.assertEqual([l1 for l1 in expected_files_test],
                          list(expected_files_exp))
 
-    @mock.patch('os.path.exists')
-    @mock.patch('shutil.copy')
-    def test_copy_to_staging_dir(self,
-                                 mock_shutil_copy2,
-                                 mock_os_exists):
-        """
-        Tests the file_management.copy_to_staging_dir function.
-        """
-        src_dir = '/path/to/src/dir/'
-        dest_dir = '/path/to/dest/dir/'
-        start_dt = datetime.datetime(year=1850, month=1, day=1)
-        end_dt = datetime.datetime(year=1854, month=12, day=30)
-        expected_files = [(start_dt, end_dt, 'file1.nc'),
-                          (start_dt, end_dt, 'file2.nc'),
-                          (start_dt, end_dt, 'file3.nc')]
-
-        mock_os_exists.return_value = True
-
-        copy_to_staging_dir(expected_files, src_dir, dest_dir)
-
-        copy2_calls_list = [mock.call(os.path.join(src_dir, f1),
-                                     os.path.join(dest_dir, f1))
-                           for sdt, edt, f1 in expected_files]
-
-        mock_shutil_copy2.assert_has_calls(copy2_calls_list)
-
-    @mock.patch('glob.glob')
-    @mock.patch('os.symlink')
-    @mock.patch('os.path.exists')
-    def test_link_data(self,
-                       mock_os_exists,
-                       mock_os_symlink,
-                       mock_glob_glob):
-        """
-        Tests the file_management.link_data function.
-        """
-        src_dir = '/path/to/src/dir/'
-        dest_dir = '/path/to/dest/dir/'
-        start_dt = datetime.datetime(year=1850, month=1, day=1)
-        end_dt = datetime.datetime(year=1854, month=12, day=30)
-        expected_files = [(start_dt, end_dt, 'file1.nc'),
-                          (start_dt, end_dt, 'file2.nc'),
-                          (start_dt, end_dt, 'file3.nc')]
-
-        mock_glob_glob.return_value = []
-
-        exists_returns = [True  ,]
-        for _ in expected_files:
-            exists_returns += [False, True,]
-        mock_os_exists.side_effect = exists_returns
 
-        num_links, link_dir = link_data(expected_files, src_dir, dest_dir)
+class TestBuildFileIndex(unittest.TestCase):
+    """
+    Test the single pass index of the input directory tree.
+    """
+    def setUp(self):
+        self.input_dir = tempfile.mkdtemp()
+        self.suite_name = 'u-RUNID'
+        suite_dir = os.path.join(self.input_dir, self.suite_name)
+        # Met Office layout: stream/file
+        self.stream_dir = os.path.join(suite_dir, 'ap4')
+        # Jasmin layout: cycle/file
+        self.cycle_dir = os.path.join(suite_dir, '18500101T0000Z')
+        os.makedirs(self.stream_dir)
+        os.makedirs(self.cycle_dir)
+        for dirname, filename in [(self.stream_dir, 'RUNIDa.p41850jan.pp'),
+                                  (self.cycle_dir, 'RUNIDa.p41850feb.pp')]:
+            open(os.path.join(dirname, filename), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.input_dir)
+
+    def test_build_file_index(self):
+        file_index = build_file_index(self.suite_name, self.input_dir)
+        expected = {
+            'RUNIDa.p41850jan.pp': (
+                os.path.join(self.stream_dir, 'RUNIDa.p41850jan.pp'),
+                self.stream_dir),
+            'RUNIDa.p41850feb.pp': (
+                os.path.join(self.cycle_dir, 'RUNIDa.p41850feb.pp'),
+                self.cycle_dir)}
+        self.assertEqual(expected, file_index)
+
+    def test_build_file_index_follows_links(self):
+        linked_dir = tempfile.mkdtemp()
+        try:
+            open(os.path.join(linked_dir, 'RUNIDa.p41850mar.pp'), 'w').close()
+            link = os.path.join(self.input_dir, self.suite_name, 'linked')
+            os.symlink(linked_dir, link)
+            file_index = build_file_index(self.suite_name, self.input_dir)
+            self.assertEqual(
+                (os.path.join(link, 'RUNIDa.p41850mar.pp'), link),
+                file_index['RUNIDa.p41850mar.pp'])
+        finally:
+            shutil.rmtree(linked_dir)
+
+    def test_build_file_index_no_suite_dir(self):
+        self.assertEqual({}, build_file_index('u-NOSUITE', self.input_dir))
+
+    def test_get_file_paths_with_index(self):
+        work_dir = os.path.sep + os.path.join('path', 'to', 'work', 'dir')
+        file_index = build_file_index(self.suite_name, self.input_dir)
+        result = get_file_paths('RUNIDa.p41850jan.pp', self.suite_name,
+                                'ap4', self.input_dir, work_dir,
+                                file_index=file_index)
+        expected = (os.path.join(self.stream_dir, 'RUNIDa.p41850jan.pp'),
+                    self.stream_dir,
+                    os.path.join(work_dir, self.suite_name, 'ap4'))
+        self.assertEqual(expected, result)
+        # without an index the same tree is walked on the fly
+        self.assertEqual(expected,
+                         get_file_paths('RUNIDa.p41850jan.pp',
+                                        self.suite_name, 'ap4',
+                                        self.input_dir, work_dir))
+
+    def test_get_file_paths_missing(self):
+        work_dir = os.path.sep + os.path.join('path', 'to', 'work', 'dir')
+        result = get_file_paths('RUNIDa.p41851jan.pp', self.suite_name,
+                                'ap4', self.input_dir, work_dir,
+                                file_index={})
+        self.assertEqual(
+            (None, None, os.path.join(work_dir, self.suite_name, 'ap4')),
+            result)
 
-        self.assertEqual(3, num_links)
-        symlink_calls = [mock.call(os.path.join(src_dir, f1),
-                                   os.path.join(dest_dir, f1))
-                         for sdt, edt, f1 in expected_files]
 
-        mock_os_symlink.assert_has_calls(symlink_calls)
+class TestCopyFilesToStagingDir(unittest.TestCase):
+    """
+    Test the batched copies to the staging directory.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.dest_dir = os.path.join(self.tmp_dir, 'dest')
+        os.makedirs(self.src_dir)
+        self.src_files = []
+        for i in range(5):
+            src = os.path.join(self.src_dir, 'file{}.nc'.format(i))
+            with open(src, 'wb') as fsrc:
+                fsrc.write(os.urandom(1000 * (i + 1)))
+            self.src_files.append(src)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _read(self, path):
+        with open(path, 'rb') as fpath:
+            return fpath.read()
+
+    def test_copy(self):
+        num_staged = copy_files_to_staging_dir(self.src_files, self.dest_dir,
+                                               num_threads=2)
+        self.assertEqual(5, num_staged)
+        self.assertEqual(sorted(os.path.basename(src)
+                                for src in self.src_files),
+                         sorted(os.listdir(self.dest_dir)))
+        for src in self.src_files:
+            dest = os.path.join(self.dest_dir, os.path.basename(src))
+            self.assertEqual(self._read(src), self._read(dest))
+            self.assertEqual(int(os.stat(src).st_mtime),
+                             int(os.stat(dest).st_mtime))
+
+    def test_skip_up_to_date(self):
+        copy_files_to_staging_dir(self.src_files, self.dest_dir)
+        # mark the staged copies so a new copy would be noticed
+        dest = os.path.join(self.dest_dir, 'file0.nc')
+        src_stat = os.stat(self.src_files[0])
+        with open(dest, 'r+b') as fdest:
+            fdest.write(b'X')
+        os.utime(dest, (src_stat.st_atime, src_stat.st_mtime))
+        num_staged = copy_files_to_staging_dir(self.src_files, self.dest_dir)
+        self.assertEqual(5, num_staged)
+        self.assertEqual(b'X', self._read(dest)[:1])
+
+    def test_copy_changed(self):
+        copy_files_to_staging_dir(self.src_files, self.dest_dir)
+        with open(self.src_files[1], 'ab') as fsrc:
+            fsrc.write(b'more data')
+        copy_files_to_staging_dir(self.src_files, self.dest_dir)
+        dest = os.path.join(self.dest_dir, 'file1.nc')
+        self.assertEqual(self._read(self.src_files[1]), self._read(dest))
+
+    def test_missing_file(self):
+        missing = os.path.join(self.src_dir, 'missing.nc')
+        num_staged = copy_files_to_staging_dir(self.src_files + [missing],
+                                               self.dest_dir)
+        self.assertEqual(5, num_staged)
+        self.assertFalse(os.path.exists(
+            os.path.join(self.dest_dir, 'missing.nc')))
+
+
+class TestLinkMany(unittest.TestCase):
+    """
+    Test setting up all the symlinks of a job step at once.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.src_dir = os.path.join(self.tmp_dir, 'src')
+        self.work_dir = os.path.join(self.tmp_dir, 'work')
+        self.link_dir = os.path.join(self.work_dir, 'u-ar050', 'ap4')
+        os.makedirs(self.src_dir)
+        self.src_files = [os.path.join(self.src_dir, filename)
+                          for filename in ['ar050a.p41850jan.pp',
+                                           'ar050a.p41850feb.pp']]
+        for src in self.src_files:
+            open(src, 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def _links(self):
+        return dict((filename, os.readlink(os.path.join(self.link_dir,
+                                                        filename)))
+                    for filename in os.listdir(self.link_dir))
+
+    def test_link(self):
+        self.assertEqual(2, link_many(self.src_files, self.link_dir))
+        expected = dict((os.path.basename(src), src)
+                        for src in self.src_files)
+        self.assertEqual(expected, self._links())
+        # nothing is left next to the symlink directory
+        self.assertEqual(['ap4'],
+                         os.listdir(os.path.dirname(self.link_dir)))
+
+    def test_replace_previous_links(self):
+        link_many(self.src_files, self.link_dir)
+        self.assertEqual(1, link_many(self.src_files[1:], self.link_dir))
+        self.assertEqual(
+            {os.path.basename(self.src_files[1]): self.src_files[1]},
+            self._links())
+        self.assertEqual(['ap4'],
+                         os.listdir(os.path.dirname(self.link_dir)))
+
+    def test_failed_link_keeps_previous_links(self):
+        link_many(self.src_files, self.link_dir)
+        previous_links = self._links()
+        error = OSError(errno.ENOSPC, 'No space left on device')
+        with mock.patch('os.symlink', side_effect=error):
+            self.assertRaises(OSError, link_many, self.src_files[1:],
+                              self.link_dir)
+        self.assertEqual(previous_links, self._links())
+        self.assertEqual(['ap4'],
+                         os.listdir(os.path.dirname(self.link_dir)))
+
+
+class TestReplacePath(unittest.TestCase):
+    """
+    Test putting a new file or directory in place of an old one.
+    """
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'dir')
+        self.new_path = os.path.join(self.tmp_dir, 'new_dir')
+        for dirname, filename in [(self.path, 'old.nc'),
+                                  (self.new_path, 'new.nc')]:
+            os.makedirs(dirname)
+            open(os.path.join(dirname, filename), 'w').close()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_replace(self):
+        replace_path(self.new_path, self.path)
+        self.assertEqual(['new.nc'], os.listdir(self.path))
+        self.assertEqual(['dir'], os.listdir(self.tmp_dir))
+
+    def test_replace_missing(self):
+        shutil.rmtree(self.path)
+        replace_path(self.new_path, self.path)
+        self.assertEqual(['new.nc'], os.listdir(self.path))
+
+    def test_failed_replace_restores(self):
+        rename = os.rename
+
+        def failed_rename(src, dest):
+            if src == self.new_path:
+                raise OSError(errno.EXDEV, 'Invalid cross-device link')
+            return rename(src, dest)
+
+        with mock.patch('os.rename', side_effect=failed_rename):
+            self.assertRaises(OSError, replace_path, self.new_path,
+                              self.path)
+        self.assertEqual(['old.nc'], os.listdir(self.path))
+        self.assertEqual(['dir', 'new_dir'], sorted(os.listdir(self.tmp_dir)))
 
 
 class TestExpectedAP(unittest.TestCase):
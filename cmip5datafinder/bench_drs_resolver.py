@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+bench_drs_resolver.py
+Microbenchmark of the per-filedescriptor cost of data_finder.DRSResolver,
+i.e. of mapping a params file row to the exact directory of its files,
+for each of the DRS layouts in data_finder.CMIP5_DRS_TEMPLATES.
+No archive is needed: BADC, ETHZ and SMHI paths are pure string work,
+the versioned layouts (DKRZ, SDT: latest version by listdir, once per
+ensemble directory, see data_finder.LatestVersions) run against a small
+temporary tree each.
+
+Example:
+python bench_drs_resolver.py --descriptors 20000 --repeat 5
+
+"""
+
+# ---- Import standard modules to the python path.
+import sys, os, getopt, time, tempfile, shutil
+import data_finder as df
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+MIPS = ['Amon', 'Omon', 'Lmon', 'LImon', 'OImon', 'aero', 'day', 'cfMon']
+VARIABLES = ['tas', 'pr', 'tro3', 'hus', 'ua', 'va', 'zg', 'clt']
+
+# ---- synthetic filedescriptors
+def make_descriptors(n):
+    """
+    Returns n (model, var) dictionary pairs cycling through
+    all the known models, a few mips and variables
+    """
+    models = sorted(df.CMIP5_MODEL2INST)
+    descriptors = []
+    for i in range(n):
+        model = {'project': 'CMIP5',
+                 'name': models[i % len(models)],
+                 'mip': MIPS[(i // len(models)) % len(MIPS)],
+                 'exp': 'historical',
+                 'ensemble': 'r%ii1p1' % (i % 3 + 1),
+                 'start_year': '1980',
+                 'end_year': '2005'}
+        var = {'name': VARIABLES[i % len(VARIABLES)]}
+        descriptors.append((model, var))
+    return descriptors
+
+# ---- versioned layouts need the ensemble dirs to pick the latest version
+def make_versioned_tree(rootpath, drs, descriptors):
+    resolver = df.DRSResolver(rootpath, drs)
+    for model, var in descriptors:
+        realm, freq = df.cmip5_mip2realm_freq(model['mip'])
+        ensemble_dir = resolver.ensemble_template.format(
+            root=resolver.rootpath, institute=df.cmip5_model2inst(model['name']),
+            model=model['name'], exp=model['exp'], realm=realm, freq=freq,
+            mip=model['mip'], ensemble=model['ensemble'])
+        for version in ('v20110101', 'v20120101'):
+            vdir = os.path.join(ensemble_dir, version)
+            if not os.path.isdir(vdir):
+                os.makedirs(vdir)
+
+# ---- time a resolver over all descriptors
+def time_resolver(resolver, descriptors, repeat):
+    """
+    Returns the best time per descriptor over repeat runs, in seconds
+    """
+    best = None
+    for r in range(repeat):
+        t1 = time.time()
+        for model, var in descriptors:
+            resolver.directory(model, var)
+        dt = time.time() - t1
+        if best is None or dt < best:
+            best = dt
+    return best / len(descriptors)
+
+# ---- Function usage.
+def usage():
+    msg = """\
+Microbenchmark of the DRS path resolution per filedescriptor
+
+Usage:
+  bench_drs_resolver.py [options]
+  --descriptors <N>           Number of synthetic filedescriptors (default 10000)
+  --repeat <N>                Number of timed runs, the best one is reported (default 3)
+  -h, --help                  Display this message and exit
+"""
+    print(msg)
+
+if __name__ == '__main__':
+    ndesc = 10000
+    repeat = 3
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'descriptors=', 'repeat='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o == '--descriptors':
+            ndesc = int(a)
+        elif o == '--repeat':
+            repeat = int(a)
+    descriptors = make_descriptors(ndesc)
+    tmpdir = tempfile.mkdtemp(prefix='bench_drs_')
+    try:
+        print('%i filedescriptors, best of %i runs' % (ndesc, repeat))
+        for drs in sorted(df.CMIP5_DRS_TEMPLATES):
+            if '{version}' in df.CMIP5_DRS_TEMPLATES[drs]:
+                rootpath = os.path.join(tmpdir, drs)
+                make_versioned_tree(rootpath, drs, descriptors)
+            else:
+                rootpath = '/badc/cmip5/data/cmip5/output1'
+            resolver = df.get_drs_resolver(rootpath, drs)
+            per_item = time_resolver(resolver, descriptors, repeat)
+            print('%-5s %8.2f us per filedescriptor' % (drs, per_item * 1e6))
+    finally:
+        shutil.rmtree(tmpdir)
@@ -0,0 +1,95 @@
+#!/usr/bin/env python
+
+"""
+bench_final_cache.py
+Benchmark of cmip5datafinder_v2.final_cache, i.e. of building the final
+user-friendly cache from the combined cache, at growing sizes: for each
+size N there are N filedescriptors and FILES*N files in the combined
+cache (one file per decade). The time per filedescriptor should stay
+flat as N grows, final_cache being a single pass over the combined
+cache and a dictionary lookup per filedescriptor.
+
+Example:
+python bench_final_cache.py --descriptors 10000 --files 10
+
+"""
+
+# ---- Import standard modules to the python path.
+import sys, os, getopt, time, tempfile, shutil
+import data_finder as df
+import cmip5datafinder_v2 as finder
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+MIPS = ['Amon', 'Omon', 'Lmon', 'LImon', 'OImon', 'day']
+VARIABLES = ['tas', 'pr', 'tro3', 'hus', 'ua', 'va', 'zg', 'clt']
+
+# ---- synthetic params file rows and combined cache
+def make_cache(n, nfiles, cache_file):
+    """
+    Returns n distinct params file rows (lists of fields) and writes
+    their combined cache: nfiles decadal files from 1900 each, every
+    seventh filedescriptor missing its middle file (a data gap)
+    """
+    models = sorted(df.CMIP5_MODEL2INST)
+    combos = len(models) * len(MIPS) * len(VARIABLES)
+    itemlist = []
+    with open(cache_file, 'w') as cf:
+        for i in range(n):
+            model = models[i % len(models)]
+            mip = MIPS[(i // len(models)) % len(MIPS)]
+            ensemble = 'r%ii1p1' % (i // combos + 1)
+            var = VARIABLES[(i // (len(models) * len(MIPS))) % len(VARIABLES)]
+            item = ['CMIP5', model, mip, 'historical', ensemble, '1900', str(1899 + 10 * nfiles), var]
+            itemlist.append(item)
+            header = '_'.join(item)
+            for k in range(nfiles):
+                if i % 7 == 0 and k == nfiles // 2:
+                    continue
+                decade = 1900 + 10 * k
+                cf.write('%s /badc/cmip5/data/%s/%s_%s_%s_historical_%s_%i01-%i12.nc\n'
+                         % (header, model, var, mip, model, ensemble, decade, decade + 9))
+    return itemlist
+
+# ---- Function usage.
+def usage():
+    msg = """\
+Benchmark of the final cache build at growing sizes
+
+Usage:
+  bench_final_cache.py [options]
+  --descriptors <N>           Largest number of filedescriptors (default 10000); the
+                              benchmark also runs at N/100 and N/10
+  --files <N>                 Files per filedescriptor in the combined cache (default 10)
+  -h, --help                  Display this message and exit
+"""
+    print(msg)
+
+if __name__ == '__main__':
+    ndesc = 10000
+    nfiles = 10
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'descriptors=', 'files='])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o == '--descriptors':
+            ndesc = int(a)
+        elif o == '--files':
+            nfiles = int(a)
+    tmpdir = tempfile.mkdtemp(prefix='bench_final_cache_')
+    try:
+        for n in (max(ndesc // 100, 1), max(ndesc // 10, 1), ndesc):
+            cache_file = os.path.join(tmpdir, 'cache_cmip5_combined.txt')
+            itemlist = make_cache(n, nfiles, cache_file)
+            t1 = time.time()
+            finder.final_cache(itemlist, cache_file, os.path.join(tmpdir, 'cache_final.txt'))
+            dt = time.time() - t1
+            print('%6i filedescriptors x %i files: %7.3f s (%.2f us per file)'
+                  % (n, nfiles, dt, dt / (n * nfiles) * 1e6))
+    finally:
+        shutil.rmtree(tmpdir)
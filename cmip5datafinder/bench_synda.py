@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+
+"""
+bench_synda.py
+Benchmark of the full synda path of cmip5datafinder_v2.py
+(--synda --download --dryrun) without ESGF access: a synthetic params
+file of N filedescriptors is run against fake_synda.py, which answers
+every synda call after FAKE_SYNDA_LATENCY seconds. Nothing of it is on
+the local datasource, so every filedescriptor goes through synda search
+and synda_dll. The run happens in a temporary directory; the wall time
+and the number of filedescriptors per second are reported.
+
+Example:
+python bench_synda.py --descriptors 10000 --latency 0.05 --jobs 16
+
+"""
+
+# ---- Import standard modules to the python path.
+import sys, os, getopt, time, tempfile, shutil, subprocess
+import data_finder as df
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+MIPS = ['Amon', 'Omon', 'Lmon', 'LImon', 'OImon', 'day']
+VARIABLES = ['tas', 'pr', 'tro3', 'hus', 'ua', 'va', 'zg', 'clt']
+
+# ---- synthetic params file
+def write_params_file(path, n):
+    """
+    Writes n distinct params file rows e.g.
+    CMIP5 MPI-ESM-LR Amon historical r1i1p1 1980 2005 tas
+    """
+    models = sorted(df.CMIP5_MODEL2INST)
+    combos = len(models) * len(MIPS) * len(VARIABLES)
+    with open(path, 'w') as pf:
+        for i in range(n):
+            pf.write('CMIP5 %s %s historical r%ii1p1 1980 2005 %s\n'
+                     % (models[i % len(models)],
+                        MIPS[(i // len(models)) % len(MIPS)],
+                        i // combos + 1,
+                        VARIABLES[(i // (len(models) * len(MIPS))) % len(VARIABLES)]))
+
+# ---- Function usage.
+def usage():
+    msg = """\
+Benchmark of cmip5datafinder_v2.py --synda --download --dryrun against fake_synda.py
+
+Usage:
+  bench_synda.py [options]
+  --descriptors <N>           Number of synthetic filedescriptors (default 10000)
+  --latency <sec>             Seconds each fake synda call takes (default 0.05)
+  --jobs <N>                  Passed on to cmip5datafinder_v2.py --jobs (default 1)
+  --recordings <dir>          Directory of recorded synda outputs to replay (see fake_synda.py)
+  --keep                      Flag to keep the temporary run directory (printed at the end)
+  -h, --help                  Display this message and exit
+"""
+    print(msg)
+
+if __name__ == '__main__':
+    ndesc = 10000
+    latency = 0.05
+    jobs = 1
+    recordings = None
+    keep = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h', ['help', 'descriptors=', 'latency=',
+                                                       'jobs=', 'recordings=', 'keep'])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o == '--descriptors':
+            ndesc = int(a)
+        elif o == '--latency':
+            latency = float(a)
+        elif o == '--jobs':
+            jobs = int(a)
+        elif o == '--recordings':
+            recordings = os.path.abspath(a)
+        elif o == '--keep':
+            keep = True
+    rundir = tempfile.mkdtemp(prefix='bench_synda_')
+    try:
+        write_params_file(os.path.join(rundir, 'bench_params.txt'), ndesc)
+        env = dict(os.environ)
+        env['FAKE_SYNDA_LATENCY'] = str(latency)
+        if recordings:
+            env['FAKE_SYNDA_RECORDINGS'] = recordings
+        cmd = [sys.executable, os.path.join(HERE, 'cmip5datafinder_v2.py'),
+               '-p', 'bench_params.txt', '--datasource', 'badc',
+               '--synda', '--download', '--dryrun',
+               '--synda-exec', os.path.join(HERE, 'fake_synda.py'),
+               '--jobs', str(jobs), '--no-plots']
+        print('Running: %s' % ' '.join(cmd))
+        t1 = time.time()
+        with open(os.path.join(rundir, 'bench.log'), 'w') as log:
+            returncode = subprocess.call(cmd, cwd=rundir, env=env, stdout=log, stderr=subprocess.STDOUT)
+        dt = time.time() - t1
+        if returncode != 0:
+            print('cmip5datafinder_v2.py failed (exit code %i), see %s' % (returncode, os.path.join(rundir, 'bench.log')))
+            keep = True
+            sys.exit(1)
+        print('%i filedescriptors, %.3f s synda latency, %i jobs: %.1f s (%.1f filedescriptors/s)'
+              % (ndesc, latency, jobs, dt, ndesc / dt))
+    finally:
+        if keep:
+            print('Run directory: %s' % rundir)
+        else:
+            shutil.rmtree(rundir)
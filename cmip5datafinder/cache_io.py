@@ -0,0 +1,216 @@
+"""
+cache_io.py
+Reading and writing of the datafinder cache files.
+
+CacheWriter keeps a cache file open for a whole stage of the run instead
+of re-opening it in append mode for every line (an open/close metadata
+round-trip per file found on Lustre/GPFS). Lines are written to a
+temporary .part file next to the cache file, which is renamed over the
+cache file only when the stage completes, so a killed run never leaves
+behind a half-written cache that a later run could mistake for a good one.
+
+"""
+import os
+import shutil
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+# ---- buffered, atomically renamed cache file writer
+class CacheWriter:
+    """
+    Buffered writer for a single cache file, use it as
+    with CacheWriter(outfile) as cw:
+        cw.write(header + ' ' + path + '\n')
+
+    path: cache file
+    append: keep what is already in path and add to it (same as the
+            old open(path, 'a')); if False path is overwritten
+    buffering: write buffer size in bytes
+    create: write path even if no line was written
+
+    Unless create is set, nothing is created if no line was written,
+    so os.path.exists(path) still tells if anything was cached.
+    If the with block raises, the temporary file is removed and
+    path is left as it was.
+    """
+
+    def __init__(self, path, append=True, buffering=1 << 16, create=False):
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.append = append
+        self.buffering = buffering
+        self.create = create
+        self.file = None
+        self.lines = 0
+
+    def _open(self):
+        if self.append and os.path.exists(self.path):
+            shutil.copyfile(self.path, self.tmp_path)
+            self.file = open(self.tmp_path, 'a', self.buffering)
+        else:
+            self.file = open(self.tmp_path, 'w', self.buffering)
+
+    def write(self, line):
+        if self.file is None:
+            self._open()
+        self.file.write(line)
+        self.lines += 1
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def flush(self):
+        """
+        Explicit flush point: push the buffered lines to the .part file
+        """
+        if self.file is not None:
+            self.file.flush()
+
+    def close(self):
+        """
+        Flush to disk and move the .part file over the cache file
+        """
+        if self.file is None:
+            if not self.create:
+                return
+            self._open()
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        self.file = None
+        os.rename(self.tmp_path, self.path)
+
+    def abort(self):
+        """
+        Drop everything written since the writer was opened
+        """
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        os.remove(self.tmp_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+# ---- write a whole cache file at once
+def write_lines(path, lines):
+    """
+    Replaces path with the given lines through a .part file,
+    so readers see either the old or the new cache, never half of it;
+    with no lines, path is replaced by an empty file
+    """
+    with CacheWriter(path, append=False, create=True) as cw:
+        cw.writelines(lines)
+
+# ---- columnar (binary) version of the final user-friendly cache
+def save_final_cache(path, records):
+    """
+    Saves the final cache as a numpy .npz file, next to (not instead of)
+    the text cache_<params>-<server> file, so downstream tools can load it
+    without re-parsing text:
+    records: list of (filedescriptor, status, coverage fraction, [files])
+    as written by final_cache. The file holds two arrays: 'records', a
+    structured array (header, status, coverage, first, nfiles) and
+    'files', all file paths back to back; a filedescriptor's files are
+    files[first:first + nfiles].
+    """
+    import numpy as np
+    files = []
+    rows = []
+    for header, status, coverage, flist in records:
+        rows.append((header, status, coverage, len(files), len(flist)))
+        files.extend(flist)
+    hlen = max([len(r[0]) for r in rows] + [1])
+    slen = max([len(r[1]) for r in rows] + [1])
+    flen = max([len(f) for f in files] + [1])
+    dtype = [('header', '%s%i' % (np.dtype(str).char, hlen)),
+             ('status', '%s%i' % (np.dtype(str).char, slen)),
+             ('coverage', 'f8'),
+             ('first', 'i8'),
+             ('nfiles', 'i8')]
+    rec = np.array(rows, dtype=dtype)
+    fil = np.array(files, dtype='%s%i' % (np.dtype(str).char, flen))
+    # np.savez appends .npz to names without it; write through a .part
+    # file (same as the text caches) so readers never see half a file
+    tmp_path = path + '.part.npz'
+    with open(tmp_path, 'wb') as f:
+        np.savez(f, records=rec, files=fil)
+    os.rename(tmp_path, path)
+
+class FinalCache:
+    """
+    Final cache as loaded by load_final_cache:
+    records: structured array with fields header, status, coverage,
+             first, nfiles (one row per filedescriptor)
+    files: array of all file paths, see files_of()
+    """
+
+    def __init__(self, records, files):
+        self.records = records
+        self.all_files = files
+        self._index = None
+
+    def __len__(self):
+        return len(self.records)
+
+    def files_of(self, i):
+        """
+        List of file paths of the i-th filedescriptor
+        """
+        first = self.records['first'][i]
+        return [str(f) for f in self.all_files[first:first + self.records['nfiles'][i]]]
+
+    def lookup(self, header):
+        """
+        Returns (status, coverage, [files]) for a filedescriptor
+        e.g. CMIP5_MIROC5_Amon_historical_r1i1p1_2003_2010_hus
+        or None if it is not in the cache
+        """
+        if self._index is None:
+            self._index = dict((str(h), i) for i, h in enumerate(self.records['header']))
+        i = self._index.get(header)
+        if i is None:
+            return None
+        return (str(self.records['status'][i]), float(self.records['coverage'][i]),
+                self.files_of(i))
+
+def _native_strings(array):
+    """
+    Returns array with its string fields in the native str type: the
+    .npz written under Python 2 holds byte strings (dtype 'S') which
+    Python 3 would see as b'...', and the one written under Python 3
+    holds unicode strings (dtype 'U'); paths are utf-8
+    """
+    import numpy as np
+    native = np.dtype(str).kind
+    if array.dtype.names is None:
+        if array.dtype.kind == native or array.dtype.kind not in 'SU':
+            return array
+        if native == 'U':
+            return np.char.decode(array, 'utf-8')
+        return np.char.encode(array, 'utf-8')
+    fields = dict((name, _native_strings(array[name])) for name in array.dtype.names)
+    converted = np.empty(array.shape, dtype=[(name, fields[name].dtype)
+                                             for name in array.dtype.names])
+    for name in array.dtype.names:
+        converted[name] = fields[name]
+    return converted
+
+def load_final_cache(path):
+    """
+    Loads a final cache written by save_final_cache, under either
+    Python 2 or 3 whichever wrote it; returns a FinalCache
+    """
+    import numpy as np
+    with np.load(path) as data:
+        return FinalCache(_native_strings(data['records']),
+                          _native_strings(data['files']))
@@ -21,9 +21,22 @@ from xml.dom import minidom
 import subprocess
 from datetime import datetime
 import time
+import glob
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
 
 __author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
 
+# ---- model -> institute directories, per root directory;
+# ---- built once per run by find_local_files()
+MODEL_INSTITUTES = {}
+
 # ---- Function usage.
 # ---- opts parsing
 def usage():
@@ -347,6 +360,22 @@ def write_cache_via_synda(searchoutput,varname,year1_model,year2_model,header,ou
         print >> sys.stderr, "Could not find filedescriptor with the specified parameters on datasource"
         return 0
 
+# ---- DRS directories (frequency, realm, mip table) below
+# ---- root/institute/model/experiment for each mip; a '*' is only
+# ---- left where the same mip can sit under more than one realm
+MIP_DRS = {
+    '3h': ('3h', '*', '*'),
+    '6h': ('6h', '*', '*'),
+    'day': ('day', '*', 'day'),
+    'cfDay': ('day', 'atmos', 'cfDay'),
+    'Amon': ('mon', 'atmos', 'Amon'),
+    'Omon': ('mon', 'ocean', 'Omon'),
+    'Lmon': ('mon', 'land', 'Lmon'),
+    'LImon': ('mon', 'landIce', 'LImon'),
+    'OImon': ('mon', 'seaIce', 'OImon'),
+    'aero': ('mon', 'aerosol', 'aero'),
+}
+
 # ---- function that returns the DRS
 def get_drs(dir1, sdir, ic, model, latest_dir):
     """
@@ -357,103 +386,127 @@ def get_drs(dir1, sdir, ic, model, latest_dir):
     model: CMIP5 MPI-ESM-LR Amon amip r1i1p1
     latest_dir: on badc is /latest/ - this is known in advance
     and is dependant on where the code is run.
+    The frequency/realm/mip directories come from MIP_DRS;
+    e.g. for monthly (mon) data this is a very detailed DRS,
+    looking straight into the variable dir (variable = model[7])
     """
-    # 3h
-    if model[2] == '3h':
-        gdrs = dir1 + sdir + '/' + ic + '/' + model[3] + '/3h/*/*/' + model[4]\
-               + latest_dir + model[7] + '/'
-    # 6h
-    elif model[2] == '6h':
-        gdrs = dir1 + sdir + '/' + ic + '/' + model[3] + '/6h/*/*/' + model[4]\
-               + latest_dir + model[7] + '/'
-    # daily (day)
-    # the current implementation does not make the difference
-    # between day and cfDay in lower dirs
-    elif model[2] == 'day':
-        gdrs = dir1 + sdir + '/' + ic + '/' + model[3] + '/day/*/*/' + model[4]\
-              + latest_dir + model[7] + '/'
-    elif model[2] == 'cfDay':
-        gdrs = dir1 + sdir + '/' + ic + '/' + model[3] + '/cfDay/*/*/' + model[4]\
-              + latest_dir + model[7] + '/'
-    # monthly (mon)
-    # very detailed DRS, looking straight into variable dir
-    # variable = model[7]
-    elif model[2] == 'Amon':
-        gdrs = dir1 + sdir\
-              + '/' + ic + '/' + model[3] + '/mon/atmos/Amon/' + model[4]\
-              + latest_dir + model[7] + '/'
-    elif model[2] == 'Omon':
-        gdrs = dir1 + sdir\
-              + '/' + ic + '/' + model[3] + '/mon/ocean/Omon/' + model[4]\
-              + latest_dir + model[7] + '/'
-    elif model[2] == 'Lmon':
-        gdrs = dir1 + sdir\
-              + '/' + ic + '/' + model[3] + '/mon/land/Lmon/' + model[4]\
-              + latest_dir + model[7] + '/'
-    elif model[2] == 'LImon':
-        gdrs = dir1 + sdir\
-              + '/' + ic + '/' + model[3] + '/mon/landIce/LImon/' + model[4]\
-              + latest_dir + model[7] + '/'
-    elif model[2] == 'OImon':
-        gdrs = dir1 + sdir\
-              + '/' + ic + '/' + model[3] + '/mon/seaIce/OImon/' + model[4]\
-              + latest_dir + model[7] + '/'
-    # aerosols
-    elif model[2] == 'aero':
-        gdrs = dir1 + sdir\
-              + '/' + ic + '/' + model[3] + '/mon/aerosol/aero/' + model[4]\
-              + latest_dir + model[7] + '/'
+    if model[2] in MIP_DRS:
+        freq, realm, mip = MIP_DRS[model[2]]
+        custom = True
     else:
+        freq, realm, mip = model[2], '*', '*'
+        custom = False
+    gdrs = dir1 + sdir + '/' + ic + '/' + model[3] + '/' + freq + '/' + realm + '/' + mip\
+           + '/' + model[4] + latest_dir + model[7] + '/'
+    if custom is False:
         print('Could not establish custom DRS...')
-        gdrs = dir1 + sdir + '/' + ic + '/' + model[3] + '/' + model[2] + '/*/*/' + model[4]\
-               + latest_dir + model[7] + '/'
         print('Using generalized path: %s' % gdrs)
     return gdrs
 
+# ---- list a directory in-process
+def list_subdirs(dirname, mfile=None):
+    """
+    Returns the names of the subdirectories of dirname (symlinks to
+    directories included, same as ls -la + find -follow did).
+    mfile: stderr dump file (cache_err.out); permission denied or
+    non-existent dirs are logged there and give an empty list
+    """
+    try:
+        if _scandir is not None:
+            subdirs = []
+            for entry in _scandir(dirname):
+                try:
+                    if entry.is_dir():
+                        subdirs.append(entry.name)
+                except OSError:
+                    continue
+        else:
+            subdirs = [name for name in os.listdir(dirname)
+                       if os.path.isdir(os.path.join(dirname, name))]
+    except OSError as exc:
+        if mfile is not None:
+            with open(mfile, 'a') as file:
+                file.write(str(exc) + '\n')
+        return []
+    return sorted(subdirs)
+
+# ---- walk a directory tree for .nc files in-process
+def walk_nc_files(dirname):
+    """
+    Returns all the .nc files (case insensitive, symlinks followed)
+    below dirname; same as find dirname -follow -type f -iname "*.nc";
+    a directory reached again through a symlink, (st_dev, st_ino) already
+    seen, is skipped so symlink loops do not walk forever
+    """
+    flist = []
+    visited = set()
+    stack = [dirname.rstrip('/')]
+    while stack:
+        top = stack.pop()
+        try:
+            st = os.stat(top)
+            if (st.st_dev, st.st_ino) in visited:
+                continue
+            visited.add((st.st_dev, st.st_ino))
+            if _scandir is not None:
+                entries = [(e.name, e.is_dir(), e.is_file()) for e in _scandir(top)]
+            else:
+                entries = []
+                for name in os.listdir(top):
+                    fpath = os.path.join(top, name)
+                    entries.append((name, os.path.isdir(fpath), os.path.isfile(fpath)))
+        except OSError:
+            continue
+        for name, is_dir, is_file in entries:
+            if is_dir:
+                stack.append(top + '/' + name)
+            elif is_file and name.lower().endswith('.nc'):
+                flist.append(top + '/' + name)
+    return flist
+
 # ---- capture ls in the preferred directory
 def lsladir(dirname):
     """
     Calling this function once so we save time; called in root dirname.
     It is needed for generalization and not hardcoding the institutions.
+    Returns the institute directory names.
     """
-    # capture the ls output
-    lsd = 'ls -la ' + dirname
-    proc = subprocess.Popen(lsd, stdout=subprocess.PIPE, shell=True)
-    (out, err) = proc.communicate()
-    res = out.split('\n')[3:-1]
-    return res
+    return list_subdirs(dirname)
+
+# ---- model -> institutes map of a root directory
+def model_institutes(dirname1, institutes, mfile):
+    """
+    Lists every institute directory once and returns a dictionary
+    model -> [institutes]; cached in MODEL_INSTITUTES for the whole run
+    so a params file row costs no directory listing at all.
+    """
+    if dirname1 not in MODEL_INSTITUTES:
+        mi = {}
+        for subdir in institutes:
+            for findic in list_subdirs(dirname1 + subdir, mfile):
+                mi.setdefault(findic, []).append(subdir)
+        MODEL_INSTITUTES[dirname1] = mi
+    return MODEL_INSTITUTES[dirname1]
 
 # ---- local file finder
 def find_local_files(model,out1,dirname1,mfile,latest_dir):
     """
-    Function that performs local search for files using `find'
-    The depth is as high as possible so that find is fast.
+    Function that performs local search for files, in-process
+    (no ls or find subprocesses); the depth is as high as possible
+    so that the walk is fast.
     model: CMIP5 MPI-ESM-LR Amon amip r1i1p1
+    out1: institute directories in dirname1, see lsladir()
     mfile: stderr dump file (cache_err.out) - need to capture
     instances of either Permission denied or non-existent dirs;
     latest_dir: latest version directory e.g. /latest/ on badc
     (see above for details)
     """
     flist = []
-    for st in out1:
-        subdir = st.split()[-1]
-        lsd2 = 'ls -la ' + dirname1 + subdir
-        FNULL = open(mfile, 'a')
-        proc2 = subprocess.Popen(lsd2, stdout=subprocess.PIPE, stderr=FNULL, shell=True)
-        (out2, err2) = proc2.communicate()
-        # work only with existing dirs or allowed permission dirs
-        if len(out2) > 0:
-            for st2 in out2.split('\n')[3:-1]:
-                findic = st2.split()[-1]
-                if findic == model[1]:
-                    drs = get_drs(dirname1,subdir, findic, model,latest_dir)
-                    # -follow option allows for finding symlinked files
-                    strfindic = 'find ' + drs\
-                                 +' -follow -type f -iname "*.nc"'
-                    proc = subprocess.Popen(strfindic, stdout=subprocess.PIPE, shell=True)
-                    (out, err) = proc.communicate()
-                    for t in out.split('\n')[0:-1]:
-                        flist.append(t)
+    for subdir in model_institutes(dirname1, out1, mfile).get(model[1], []):
+        drs = get_drs(dirname1, subdir, model[1], model, latest_dir)
+        # the DRS may hold wildcards e.g. for 3h/6h/day data
+        for drsdir in glob.glob(drs):
+            flist.extend(walk_nc_files(drsdir))
     return flist
     # ---- done
 
@@ -4,7 +4,8 @@
 cmip5datafinder.py
 Python 2.7.13
 Script that searches for data locally and on valid ESGF nodes. It builds 
-cache files using the results of the search.
+cache files using the results of the search. It can also be imported,
+see find_data.
 
 """
 
@@ -13,18 +14,32 @@ cache files using the results of the search.
 # -------------------------------------------------------------------------
 
 # ---- Import standard modules to the python path.
-import sys, os, shutil, math, copy, getopt, re, string, popen2, time, errno
-import numpy as np
-from numpy import loadtxt as lt
-from numpy import savetxt as st
+import sys, os, shutil, math, copy, getopt, re, string, popen2, time, errno, json
 from xml.dom import minidom
 import subprocess
-from datetime import datetime
 import time
+from multiprocessing.pool import ThreadPool
 import data_finder as df
+import file_dates
+import time_coverage
+import cache_io
+import drs_index
+import manifest
 
 __author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
 
+# ---- synda executable; --synda-exec points this to any stand-in
+# ---- (e.g. a local fake synda script for offline tests)
+SYNDA = 'synda'
+
+# ---- local datasources: name -> (root path, DRS layout)
+# ---- (see data_finder.CMIP5_DRS_TEMPLATES for the layouts)
+DATASOURCES = {
+    'badc': ('/badc/cmip5/data/cmip5/output1', 'BADC'),
+    'dkrz': ('/mnt/lustre01/work/kd0956/CMIP5/data/cmip5/output1', 'DKRZ'),
+    'sdt': ('/sdt/data/cmip5/output1', 'SDT'),
+}
+
 # ---- Function usage.
 # ---- opts parsing
 def usage():
@@ -72,7 +87,14 @@ Usage:
                               with --fileparams for each parameter)
                               This option is REQUIRED if --params-file is not present
   --datasource                Name of local data source (example: badc). Available datasources:
-                              badc [to add more here, depending where running the code][REQUIRED]
+                              badc, dkrz, sdt (synda local data) [to add more here, depending where
+                              running the code, see DATASOURCES][REQUIRED]
+                              Can be given more than once, each datasource is searched on its own
+                              unless --federated is passed
+  --federated                 Flag to search all --datasource's as one: every filedescriptor is looked
+                              up on all of them at the same time and the first datasource (in the order
+                              given) that has it complete is used, else the files of all are merged;
+                              writes a single cache_files_federated directory and final cache
   --synda                     Flag to call synda operations. If not passed, local datasources will be used ONLY
   --download                  Flag to allow download missing data via synda
   --dryrun                    Flag to pass if no download is wanted. Don't pass this if downloads are neeeded!
@@ -86,6 +108,40 @@ Usage:
                               If --user-input is used, this serial option is REQUIRED
                               e.g. --uservars tro3
   --verbose                   Flag to show in-code detailed messages
+  --jobs <N>                  Number of params file rows resolved at the same time on the local
+                              datasource and number of synda searches run at the same time
+                              (default 1); local cache files are identical to a serial run
+  --binary-cache              Flag to also write the final cache in columnar form (numpy .npz) as
+                              cache_PARAM_FILE.txt-DATASOURCE.npz, see cache_io.load_final_cache
+  --synda-exec <path>         synda executable to use (default: synda found in PATH); any
+                              stand-in with the same command line works e.g. a fake synda script
+  --incremental               Flag to reuse the cache of the previous run: the
+                              cache_files_[DATASOURCE] directory is kept and only new or changed params
+                              file rows, and rows whose DRS directories changed since, are looked up
+                              again; a full run is done if the options in cmip5datafinder.param changed
+  --version-cache <file>      JSON file keeping the latest version directory of each ensemble directory
+                              (DKRZ layout) between runs, so versions directories are not listed again
+  --version-cache-ttl <sec>   Seconds after which a version in --version-cache is looked up again
+                              (default 86400)
+  --produce-manifest <file>   Write a manifest of exactly which files were cached: filedescriptor, path,
+                              size, mtime, netCDF tracking_id and checksum of each file (see manifest.py);
+                              checksums are computed by --jobs processes and an interrupted manifest
+                              is resumed (<file>-DATASOURCE if more than one datasource is searched)
+  --use-manifest <file>       Use a manifest (from --produce-manifest) instead of --params-file: the
+                              exact files in it are cached (not necessarily the latest versions) if they
+                              are still at their path with the same size
+  --verify-manifest           Flag to also check the checksum of each file with --use-manifest
+  --checksum-cache <file>     SQLite file keeping the checksums of --produce-manifest between runs: files
+                              with the same inode, size and mtime are not read again; entries of
+                              files that are gone are dropped at the end of the run
+  --no-plots                  Flag to skip the pie charts of the final cache (matplotlib is not loaded)
+  --plots-dir <dir>           Directory to save the pie charts in (default: cache_files_[DATASOURCE])
+  --stats-json <file>         Write the final stats of each datasource (counts by status, average
+                              coverage, time elapsed) to a JSON file
+  --drs-index <file>          SQLite DRS index of the local datasource (see drs_index.py) to query
+                              instead of running find for every filedescriptor; the index is
+                              refreshed (only changed directories are re-listed) before the search;
+                              with several datasources, each has its own <file>-DATASOURCE
 
 Understand the workflow:
 (1) python cmip5datafinder.py -p PARAM_FILE --datasource badc
@@ -188,29 +244,21 @@ def date_handling(time1,time2):
     time1 = 198204 or
     time1 = 19820422 or
     time1 = 198204220511 etc
-    More formats can be coded in at this stage.
+    More formats can be coded in at file_dates.py.
     Returns year 1 and year 2
     """
-    # yyyymm
-    if len(list(time1)) == 6 and len(list(time2)) == 6:
-        y1 = datetime.strptime(time1, '%Y%m')
-        year1 = y1.year
-        y2 = datetime.strptime(time2, '%Y%m')
-        year2 = y2.year
-    else:
-        # yyyymmdd
-        if len(list(time1)) == 8 and len(list(time2)) == 8:
-            y1 = datetime.strptime(time1, '%Y%m%d')
-            year1 = y1.year
-            y2 = datetime.strptime(time2, '%Y%m%d')
-            year2 = y2.year
-        # yyyymmddHHMM
-        if len(list(time1)) == 12 and len(list(time2)) == 12:
-            y1 = datetime.strptime(time1, '%Y%m%d%H%M')
-            year1 = y1.year
-            y2 = datetime.strptime(time2, '%Y%m%d%H%M')
-            year2 = y2.year
-    return year1,year2
+    return file_dates.date_years(time1, time2)
+
+# ---- unique lines of a text file
+def unique_lines(infile):
+    """
+    Returns the sorted distinct non-empty lines of a text file,
+    stripped of comments (#) and surrounding whitespace
+    """
+    with open(infile, 'r') as f:
+        lines = set(line.split('#')[0].strip() for line in f)
+    lines.discard('')
+    return sorted(lines)
 
 # ---- cleanup duplicate entries in files
 def fix_duplicate_entries(outfile):
@@ -219,9 +267,19 @@ def fix_duplicate_entries(outfile):
     from a cache file
     """
     # ---- fixing the cache file for duplicates
-    ar = np.genfromtxt(outfile, dtype=str,delimiter='\n')
-    nar = np.unique(ar)
-    st(outfile,nar,fmt='%s')
+    cache_io.write_lines(outfile, [line + '\n' for line in unique_lines(outfile)])
+
+# ---- run a synda search
+def synda_search_output(model_data,varname):
+    """
+    Runs synda search -f model_data varname (no shell) and returns
+    (stdout, stderr, return code); this does not exit so it can be
+    run from a pool of threads, see synda_pipeline()
+    """
+    synda_cmd = [which_synda(SYNDA), 'search', '-f'] + model_data.split() + [varname]
+    proc = subprocess.Popen(synda_cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    (out, err) = proc.communicate()
+    return out, err, proc.returncode
 
 # ---- synda search
 def synda_search(model_data,varname):
@@ -236,130 +294,341 @@ def synda_search(model_data,varname):
     """
     # this is needed mostly for parallel processes that may
     # go tits-up from time to time due to random path mixes
-    if which_synda('synda') is not None:
+    if which_synda(SYNDA) is not None:
         pass
     else:
         print >> sys.stderr, "No synda executable found in path. Exiting."
         sys.exit(1)
-    synda_search = which_synda('synda') + ' search -f ' + model_data + ' ' + varname
-    proc = subprocess.Popen(synda_search, stdout=subprocess.PIPE, shell=True)
-    (out, err) = proc.communicate()
-    if err is not None:
+    (out, err, returncode) = synda_search_output(model_data,varname)
+    if returncode != 0:
         print >> sys.stderr, "An error has occured while searching for data:"
         print >> sys.stderr, err
         sys.exit(1)
     else:
         return out
 
+# ---- synda install
+def synda_install(file_names):
+    """
+    Installs (downloads) all the given files with a single
+    synda install call instead of one call per file
+    """
+    synda_cmd = [which_synda(SYNDA), 'install'] + list(file_names)
+    proc = subprocess.Popen(synda_cmd, stdout=subprocess.PIPE, stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+    dll ='\n'
+    (out, err) = proc.communicate(input=dll)
+    if proc.returncode != 0:
+        print >> sys.stderr, "An error has occured while starting the download:"
+        print >> sys.stderr, err
+        sys.exit(1)
+    return out
+
+# ---- resolve a single filedescriptor on the local datasource
+def resolve_local_item(item, rootp, drs):
+    """
+    Function that looks up the files of a single params file row
+    (filedescriptor) on the local datasource. It only reads the filesystem
+    so it can safely be run from a pool of threads; it returns three lists:
+    cache lines, missing cache lines and (verbose) messages, in the order
+    the serial write_cache_direct would write/print them.
+
+    """
+    cached = []
+    missing = []
+    messages = []
+
+    # new functionality using data_finder module
+    # build the model dictionary
+    # in file: CMIP5 MPI-ESM-LR Amon historical r1i1p1 1980 2005 pr
+    # model dictionary: {name: MPI-ESM-LR, project: CMIP5,  mip: Amon,  exp: historical,  ensemble: r1i1p1,  start_year: 2000,  end_year: 2002} 
+    model = {}
+    model['project'] = item[0]
+    model['name'] = item[1]
+    model['mip'] = item[2]
+    model['exp'] = item[3]
+    model['ensemble'] = item[4]
+    model['start_year'] = item[5]
+    model['end_year'] = item[6]
+
+    # build the var variable
+    var = {}
+    var['name'] = item[7]
+    var['mip'] = item[2]
+    var['exp'] = item[3]
+    var['ensemble'] = item[4]
+
+    try:
+        arname = df.get_input_filelist(rootp, model, var, drs)
+    except (OSError, IndexError):
+        # no (versions) directory for it on this datasource
+        arname = []
+
+    # still keep all the infrastructure
+    if len(arname) > 0:
+        # var = item[7]
+        header = item[0] + '_'+ item[1] + '_' + item[2]\
+                     + '_' + item[3] + '_' + item[4] + '_' + item[5]\
+                     + '_' + item[6] + '_' + item[7]
+        yr1 = int(item[5])
+        yr2 = int(item[6])
+        for s in arname:
+            years = file_dates.parse_years(s)
+            if years is None:
+                messages.append('File: _date1-date2.nc not properly formatted...skipping it: ' + s)
+                continue
+            year1, year2 = years
+            overlap, complete = time_handling(year1, yr1, year2, yr2)
+            # case where the required data completely overlaps
+            # available data
+            # this case stops the code to make a call to synda for this filedescriptor
+            if overlap is True and complete is True:
+                if os.path.exists(s):
+                    cached.append(header + ' ' + s + '\n')
+                    messages.append('Cached file from local datasource: ' + s)
+                else:
+                    missing.append(header + ' ERROR-MISSING' + '\n')
+                    messages.append('WARNING: missing from local datasource: ' +  header)
+            # case where the required data is not fully found
+            # ie incomplete data 
+            # what we want to do here is cache what we have available
+            # but also let synda know there is missing data, maybe
+            # she can find it...just maybe
+            # also we must make sure she doesnt download what we already have
+            if overlap is True and complete is False:
+                if os.path.exists(s):
+                    cached.append(header + ' ' + s + '\n')
+                    messages.append('Cached file from local datasource: ' + s)
+                    sfn = s.split('/')[-1]
+                    # the INCOMPLETE indicator will be used
+                    # to label partially complete filedescriptors so synda can
+                    # look for the missing bits and hopefully complete it
+                    missing.append(header + ' INCOMPLETE ' + sfn + '\n')
+                else:
+                    missing.append(header + ' ERROR-MISSING' + '\n')
+                    messages.append('WARNING: missing from local datasource: ' +  header)
+    else:
+        # missing entirely
+        missing.append("_".join(item) + ' ERROR-MISSING' + '\n')
+        messages.append('WARNING: missing from local datasource: ' + "_".join(item))
+    return cached, missing, messages
+
+# ---- resolve a single filedescriptor on several local datasources
+def resolve_federated_item(item, sources, pool=None):
+    """
+    Federated version of resolve_local_item: the params file row is
+    looked up on all the sources (list of (root path, DRS) in priority
+    order) at the same time, through pool if given. The result of the
+    first source that covers the whole needed period is used as it is;
+    if none does, the files of all sources are merged (a file name
+    found on more than one source is taken from the first one) and the
+    missing lines tell what the merged files still lack.
+    Returns the same three lists as resolve_local_item.
+    """
+    resolve = lambda source: resolve_local_item(item, source[0], source[1])
+    if pool is not None:
+        results = pool.map(resolve, sources)
+    else:
+        results = [resolve(source) for source in sources]
+    yr1 = int(item[5])
+    yr2 = int(item[6])
+    header = "_".join(item)
+    merged = []
+    names = set()
+    messages = []
+    for (rootp, drs), (cached, missing, msgs) in zip(sources, results):
+        messages.extend(msgs)
+        paths = [line.split()[1] for line in cached]
+        ranges = [file_dates.parse_time_range(path) for path in paths]
+        if len(paths) > 0 and time_coverage.get_coverage(ranges, yr1, yr2).is_complete():
+            messages.append('Filedescriptor complete on datasource %s: %s' % (rootp, header))
+            return cached, [], messages
+        for path, trange in zip(paths, ranges):
+            name = os.path.basename(path)
+            if name not in names:
+                names.add(name)
+                merged.append((path, trange))
+    cached = [header + ' ' + path + '\n' for path, trange in merged]
+    if len(merged) == 0:
+        return cached, ["_".join(item) + ' ERROR-MISSING' + '\n'], messages
+    if time_coverage.get_coverage([t for p, t in merged], yr1, yr2).is_complete():
+        messages.append('Filedescriptor complete on merged datasources: ' + header)
+        return cached, [], messages
+    # still incomplete: let synda look for what none of them has
+    missing = [header + ' INCOMPLETE ' + os.path.basename(path) + '\n' for path, trange in merged]
+    return cached, missing, messages
+
+# ---- directories a local lookup depends on
+def local_item_dirs(item, rootp, drs, files=()):
+    """
+    Returns the list of directories whose contents decide what
+    resolve_local_item finds for a params file row: the DRS path from the
+    root down to the variable (BADC) or ensemble (DKRZ, SDT: new versions
+    show up there) directory, plus the directories of the found files.
+    A file (or version, or /latest/ link) added or removed in any of
+    them changes that directory's mtime.
+    """
+    dirs = set(os.path.dirname(f) for f in files if f.startswith(rootp))
+    try:
+        inst = df.cmip5_model2inst(item[1])
+        realm, freq = df.cmip5_mip2realm_freq(item[2])
+    except (KeyError, TypeError):
+        # unknown model or mip: no directory to watch, always look it up
+        return None
+    if drs == 'BADC':
+        facets = [inst, item[1], item[3], freq, realm, item[2], item[4], 'latest', item[7]]
+    elif drs == 'DKRZ':
+        facets = [inst, item[1], item[3], realm, freq, item[2], item[4]]
+    elif drs == 'SDT':
+        facets = [inst, item[1], item[3], freq, realm, item[2], item[4]]
+    else:
+        return None
+    path = rootp.rstrip('/')
+    for facet in facets:
+        path = path + '/' + facet
+        dirs.add(path)
+    return sorted(dirs)
+
+def dir_mtime(dirname, memo):
+    """
+    mtime of a directory (None if it does not exist); memo is a dict
+    shared by all rows of a run since most rows share their top dirs
+    """
+    if dirname not in memo:
+        try:
+            memo[dirname] = os.stat(dirname).st_mtime
+        except OSError:
+            memo[dirname] = None
+    return memo[dirname]
+
+# ---- state of an --incremental run
+def run_options(command_line):
+    """
+    Options of a cmip5datafinder.param command line that decide the
+    cache contents (all but --incremental, --verbose and --jobs N)
+    """
+    options = []
+    tokens = iter(command_line.split())
+    for tok in tokens:
+        if tok == '--jobs':
+            next(tokens, None)
+        elif tok not in ('--incremental', '--verbose'):
+            options.append(tok)
+    return options
+
+def load_incremental_state(statefile, previous_command, command_line):
+    """
+    Returns the state saved by the previous run in statefile, or None if
+    there is no usable state: no (readable) state file or the previous
+    run (as recorded in cmip5datafinder.param) used different options
+    """
+    if previous_command is None or not os.path.exists(statefile):
+        return None
+    if run_options(previous_command) != run_options(command_line):
+        return None
+    try:
+        with open(statefile, 'r') as sf:
+            state = json.load(sf)
+    except ValueError:
+        return None
+    if 'items' not in state:
+        return None
+    return state
+
+def save_incremental_state(statefile, state):
+    cache_io.write_lines(statefile, [json.dumps(state)])
 
 # ---- cache local data
 #def write_cache_direct(params_file,ldir,rdir,outfile,outfile2,errfile,ld,verbose=False):
-def write_cache_direct(params_file, rootp, outfile, outfile2, errfile, drs, verbose=False):
+def write_cache_direct(itemlist, rootp, outfile, outfile2, errfile, drs, verbose=False, jobs=1, state=None, sources=None,
+                       manifest_index=None, verify_manifest=False):
 
     """
     Function that does direct parsing of available datasource files and establishes
     the paths to the needed files; makes use of find_local_files()
+    itemlist: the params file rows (lists of fields), without duplicates
     File versioning is controlled by finding the ld = e.g. /latest/ dir 
     in the badc datasource, this may differ on other clusters and should be correctly
     hardcoded in the code!
+    jobs: number of threads resolving params file rows at the same time;
+    the lookups are latency bound so threads are enough. Results are
+    written in params file order so the cache files are the same as
+    for a serial (jobs=1) run.
+    state: --incremental state (see load_incremental_state), or None.
+    Rows looked up by the previous run whose directories have the same
+    mtimes as then are not looked up again, their cache and missing
+    lines are taken from state; state['items'] is updated in place to
+    hold exactly the rows of this params file.
+    sources: list of (root path, DRS) of all the datasources to look up
+    at once, in priority order (see resolve_federated_item); None means
+    the single datasource rootp, drs.
+    manifest_index: dictionary filedescriptor -> manifest entries
+    (--use-manifest); rows are then resolved to exactly those files
+    instead of being looked up on the datasources.
 
     """
-    car = np.genfromtxt(params_file, dtype=str, delimiter='\n')
-    # ---- eliminate duplicates from input file, if any
-    nar = np.unique(car)
-    prfile = 'prepended_' + params_file
-    if len(nar) == 1:
-        with open(prfile, 'a') as file:
-            file.write(nar)
-            file.write('\n')
-            file.write(nar)
-    else:
-        st(prfile,nar,fmt='%s')
-    itemlist = lt(prfile,dtype=str)
     lenitemlist = len(itemlist)
-    for item in itemlist:
-
-        # new functionality using data_finder module
-        # build the model dictionary
-        # in file: CMIP5 MPI-ESM-LR Amon historical r1i1p1 1980 2005 pr
-        # model dictionary: {name: MPI-ESM-LR, project: CMIP5,  mip: Amon,  exp: historical,  ensemble: r1i1p1,  start_year: 2000,  end_year: 2002} 
-        model = {}
-        model['project'] = item[0]
-        model['name'] = item[1]
-        model['mip'] = item[2]
-        model['exp'] = item[3]
-        model['ensemble'] = item[4]
-        model['start_year'] = item[5]
-        model['end_year'] = item[6]
-
-        # build the var variable
-        var = {}
-        var['name'] = item[7]
-        var['mip'] = item[2]
-        var['exp'] = item[3]
-        var['ensemble'] = item[4]
-
-        arname = df.get_input_filelist(rootp, model, var, drs)
-
-        # still keep all the infrastructure
-        if len(arname) > 0:
-            # var = item[7]
-            header = item[0] + '_'+ item[1] + '_' + item[2]\
-                         + '_' + item[3] + '_' + item[4] + '_' + item[5]\
-                         + '_' + item[6] + '_' + item[7]
-            yr1 = int(item[5])
-            yr2 = int(item[6])
-            for s in arname:
-                ssp = s.split('/')
-                av = ssp[-1]
-                time_range = av.split('_')[-1].strip('.nc')
-                time1 = time_range.split('-')[0]
-                time2 = time_range.split('-')[1]
-                year1 = date_handling(time1,time2)[0]
-                year2 = date_handling(time1,time2)[1]
-                # case where the required data completely overlaps
-                # available data
-                # this case stops the code to make a call to synda for this filedescriptor
-                if time_handling(year1, yr1, year2, yr2)[0] is True and time_handling(year1, yr1, year2, yr2)[1] is True:
-                    if os.path.exists(s):
-                        with open(outfile, 'a') as file:
-                            file.write(header + ' ' + s + '\n')
-                        if verbose is True:
-                            print('Cached file from local datasource: ' + s)
-                    else:
-                        with open(outfile2, 'a') as file:
-                            file.write(header + ' ERROR-MISSING' + '\n')
-                        if verbose is True:
-                            print('WARNING: missing from local datasource: ' +  header)
-                # case where the required data is not fully found
-                # ie incomplete data 
-                # what we want to do here is cache what we have available
-                # but also let synda know there is missing data, maybe
-                # she can find it...just maybe
-                # also we must make sure she doesnt download what we already have
-                if time_handling(year1, yr1, year2, yr2)[0] is True and time_handling(year1, yr1, year2, yr2)[1] is False:
-                    if os.path.exists(s):
-                        with open(outfile, 'a') as file:
-                            file.write(header + ' ' + s + '\n')
-                        if verbose is True:
-                            print('Cached file from local datasource: ' + s)
-                        sfn = s.split('/')[-1]
-                        with open(outfile2, 'a') as file:
-                            # the INCOMPLETE indicator will be used
-                            # to label partially complete filedescriptors so synda can
-                            # look for the missing bits and hopefully complete it
-                            file.write(header + ' INCOMPLETE ' + sfn + '\n')
-                    else:
-                        with open(outfile2, 'a') as file:
-                            file.write(header + ' ERROR-MISSING' + '\n')
-                        if verbose is True:
-                            print('WARNING: missing from local datasource: ' +  header)
-        else:
-            with open(outfile2, 'a') as file:
-                # missing entirely
-                file.write("_".join(item) + ' ERROR-MISSING' + '\n')
+    if sources is None or len(sources) == 1:
+        sources = [(rootp, drs)]
+    if manifest_index is not None:
+        src_pool = None
+        resolve_item = lambda item: manifest.resolve_manifest_item(item, manifest_index, verify_manifest)
+    elif len(sources) == 1:
+        src_pool = None
+        resolve_item = lambda item: resolve_local_item(item, rootp, drs)
+    else:
+        # one thread per datasource for each row being looked up
+        src_pool = ThreadPool(jobs * len(sources))
+        resolve_item = lambda item: resolve_federated_item(item, sources, src_pool)
+    if state is not None:
+        previous = state['items']
+        mtimes = {}
+        looked_up = []
+        def resolve(item):
+            key = ' '.join(item)
+            old = previous.get(key)
+            if old is not None and old['dirs'] is not None and \
+               all(dir_mtime(dn, mtimes) == mt for dn, mt in old['dirs']):
+                return old['cached'], old['missing'], []
+            cached, missing, messages = resolve_item(item)
+            looked_up.append(item)
+            dirs = []
+            for source in sources:
+                sdirs = local_item_dirs(item, source[0], source[1], [c.split()[1] for c in cached])
+                if sdirs is None:
+                    dirs = None
+                    break
+                dirs.extend((dn, dir_mtime(dn, mtimes)) for dn in sdirs)
+            state['items'][key] = {'cached': cached, 'missing': missing, 'dirs': dirs}
+            return cached, missing, messages
+        # rows no longer in the params file are dropped
+        keys = set(' '.join(item) for item in itemlist)
+        state['items'] = dict((k, v) for k, v in previous.items() if k in keys)
+    else:
+        resolve = resolve_item
+    if jobs > 1:
+        pool = ThreadPool(jobs)
+        # imap keeps the input order
+        results = pool.imap(resolve, itemlist)
+    else:
+        pool = None
+        results = (resolve(item) for item in itemlist)
+    # both cache files stay open for the whole pass
+    # and only replace the old ones once all rows are done
+    with cache_io.CacheWriter(outfile) as cw, cache_io.CacheWriter(outfile2) as mw:
+        for cached, missing, messages in results:
+            cw.writelines(cached)
+            mw.writelines(missing)
             if verbose is True:
-                print('WARNING: missing from local datasource: ' + "_".join(item))
+                for message in messages:
+                    print(message)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if src_pool is not None:
+        src_pool.close()
+        src_pool.join()
+    if state is not None:
+        print('Incremental run: looked up %i of %i filedescriptors again' % (len(looked_up), lenitemlist))
     if os.path.exists(outfile):
         fix_duplicate_entries(outfile)
     else:
@@ -369,33 +638,25 @@ def write_cache_direct(params_file, rootp, outfile, outfile2, errfile, drs, verb
     else:
         print >> sys.stderr, "Cached all needed data from local datasource. Looks like there are no missing files, huzzah!"
 
+# ---- number of entries in a cache file
+def count_lines(infile):
+    with open(infile, 'r') as f:
+        return sum(1 for line in f if line.strip())
+
 # ---- print some stats
 def print_stats(outfile1,outfile2):
     """
     small function to print some stats at the end
     """
     if os.path.exists(outfile1) and os.path.exists(outfile2):
-        ar1 = np.genfromtxt(outfile1, dtype=str,delimiter='\n')
-        ar2 = np.genfromtxt(outfile2, dtype=str,delimiter='\n')
-        # force to a 1-liner
-        if ar1.ndim == 0:
-            f = 1
-        else:
-            f = len(ar1)
-        if ar2.ndim == 0:
-            m = 1
-        else:
-            m = len(ar2)
+        f = count_lines(outfile1)
+        m = count_lines(outfile2)
         print('\n###############################################################')
         print('  Found and cached: %i individual .nc files cached' % f)
         print('Missing/incomplete: %i individual datasets NOT cached/incomplete' % m)
         print('#################################################################\n')
     elif os.path.exists(outfile1) and os.path.exists(outfile2) is False:
-        ar1 = np.genfromtxt(outfile1, dtype=str,delimiter='\n')
-        if ar1.ndim == 0:
-            f = 1
-        else:
-            f = len(ar1)
+        f = count_lines(outfile1)
         print('\n########################################################')
         print('Found and cached: %i individual .nc files cached' % f)
         print('########################################################\n')
@@ -403,7 +664,7 @@ def print_stats(outfile1,outfile2):
         print('Shoot! No cache written this time around...') 
 
 # ---- synda download
-def synda_dll(searchoutput,varname,year1_model,year2_model,header,D,outfile,outfile2,download=False,dryrunOn=False,verbose=False):
+def synda_dll(searchoutput,varname,year1_model,year2_model,header,D,outfile,outfile2,download=False,dryrunOn=False,verbose=False,pending=None):
     """
     This function takes the standard search output from synda
     and parses it to see if/what files need to be downloaded
@@ -419,96 +680,157 @@ def synda_dll(searchoutput,varname,year1_model,year2_model,header,D,outfile,outf
     be downloaded via synda install. It also takes the year1_model and year2_model, for time checks.
     It also takes the variable name and the name of a cache file outfile that will be written to disk. 
     dryrunOn is the switch from a physical download to just polling the esgf node without any download.
+    Entries of another model or outside the needed period are skipped (the
+    rest of the listing is still processed); returns the number of entries
+    that were used, 0 meaning synda has nothing for this filedescriptor.
 
     varname: variable
     D: incomplete filedescriptors: the dictionary that contains the files that are already available locally
     year1_model, year2_model: needed filedescriptor year1 and 2
     header: unique filedescriptor indicator e.g. CMIP5_CNRM-CM5_Amon_historical_r1i1p1_2003_2010_hus
-    outfile: cache file
-    outfile2: missing cache file
+    outfile: cache file writer (cache_io.CacheWriter)
+    outfile2: missing cache file writer (cache_io.CacheWriter)
     download: download (either dryrun or for reals) flag 
+    pending: if a list is passed, files to download are not installed
+    one by one here but appended as (dataset, file_name, cache line) so the
+    caller can install them in one synda call per dataset (see synda_pipeline)
     
     """
     # this is needed mostly for parallel processes that may
     # go tits-up from time to time due to random path mixes
-    if which_synda('synda') is not None:
+    if which_synda(SYNDA) is not None:
         pass
     else:
         print >> sys.stderr, "No synda executable found in path. Exiting."
         sys.exit(1)
     entries = searchoutput.split('\n')[:-1]
-    if len(entries) > 0:
-        for entry in entries:
-            label=str(entry.split()[0])
-            file_name = entry.split()[3]
-            if header.split('_')[1] == file_name.split('.')[3]:
-                time_range = file_name.split('_')[-1].strip('.nc')
-                time1 = time_range.split('-')[0]
-                time2 = time_range.split('-')[1]
-                year1 = date_handling(time1,time2)[0]
-                year2 = date_handling(time1,time2)[1]
-                if time_handling(year1, year1_model, year2, year2_model)[0] is True:
-                    if label=='done':
-                        file_name_complete = ".".join(file_name.split('.')[:10]) + '.' + varname + '.' + ".".join(file_name.split('.')[10:])
-                        filepath_complete = '/sdt/data/c' + file_name_complete.replace('.','/').strip('/nc') + '.nc'
-                        fn = filepath_complete.split('/')[-1]
-                        # synda should not cache files in dictionary D
-                        # these belong to incomplete filedescriptors but are already on disk
-                        if fn not in D[header]:
-                            with open(outfile, 'a') as file:
-                                file.write(header + ' ' + filepath_complete + ' ' + 'INSTALLED' + '\n')
-                            if verbose is True:
-                                print('File exists in local /sdt/data, path: ' + filepath_complete)
-                                # no download #
-                    elif label=='new':
-                        if download is True:
-                            file_name_new = ".".join(file_name.split('.')[:10]) + '.' + varname + '.' + ".".join(file_name.split('.')[10:])
-                            filepath_new = '/sdt/data/c' + file_name_new.replace('.','/').strip('/nc') + '.nc'
-                            fn = filepath_new.split('/')[-1]
-                            # synda should not download files in dictionary D
-                            # these belong to incomplete filedescriptors but are already on disk
-                            if fn not in D[header]:
-                                if dryrunOn is True:
-                                    if verbose is True:
-                                        print('Needed file %s doesnt exist in local /sdt/data but is on ESGF nodes, enable download to get it' % file_name)
-                                        print('Download enabled in dryrun mode...')
-                                        print('Synda found file: ' + file_name)
-                                        print('If installed, full path would be: ' + filepath_new)
-                                    with open(outfile, 'a') as file:
-                                        file.write(header + ' ' + filepath_new + ' ' + 'NOT-YET-INSTALLED' + '\n')
-                                        # no download, dryrun only #
-                                else:
-                                    synda_install = which_synda('synda') +  ' install ' + file_name
-                                    proc = subprocess.Popen(synda_install, stdout=subprocess.PIPE, stdin=subprocess.PIPE, shell=True)
-                                    dll ='\n'
-                                    (out, err) = proc.communicate(input=dll)
-                                    if err is not None:
-                                        print >> sys.stderr, "An error has occured while starting the download:"
-                                        print >> sys.stderr, err
-                                        sys.exit(1)
-                                    else:
-                                        with open(outfile, 'a') as file:
-                                            file.write(header + ' ' + filepath_new + ' ' + 'INSTALLED' + '\n')
-                                    if verbose is True:
-                                        print('Needed file %s doesnt exist in local /sdt/data but is on ESGF nodes' % file_name)
-                                        print('Download enabled in full install mode...')
-                                        print('Downloading file: ' + file_name)
-                                        print('Full path: ' + filepath_new)
-                                        # yes download #
-                else:
-                    if verbose is True:
-                        print('WARNING: synda - not cached due to requested period mismatch: ' + header + ' ' + file_name)
-                    return 0
-            else:
-                if verbose is True:
-                    print('WARNING: synda - not cached due to model mismatch: ' + header + ' ' + file_name)
-                return 0
-    else:
+    if len(entries) == 0:
         if verbose is True:
             print('WARNING: synda - missing data altogether: ' + header)
         return 0
-    if os.path.exists(outfile):
-        fix_duplicate_entries(outfile)
+    import numpy as np
+    file_names = [entry.split()[3] for entry in entries]
+    # single vectorised pass over the whole listing: only the entries
+    # of the right model that overlap the needed period are looked at
+    years1, years2 = file_dates.parse_years_array(file_names)
+    models = np.array([f.split('.')[3] if f.count('.') > 3 else '' for f in file_names])
+    right_model = models == header.split('_')[1]
+    in_period = (years1 >= 0) & (years2 >= int(year1_model)) & (years1 <= int(year2_model))
+    if verbose is True:
+        for i in np.flatnonzero(~right_model):
+            print('WARNING: synda - not cached due to model mismatch: ' + header + ' ' + file_names[i])
+        for i in np.flatnonzero(right_model & (years1 < 0)):
+            print('File: _date1-date2.nc not properly formatted...skipping it: ' + file_names[i])
+        for i in np.flatnonzero(right_model & (years1 >= 0) & ~in_period):
+            print('WARNING: synda - not cached due to requested period mismatch: ' + header + ' ' + file_names[i])
+    selected = np.flatnonzero(right_model & in_period)
+    if len(selected) == 0 and verbose is True:
+        print('WARNING: synda - no data for the requested period: ' + header)
+    for i in selected:
+        label = str(entries[i].split()[0])
+        file_name = file_names[i]
+        if label=='done':
+            file_name_complete = ".".join(file_name.split('.')[:10]) + '.' + varname + '.' + ".".join(file_name.split('.')[10:])
+            filepath_complete = '/sdt/data/c' + file_name_complete.replace('.','/').strip('/nc') + '.nc'
+            fn = filepath_complete.split('/')[-1]
+            # synda should not cache files in dictionary D
+            # these belong to incomplete filedescriptors but are already on disk
+            if fn not in D[header]:
+                outfile.write(header + ' ' + filepath_complete + ' ' + 'INSTALLED' + '\n')
+                if verbose is True:
+                    print('File exists in local /sdt/data, path: ' + filepath_complete)
+                    # no download #
+        elif label=='new':
+            if download is True:
+                file_name_new = ".".join(file_name.split('.')[:10]) + '.' + varname + '.' + ".".join(file_name.split('.')[10:])
+                filepath_new = '/sdt/data/c' + file_name_new.replace('.','/').strip('/nc') + '.nc'
+                fn = filepath_new.split('/')[-1]
+                # synda should not download files in dictionary D
+                # these belong to incomplete filedescriptors but are already on disk
+                if fn not in D[header]:
+                    if dryrunOn is True:
+                        if verbose is True:
+                            print('Needed file %s doesnt exist in local /sdt/data but is on ESGF nodes, enable download to get it' % file_name)
+                            print('Download enabled in dryrun mode...')
+                            print('Synda found file: ' + file_name)
+                            print('If installed, full path would be: ' + filepath_new)
+                        outfile.write(header + ' ' + filepath_new + ' ' + 'NOT-YET-INSTALLED' + '\n')
+                        # no download, dryrun only #
+                    elif pending is not None:
+                        # installed later, one synda install per dataset
+                        dataset = ".".join(file_name.split('.')[:10])
+                        pending.append((dataset, file_name, header + ' ' + filepath_new + ' ' + 'INSTALLED' + '\n'))
+                        if verbose is True:
+                            print('Needed file %s doesnt exist in local /sdt/data but is on ESGF nodes' % file_name)
+                            print('Download enabled in full install mode...')
+                            print('Queued for download: ' + file_name)
+                            print('Full path: ' + filepath_new)
+                    else:
+                        synda_install([file_name])
+                        outfile.write(header + ' ' + filepath_new + ' ' + 'INSTALLED' + '\n')
+                        if verbose is True:
+                            print('Needed file %s doesnt exist in local /sdt/data but is on ESGF nodes' % file_name)
+                            print('Download enabled in full install mode...')
+                            print('Downloading file: ' + file_name)
+                            print('Full path: ' + filepath_new)
+                            # yes download #
+    return len(selected)
+
+# ---- concurrent synda search and install
+def synda_pipeline(headers,D,outfile,outfile2,jobs=1,download=False,dryrunOn=False,verbose=False):
+    """
+    Function that runs the synda part for a list of filedescriptors:
+    up to jobs synda search processes run at the same time and each
+    search output is parsed by synda_dll as soon as it arrives, so the
+    synda cache file fills up while the other searches are still running.
+    Files that need downloading are collected and installed with a
+    single synda install per dataset once all searches are done.
+
+    headers: filedescriptors e.g. CMIP5_CNRM-CM5_Amon_historical_r1i1p1_2003_2010_hus
+    D: incomplete filedescriptors dictionary (see synda_dll)
+    outfile: synda cache file
+    outfile2: synda missing cache file
+    """
+    if which_synda(SYNDA) is None:
+        print >> sys.stderr, "No synda executable found in path. Exiting."
+        sys.exit(1)
+    # each filedescriptor is searched once only
+    seen = set()
+    headers = [h for h in headers if not (h in seen or seen.add(h))]
+    def search(header):
+        ite = header.split('_')
+        model_data = ' '.join(ite[0:5])
+        return (header,) + synda_search_output(model_data, ite[7])
+    pool = ThreadPool(max(jobs, 1))
+    pending = []
+    # both cache files stay open for the whole pipeline
+    # and only replace the old ones once it completes
+    with cache_io.CacheWriter(outfile) as cw, cache_io.CacheWriter(outfile2) as mw:
+        for header, outpt, err, returncode in pool.imap_unordered(search, headers):
+            if returncode != 0:
+                pool.terminate()
+                print >> sys.stderr, "An error has occured while searching for data:"
+                print >> sys.stderr, err
+                sys.exit(1)
+            ite = header.split('_')
+            s = synda_dll(outpt,ite[7],int(ite[5]),int(ite[6]),header,D,cw,mw,
+                          download=download,dryrunOn=dryrunOn,verbose=verbose,pending=pending)
+            if s == 0:
+                mw.write(header + ' ' + 'ERROR-MISSING' + '\n')
+        pool.close()
+        pool.join()
+        cw.flush()
+        mw.flush()
+        # one synda install per dataset
+        datasets = {}
+        for dataset, file_name, line in pending:
+            datasets.setdefault(dataset, []).append((file_name, line))
+        for dataset in sorted(datasets):
+            if verbose is True:
+                print('Downloading %i file(s) of dataset %s' % (len(datasets[dataset]), dataset))
+            synda_install([f for f, l in datasets[dataset]])
+            cw.writelines([l for f, l in datasets[dataset]])
+            cw.flush()
 
 def cache_merge(file1,file2,finalFile):
     """
@@ -516,25 +838,27 @@ def cache_merge(file1,file2,finalFile):
     into a single one. Caution -- note the order:
     file1 = local datasource cache
     file2 = local synda cache
+    Entries are keyed by filedescriptor and file basename: a synda
+    file is only added if the local datasource does not already have
+    a file with the same name for that filedescriptor. Both files are
+    read once and the merged cache is written in a single pass,
+    local entries first, each in their original order, no duplicates.
     """
-    f1 = open(file1, 'r')
-    f2 = open(file2, 'r')
-    ff = open(finalFile, 'w')
-    r1 = f1.readlines()
-    r2 = f2.readlines()
-    for b in r2:
-        for a in r1:
-            if a.split()[1].split('/')[-1] == b.split()[1].split('/')[-1]:
-                ff.write(a.split()[0] + ' ' + a.split()[1] + '\n')
-            else:
-                ff.write(a.split()[0] + ' ' + a.split()[1] + '\n')
-                ff.write(b.split()[0] + ' ' + b.split()[1] + '\n')
-    ff.close()
-    if os.path.exists(finalFile):
-        fix_duplicate_entries(finalFile)                
-    
+    seen = set()
+    with cache_io.CacheWriter(finalFile, append=False, create=True) as ff:
+        for cfile in (file1, file2):
+            with open(cfile, 'r') as f:
+                for line in f:
+                    entry = line.split()
+                    if len(entry) < 2:
+                        continue
+                    key = (entry[0], entry[1].split('/')[-1])
+                    if key not in seen:
+                        seen.add(key)
+                        ff.write(entry[0] + ' ' + entry[1] + '\n')
+
 # ---- final user-friendly cache generator
-def final_cache(parfile,ofile1,finalfile):
+def final_cache(itemlist,ofile1,finalfile,binfile=None):
     """
     Function that generates the final user-friendly
     single cache file; this can easily be used
@@ -542,145 +866,140 @@ def final_cache(parfile,ofile1,finalfile):
     Database | data_status | Percent complete | available_data
     ---------------------------------------------
     CMIP5_MIROC5_Amon_historical_r1i1p1_2003_2010_hus (complete,incomplete or missing) [file_list, if available]
+    The combined cache is read once and grouped by filedescriptor
+    (header -> [(time range, path), ...]) so each filedescriptor
+    is a dictionary lookup instead of a scan of the whole cache.
+    Coverage is computed at month resolution (see time_coverage.py);
+    incomplete(DATAGAPS) flags missing data between two files (there is
+    no complete(DATAGAPS): a filedescriptor with gaps is never complete)
+    binfile: if given, the same cache is also saved in columnar
+    (numpy .npz) form there, see cache_io.load_final_cache
+    itemlist: the params file rows (lists of fields); if ofile1 does
+    not exist they are all missing
+    Returns a dictionary filedescriptor -> time_coverage.Coverage and
+    the list of (filedescriptor, status, coverage, [files]) records
     """
-    pparfile = 'prepended_' + parfile
-    car = open(pparfile, 'r')
-    lis = car.readlines()
-    ff = open(finalfile, 'w')
+    coverages = {}
+    records = []
+    groups = {}
     if os.path.exists(ofile1):
-        of1 = open(ofile1, 'r')
-        ofl1 = of1.readlines()
-        o1 = [(a.split()[0],a.split()[1]) for a in ofl1]
-        for b in lis:
-            tt = []
-            hh = []
-            header = b.split()[0] + '_'+ b.split()[1] + '_' + b.split()[2]\
-                     + '_' + b.split()[3] + '_' + b.split()[4] + '_' + b.split()[5]\
-                     + '_' + b.split()[6] + '_' + b.split()[7]
-
-            for h in o1:
-                if header == h[0]:
-                    y = h[1].split('/')[-1].strip('.nc').split('_')[-1].split('-')
-                    # y could be some dodgy stuff if file not proper formatted
-                    if len(y) == 2: 
-                        yr1 = date_handling(y[0],y[1])[0]
-                        yr2 = date_handling(y[0],y[1])[1]
-                        tt.append(yr1)
-                        tt.append(yr2)
-                        hh.append(h[1])
-                    else:
-                        print('File: _date1-date2.nc not properly formatted...skipping it')
-            y1 = int(b.split()[5])
-            y2 = int(b.split()[6])
+        with open(ofile1, 'r') as of1:
+            for a in of1:
+                h = a.split()
+                if len(h) < 2:
+                    continue
+                tr = file_dates.parse_time_range(h[1])
+                # tr could be some dodgy stuff if file not proper formatted
+                if tr is not None:
+                    groups.setdefault(h[0], []).append((tr, h[1]))
+                else:
+                    print('File: _date1-date2.nc not properly formatted...skipping it')
+    with cache_io.CacheWriter(finalfile, append=False, create=True) as ff:
+        for item in itemlist:
+            if len(item) < 8:
+                continue
+            header = '_'.join(item[0:8])
+            files = groups.get(header, [])
+            hh = [path for tr, path in files]
+            y1 = int(item[5])
+            y2 = int(item[6])
             # let's see how we do with time
-            if len(tt) > 0:
-                if get_overlap(tt,y1,y2)[1] == 1:
+            if len(files) > 0:
+                cov = time_coverage.get_coverage([tr for tr, path in files], y1, y2)
+                coverages[header] = cov
+                if cov.is_complete():
+                    ff.write(header + ' complete 1.0 ' + str(hh) + '\n')
+                    records.append((header, 'complete', 1.0, hh))
+                elif len(cov.data_gaps) == 0:
                     # we have contiguous time
-                    if get_overlap(tt,y1,y2)[0] == 1:
-                        ff.write(header + ' complete 1.0 ' + str(hh) + '\n')
-                    else:
-                        fdt = get_overlap(tt,y1,y2)[0]
-                        ff.write(header + ' incomplete ' + '%.2f' % fdt + ' ' + str(hh) + '\n')
+                    ff.write(header + ' incomplete ' + '%.2f' % cov.fraction + ' ' + str(hh) + '\n')
+                    records.append((header, 'incomplete', cov.fraction, hh))
                 else:
                     # we have gaps
-                    if get_overlap(tt,y1,y2)[0] == 1:
-                        ff.write(header + ' complete(DATAGAPS) 1.0 ' + str(hh) + '\n')
-                    else:
-                        fdt = get_overlap(tt,y1,y2)[0]
-                        ff.write(header + ' incomplete(DATAGAPS) ' + '%.2f' % fdt + ' ' + str(hh) + '\n')
+                    ff.write(header + ' incomplete(DATAGAPS) ' + '%.2f' % cov.fraction + ' ' + str(hh) + '\n')
+                    records.append((header, 'incomplete(DATAGAPS)', cov.fraction, hh))
             else:
                 ff.write(header + ' missing' + '\n')
+                records.append((header, 'missing', 0.0, []))
+    if binfile is not None:
+        cache_io.save_final_cache(binfile, records)
+    return coverages, records
 
-#---- function that returns the amount of overlap
-# between needed data and available data
-def get_overlap(tt, my1, my2):
+# ---- final stats
+def final_stats(sfile, coverages=None):
     """
-    function that returns the amount of overlap
-    between needed data and available data
-    Returns a fractional float
-    li: list of years from data (1-dim, even number of elements)
-    my1,my2: required model years
+    Counts of the final cache sfile by status, as a dictionary
+    (this is what --stats-json writes); coverages: dictionary
+    filedescriptor -> time_coverage.Coverage as returned by
+    final_cache, to also count the months in gaps and the
+    filedescriptors with overlapping files
     """
-    nt = len(tt)
-    my = float(my2 - my1)
-    if nt == 2:
-        # single file, no gaps in data
-        if min(tt) >= my1 and max(tt) <= my2:
-            # completely inside
-            df = (max(tt) - min(tt))/my
-        elif min(tt) >= my1 and max(tt) >= my2:
-            # right plus
-            df = (my2 - min(tt))/my
-        elif min(tt) <= my1 and max(tt) <= my2:
-            # left plus
-            df = (max(tt) - my1)/my
-        elif my1 >= min(tt) and my2 <= max(tt):
-            df = 1
-        return df,1
-    else:
-        #multiple files, checking for gaps in data
-        b = max(tt) - min(tt)
-        el = [tt[i] - tt[i-1] for i in range(1,nt)]
-        if sum(el) == b:
-            # multiple files, no gaps in data
-            if min(tt) >= my1 and max(tt) <= my2:
-                # completely inside
-                df = (max(tt) - min(tt))/my
-            elif min(tt) >= my1 and max(tt) >= my2:
-                # right plus
-                df = (my2 - min(tt))/my
-            elif min(tt) <= my1 and max(tt) <= my2:
-                # left plus
-                df = (max(tt) - my1)/my
-            elif my1 >= min(tt) and my2 <= max(tt):
-                df = 1
-            return df,1
-        else:
-            # there are gaps!!
-            # but we dont deal with them here
-            df = 1
-            print('WARNING: there are gaps in data!')
-            print(tt)
-            return df,2
-
-        
-    #dtl = [tt[i] - tt[i-1] for i in range(1,nt)]
-    
-
-def print_final_stats(sfile):
+    counts = {}
+    prcc = []
+    with open(sfile, 'r') as ff:
+        for line in ff:
+            fields = line.split()
+            if len(fields) < 2:
+                continue
+            counts[fields[1]] = counts.get(fields[1], 0) + 1
+            # averaged over plain incomplete only, not incomplete(DATAGAPS)
+            if fields[1] == 'incomplete':
+                prcc.append(float(fields[2]))
+    stats = {'total': sum(counts.values()),
+             'complete': counts.get('complete', 0),
+             'incomplete': counts.get('incomplete', 0),
+             'missing': counts.get('missing', 0),
+             'incomplete_with_gaps': counts.get('incomplete(DATAGAPS)', 0),
+             'avg_incomplete_coverage': sum(prcc) / len(prcc) if prcc else None}
+    if coverages is not None:
+        gap_months = 0
+        overlap_dbs = 0
+        for cov in coverages.values():
+            gap_months += sum((g[1][0] - g[0][0]) * 12 + g[1][1] - g[0][1] + 1
+                              for g in cov.data_gaps)
+            if len(cov.overlaps) > 0:
+                overlap_dbs += 1
+        stats['gap_months'] = gap_months
+        stats['overlap_dbs'] = overlap_dbs
+    return stats
+
+def print_final_stats(sfile, coverages=None):
     """
     print some final stats
     To understand the output, by filedescriptor we mean any file indicator
     of form e.g. CMIP5_MIROC5_Amon_historical_r1i1p1_2003_2010_hus that is fully
     determined by its parameters; there could be multiple .nc files
     covering a single filedescriptor, alas there could be just one.
+    coverages: dictionary filedescriptor -> time_coverage.Coverage
+    as returned by final_cache, to report gaps and overlaps
+    Returns the stats, see final_stats
     """
-    ff = open(sfile, 'r')
-    lff = ff.readlines()
-    c = [a for a in lff if a.split()[1] == 'complete']
-    ic = [b for b in lff if b.split()[1] == 'incomplete']
-    mi = [d for d in lff if d.split()[1] == 'missing']
-    gc = [a for a in lff if a.split()[1] == 'complete(DATAGAPS)']
-    gic = [b for b in lff if b.split()[1] == 'incomplete(DATAGAPS)']
-    prcc = [float(a.split()[2]) for a in lff if a.split()[1] == 'incomplete']
+    stats = final_stats(sfile, coverages)
     print('---------------------------')
-    if len(gc) != 0 and len(gic) != 0:
+    if stats['incomplete_with_gaps'] != 0:
         print('============================')
         print('WARNING: THERE ARE DATA GAPS!')
         print('============================')
-    print('     Total needed filedescriptors: %i' % len(lff))
-    print('         Complete filedescriptors: %i' % len(c))
-    print('       Incomplete filedescriptors: %i' % len(ic))
-    print('          Missing filedescriptors: %i' % len(mi))
-    print('           Complete dbs with gaps: %i' % len(gc))
-    print('         Incomplete dbs with gaps: %i' % len(gic))
-    print('      Avg coverage for incomplete: %.2f' % np.mean(prcc))
+    print('     Total needed filedescriptors: %i' % stats['total'])
+    print('         Complete filedescriptors: %i' % stats['complete'])
+    print('       Incomplete filedescriptors: %i' % stats['incomplete'])
+    print('          Missing filedescriptors: %i' % stats['missing'])
+    print('         Incomplete dbs with gaps: %i' % stats['incomplete_with_gaps'])
+    if stats['avg_incomplete_coverage'] is None:
+        print('      Avg coverage for incomplete: nan')
+    else:
+        print('      Avg coverage for incomplete: %.2f' % stats['avg_incomplete_coverage'])
+    if coverages is not None:
+        print('           Months missing in gaps: %i' % stats['gap_months'])
+        print('       Dbs with overlapping files: %i' % stats['overlap_dbs'])
     print('---------------------------')
+    return stats
 
 # ---- plotting the filedescriptors in pie charts
 def plotter(cachefile,saveDir):
     """
-    simple pie chart plotting function
+    simple pie chart plotting function; matplotlib is only
+    imported here so runs with --no-plots never load it
     """
     # get matplotlib
     import matplotlib as mpl
@@ -699,11 +1018,12 @@ def plotter(cachefile,saveDir):
     # plot
     fig1, ax1 = plt.subplots()
     ax1.pie(sizes, explode=explode, labels=labels, autopct='%1.1f%%',
-            shadow=True, startangle=90)
+            startangle=90)
     ax1.axis('equal')  # Equal aspect ratio ensures that pie is drawn as a circle.
     plt.title('Overall data coverage')
     saveLoc = saveDir + '/overall.png'
     plt.savefig(saveLoc)
+    plt.close(fig1)
     # plot only missing
     c2 = [a.split()[0].split('_')[1] for a in lff if a.split()[1] == 'missing']
     c2s = list(set(c2))
@@ -717,6 +1037,7 @@ def plotter(cachefile,saveDir):
     plt.title('Missing data by model')
     saveLoc = saveDir + '/missing.png'
     plt.savefig(saveLoc)
+    plt.close(fig2)
     # plot only incomplete
     c2 = [a.split()[0].split('_')[1] for a in lff if a.split()[1] == 'incomplete']
     c2s = list(set(c2))
@@ -730,6 +1051,7 @@ def plotter(cachefile,saveDir):
     plt.title('Incomplete data by model')
     saveLoc = saveDir + '/incomplete.png'
     plt.savefig(saveLoc)
+    plt.close(fig3)
 
 # ---- synda check download
 def synda_check_dll():
@@ -738,8 +1060,8 @@ def synda_check_dll():
     """
     print('Your files(s) are being downloaded.')
     print('You can check the download progress with synda queue, see output below')
-    synda_queue = 'synda queue'
-    proc = subprocess.Popen(synda_queue, stdout=subprocess.PIPE, shell=True)
+    synda_queue = [which_synda(SYNDA), 'queue']
+    proc = subprocess.Popen(synda_queue, stdout=subprocess.PIPE)
     (out, err) = proc.communicate()
     print(out)
     statusreport = out.split('\n')
@@ -747,566 +1069,625 @@ def synda_check_dll():
         if len(entry)>0:
             if entry.split()[0] == 'waiting':
                 print('%i files are waiting, totalling %.2f MB disk' % (int(entry.split()[1]),float(entry.split()[2])))
-    synda_watch = 'synda watch'
-    proc = subprocess.Popen(synda_watch, stdout=subprocess.PIPE, shell=True)
+    synda_watch = [which_synda(SYNDA), 'watch']
+    proc = subprocess.Popen(synda_watch, stdout=subprocess.PIPE)
     (out, err) = proc.communicate()
     print(out)
 
-# -------------------------------------------------------------------------
-#      Parse the command line options.
-# -------------------------------------------------------------------------
-
-# ---- Initialise command line argument variables.
-params_file       = None
-userVars          = False
-db                = []
-syndacall         = False
-download          = False
-dryrunOn          = False
-fpars             = []
-vpars             = []
-verbose           = False
-
-# ---- Syntax of options, as required by getopt command.
-# ---- Short form.
-shortop = "hp:g:r:d:i:n:t:f:m:sc:e:"
-# ---- Long form.
-longop = [
-   "help",
-   "params-file=",
-   "user-input",
-   "datasource=",
-   "synda",
-   "download",
-   "dryrun",
-   "fileparams=",
-   "uservars=",
-   "verbose"
-]
-
-# ---- Get command-line arguments.
-try:
-  opts, args = getopt.getopt(sys.argv[1:], shortop, longop)
-except getopt.GetoptError:
-  usage()
-  sys.exit(1)
-
-# ---- We will record the command line arguments to cmip5datafinder.py in a file called
-#      cmip5datafinder.param. This file should be used if a further need to run the code arises
-command_string = 'cmip5datafinder.py '
-
-# ---- Parse command-line arguments.  Arguments are returned as strings, so
-#      convert type as necessary.
-for o, a in opts:
-    if o in ("-h", "--help"):
-        usage()
-        sys.exit(0)
-    elif o in ("-p", "--params-file"):
-        params_file = a
-        command_string = command_string + ' -p ' + a
-    elif o in ("--user-input"):
-      userVars = True
-      command_string = command_string + ' --user-input '
-    elif o in ("--datasource"):
-        db.append(a)
-        command_string = command_string + ' --datasource ' + a
-    elif o in ("--synda"):
-      syndacall = True
-      command_string = command_string + ' --synda '
-    elif o in ("--download"):
-      download = True
-      command_string = command_string + ' --download '
-    elif o in ("--dryrun"):
-      dryrunOn = True
-      command_string = command_string + ' --dryrun '
-    elif o in ("--fileparams"):
-        fpars.append(a)
-        command_string = command_string + ' --fileparams ' + a
-    elif o in ("--uservars"):
-        vpars.append(a)
-        command_string = command_string + ' --uservars ' + a 
-    elif o in ("--verbose"):
-      verbose = True
-      command_string = command_string + ' --verbose '
+# ---- find the data of a list of filedescriptors
+def find_data(descriptors, datasources, synda=False, download=False, dryrun=False, federated=False,
+              jobs=1, verbose=False, name='find_data.txt', workdir='.', binary_cache=False,
+              plots=False, plots_dir=None, index_file=None, manifest_index=None,
+              verify_manifest=False, manifest_out=None, checksum_cache=None,
+              incremental=False, command_line=None, previous_command=None):
+    """
+    Importable entry point of the datafinder (the command line is a
+    thin wrapper around it) so the data of many filedescriptors can be
+    resolved in-process e.g. from ESMValTool:
+
+    import cmip5datafinder_v2 as finder
+    results = finder.find_data([['CMIP5', 'MPI-ESM-LR', 'Amon', 'historical',
+                                 'r1i1p1', '1980', '2005', 'tas']], ['badc'])
+    results['badc']['data']['CMIP5_MPI-ESM-LR_Amon_historical_r1i1p1_1980_2005_tas']
+    -> ('complete', 1.0, [list of paths])
+
+    descriptors: params file rows, as lists of fields or whitespace
+    separated strings e.g. CMIP5 MPI-ESM-LR Amon historical r1i1p1 1980 2005 tas
+    (duplicates are looked up once)
+    datasources: names of DATASOURCES, searched one after the other or,
+    if federated, all at once (see resolve_federated_item)
+    name: stands in for the params file name in the final cache name
+    cache_NAME-DATASOURCE; the final caches and the cache_files_DATASOURCE
+    directories are written in workdir
+    plots: draw the pie charts, in plots_dir (default: the
+    cache_files_DATASOURCE directory)
+    incremental: reuse the state of the previous run on the same workdir
+    if command_line and previous_command have the same options (see
+    load_incremental_state)
+    synda: also search (and, if download, get) the files not found
+    locally with synda; the executable used is SYNDA
+    all the other arguments are the command line options of the same names.
+    Returns a dictionary datasource (or 'federated') ->
+    {'data': {filedescriptor: (status, coverage, [files])},
+     'stats': final stats, see final_stats, and the time elapsed}
+    """
+    for d in datasources:
+        if d not in DATASOURCES:
+            raise ValueError('Unknown datasource %s, available datasources: %s'
+                             % (d, ', '.join(sorted(DATASOURCES))))
+    # ---- eliminate duplicates from input, if any
+    itemlist = set()
+    for item in descriptors:
+        if isinstance(item, basestring):
+            item = item.split()
+        itemlist.add(tuple(str(field) for field in item))
+    itemlist = [list(item) for item in sorted(itemlist)]
+    # ---- datasources are run one by one
+    # ---- or, if federated, all at once (in the order given)
+    if federated is True:
+        runs = [('federated', [DATASOURCES[d] for d in datasources])]
     else:
-        print >> sys.stderr, "Unknown option:", o
-        usage()
-        sys.exit(1)
+        runs = [(d, [DATASOURCES[d]]) for d in datasources]
+    results = {}
+    for d, sources in runs:
+        # we need to firstly remove any pre existent cache dirs
+        drb = os.path.join(workdir, 'cache_files_' + d)
+        statefile = drb + '/incremental_state.json'
+        state = None
+        if incremental is True:
+            state = load_incremental_state(statefile, previous_command, command_line)
+            if state is None:
+                print('No usable previous run found for %s, doing a full run...' % d)
+        if state is not None:
+            # all cache files are written again from the state,
+            # only the state itself is kept
+            print('Incremental run: reusing %s...' % drb)
+            for fname in os.listdir(drb):
+                if os.path.join(drb, fname) != statefile:
+                    os.remove(os.path.join(drb, fname))
+        else:
+            print('Removing all pre-existent cache directories...')
+            if os.path.isdir(drb):
+                shutil.rmtree(drb)
+            if incremental is True:
+                state = {'items': {}}
+        print('Polling %s datasource...' % d)
+        # ...then create new one, standard name cache_files_[SERVER] eg cache_files_badc
+        print('We will be writing all needed cache files to %s directory...' % drb)
+        if not os.path.isdir(drb):
+            os.makedirs(drb)
+        # place the cache files
+        pfile2 = drb + '/cache_cmip5_' + d + '.txt'
+        pfile3 = drb + '/missing_cache_cmip5_' + d + '.txt'
+        pfile4 = drb + '/cache_cmip5_synda_' + d + '.txt'
+        pfile5 = drb + '/missing_cache_cmip5_synda_' + d + '.txt'
+        compf = drb + '/cache_cmip5_combined_' + d + '.txt'
+        compm = drb + '/missing_cache_cmip5_combined_' + d + '.txt'
+        errorfile = drb + '/cache_err.out'
+        nm = os.path.join(workdir, 'cache_' + name + '-' + d)
+        if os.path.exists(nm):
+            os.remove(nm)
+        if binary_cache is True:
+            binfile = nm + '.npz'
+        else:
+            binfile = None
+        # ---- where the pie charts go, if anywhere
+        if plots is False:
+            plotdir = None
+        elif plots_dir:
+            plotdir = plots_dir
+            if len(runs) > 1:
+                plotdir = plots_dir + '/' + d
+            if not os.path.isdir(plotdir):
+                os.makedirs(plotdir)
+        else:
+            plotdir = drb
 
-# ---- Check that all required arguments are specified, else exit.
-if not params_file:
-    if not userVars:
-        print >> sys.stderr, "No parameter file specified and no user file definitions"
-        print >> sys.stderr, "Use --params-file to specify the parameter file or --user-vars followed"
-        print >> sys.stderr, "by command-line options for file parameters. Exiting."
-        sys.exit(1)
-    else:
-        print >> sys.stderr, "Using the user's specified file parameters"
-        if not fpars:
-            print >> sys.stderr, "You need to specify a number of file params e.g. CMIP5,MPI-ESM-LR,Amon,historical,r1i1p1,1910,1919"
-            print >> sys.stderr, "Use the --fileparams option for this"
-            sys.exit(1)
-        if not vpars:
-            print >> sys.stderr, "You need to specify a number of variables e.g. tro3"
-            print >> sys.stderr, "Use the --uservars option for this"
-            sys.exit(1)
-if params_file and userVars:
-    print >> sys.stderr, "Use --params-file to specify the parameter file OR --user-input followed"
-    print >> sys.stderr, "by command-line options for file and variables parameters. Can not use both options! Exiting."
-    sys.exit(1)
-if not db:
-    print >> sys.stderr, "No local datasource to search specified"
-    print >> sys.stderr, "Use --datasource to specify a valid datasource e.g. badc or dkrz. Exiting..."
-    sys.exit(1)
+        # ---- get root directory
+        if verbose is True:
+            for rootp, drs in sources:
+                print('Using %s (%s DRS) as local searchable datasource' % (rootp, drs))
+        rootp, drs = sources[0]
+
+        # ---- use (and refresh) the persistent DRS index, if any, one
+        # ---- file per datasource (federated: it indexes the first one)
+        dindex = None
+        if index_file:
+            if len(runs) == 1:
+                ifile = index_file
+            else:
+                ifile = index_file + '-' + d
+            print('Refreshing DRS index %s...' % ifile)
+            dindex = drs_index.DRSIndex(ifile, rootp, drs)
+            dindex.refresh(verbose)
+
+        # ---- start timer
+        t1 = time.time()
+
+        # ---- first poll the local datasource(s)
+        if verbose is True and synda is False:
+            print('\n-------------------------------------------------------------------------------------')
+            print('We have looked at existing files LOCALLY only: ')
+            print('Here is what we found:')
+            print('---------------------------------------------------------------------------------------')
+        # ---- the index is only queried here, and only for this datasource
+        df.use_drs_index(dindex)
+        try:
+            write_cache_direct(itemlist, rootp, pfile2, pfile3, errorfile, drs, verbose=verbose, jobs=jobs,
+                               state=state, sources=sources, manifest_index=manifest_index,
+                               verify_manifest=verify_manifest)
+        finally:
+            df.use_drs_index(None)
+            if dindex is not None:
+                dindex.close()
+        if os.path.exists(errorfile):
+            fix_duplicate_entries(errorfile)
+        print_stats(pfile2,pfile3)
+        # check for incomplete/missing filedescriptors
+        if synda is True and os.path.exists(pfile3):
+            ar = open(pfile3, 'r')
+            lls = [line for line in ar if line.split()[0].split('_')[0] == 'CMIP5']
+            ar.close()
+            lenitemlist = len(lls)
+            cat11 = [(p.split()[0],'dope') for p in lls if p.split()[1] == 'ERROR-MISSING']
+            cat21 = [(p.split()[0],p.split()[2]) for p in lls if p.split()[1] == 'INCOMPLETE']
+            # construct two dictionaries:
+            # A: contains all missing filedescriptors
+            # B: contains the incomplete filedescriptors
+            A = {}
+            B = {}
+            for item in cat21:
+                A.setdefault(item[0],[]).append(item[1])
+            for item in cat11:
+                B.setdefault(item[0],[]).append(item[1])
+            # convolve A and B so synda will download only the A's 'dope' (missing)
+            # and the bits from B that are not already on disk
+            Z = dict(A, **B)
+            if verbose is True:
+                print('\n-----------------------------------------------------------------------------------------------------')
+                print('We parsed a missing LOCAL data param file. We have missing/incomplete files for %i filedescriptors: ' % lenitemlist)
+                print('Calling SYNDA to look for data in /sdt/data or download what is not found...')
+                print('-------------------------------------------------------------------------------------------------------')
+            synda_pipeline([it.split()[0] for it in lls],Z,pfile4,pfile5,
+                           jobs=jobs,download=download,dryrunOn=dryrun,verbose=verbose)
+            if os.path.exists(pfile4):
+                fix_duplicate_entries(pfile4)
+            if os.path.exists(errorfile):
+                fix_duplicate_entries(errorfile)
+            print_stats(pfile4,pfile5)
+            # final cache merging and cleanup
+            if os.path.exists(pfile2) and os.path.exists(pfile4):
+                # create a composite file using caches from sever and synda
+                cache_merge(pfile2,pfile4,compf)
+            elif os.path.exists(pfile2):
+                # looks like synda didnt find anything extra
+                shutil.copy(pfile2, compf)
+            elif os.path.exists(pfile4):
+                # looks like there is nothing in local but synda found extra
+                shutil.copy(pfile4, compf)
+            # in case synda missed some filedescriptors
+            if os.path.exists(pfile5):
+                fix_duplicate_entries(pfile5)
+                shutil.copy(pfile5, compm)
+        else:
+            if synda is True:
+                # no need to call synda if we found all needed filedescriptors on server
+                print('Cached all needed data from local datasource %s' % d)
+            if os.path.exists(pfile2):
+                shutil.copy(pfile2, compf)
+            if os.path.exists(pfile3):
+                shutil.copy(pfile3, compm)
+        coverages, records = final_cache(itemlist,compf,nm,binfile)
+        stats = print_final_stats(nm, coverages)
+        if plotdir is not None:
+            plotter(nm,plotdir)
+
+        # ---- manifest of the files cached from this datasource
+        if manifest_out and os.path.exists(compf):
+            if len(runs) == 1:
+                mfile = manifest_out
+            else:
+                mfile = manifest_out + '-' + d
+            print('Writing manifest %s...' % mfile)
+            n = manifest.produce_manifest(compf, mfile, jobs, verbose=verbose,
+                                          checksum_cache=checksum_cache)
+            print('Checksummed %i files' % n)
+
+        # ---- what the next --incremental run starts from
+        if state is not None:
+            save_incremental_state(statefile, state)
+
+        # ---- timing
+        t2 = time.time()
+        dt = t2 - t1
+        if verbose is True:
+            print('=================================')
+            print('DONE! with datasource %s' % d)
+            print('Time elapsed: %.1f seconds' % dt)
+            print('=================================')
+        print('Time elapsed: %.1f s' % dt)
+        stats['time_elapsed'] = dt
+        results[d] = {'data': dict((r[0], r[1:]) for r in records), 'stats': stats}
+    return results
 
 # -------------------------------------------------------------------------
-#      Status message.  Report all supplied arguments.
+#      Command line: a thin wrapper around find_data
 # -------------------------------------------------------------------------
+def main(argv=None):
+    """
+    Parses the command line (see usage), runs find_data on the
+    params file, user input or manifest rows and writes the
+    cmip5datafinder.param, stats and cache files
+    """
+    global SYNDA
+    if argv is None:
+        argv = sys.argv[1:]
+
+    # ---- Initialise command line argument variables.
+    params_file       = None
+    userVars          = False
+    db                = []
+    syndacall         = False
+    download          = False
+    dryrunOn          = False
+    fpars             = []
+    vpars             = []
+    verbose           = False
+    index_file        = None
+    jobs              = 1
+    binaryCache       = False
+    incremental       = False
+    federated         = False
+    manifest_out      = None
+    manifest_in       = None
+    verifyManifest    = False
+    checksum_file     = None
+    version_file      = None
+    version_ttl       = 86400
+    plotsOn           = True
+    plots_dir         = None
+    stats_file        = None
+
+    # ---- Syntax of options, as required by getopt command.
+    # ---- Short form.
+    shortop = "hp:g:r:d:i:n:t:f:m:sc:e:"
+    # ---- Long form.
+    longop = [
+       "help",
+       "params-file=",
+       "user-input",
+       "datasource=",
+       "synda",
+       "download",
+       "dryrun",
+       "fileparams=",
+       "uservars=",
+       "verbose",
+       "drs-index=",
+       "jobs=",
+       "synda-exec=",
+       "binary-cache",
+       "incremental",
+       "federated",
+       "produce-manifest=",
+       "use-manifest=",
+       "verify-manifest",
+       "checksum-cache=",
+       "version-cache=",
+       "version-cache-ttl=",
+       "no-plots",
+       "plots-dir=",
+       "stats-json="
+    ]
+
+    # ---- Get command-line arguments.
+    try:
+      opts, args = getopt.getopt(argv, shortop, longop)
+    except getopt.GetoptError:
+      usage()
+      sys.exit(1)
+
+    # ---- We will record the command line arguments to cmip5datafinder.py in a file called
+    #      cmip5datafinder.param. This file should be used if a further need to run the code arises
+    command_string = 'cmip5datafinder.py '
+
+    # ---- Parse command-line arguments.  Arguments are returned as strings, so
+    #      convert type as necessary.
+    for o, a in opts:
+        if o in ("-h", "--help"):
+            usage()
+            sys.exit(0)
+        elif o in ("-p", "--params-file"):
+            params_file = a
+            command_string = command_string + ' -p ' + a
+        elif o in ("--user-input"):
+          userVars = True
+          command_string = command_string + ' --user-input '
+        elif o in ("--datasource"):
+            db.append(a)
+            command_string = command_string + ' --datasource ' + a
+        elif o in ("--synda"):
+          syndacall = True
+          command_string = command_string + ' --synda '
+        elif o in ("--download"):
+          download = True
+          command_string = command_string + ' --download '
+        elif o in ("--dryrun"):
+          dryrunOn = True
+          command_string = command_string + ' --dryrun '
+        elif o in ("--fileparams"):
+            fpars.append(a)
+            command_string = command_string + ' --fileparams ' + a
+        elif o in ("--uservars"):
+            vpars.append(a)
+            command_string = command_string + ' --uservars ' + a 
+        elif o in ("--verbose"):
+          verbose = True
+          command_string = command_string + ' --verbose '
+        elif o in ("--drs-index"):
+            index_file = a
+            command_string = command_string + ' --drs-index ' + a
+        elif o in ("--jobs"):
+            jobs = int(a)
+            command_string = command_string + ' --jobs ' + a
+        elif o in ("--synda-exec"):
+            SYNDA = a
+            command_string = command_string + ' --synda-exec ' + a
+        elif o in ("--binary-cache"):
+          binaryCache = True
+          command_string = command_string + ' --binary-cache '
+        elif o in ("--incremental"):
+          incremental = True
+          command_string = command_string + ' --incremental '
+        elif o in ("--federated"):
+          federated = True
+          command_string = command_string + ' --federated '
+        elif o in ("--produce-manifest"):
+            manifest_out = a
+            command_string = command_string + ' --produce-manifest ' + a
+        elif o in ("--use-manifest"):
+            manifest_in = a
+            command_string = command_string + ' --use-manifest ' + a
+        elif o in ("--verify-manifest"):
+          verifyManifest = True
+          command_string = command_string + ' --verify-manifest '
+        elif o in ("--checksum-cache"):
+            checksum_file = a
+            command_string = command_string + ' --checksum-cache ' + a
+        elif o in ("--version-cache"):
+            version_file = a
+            command_string = command_string + ' --version-cache ' + a
+        elif o in ("--version-cache-ttl"):
+            version_ttl = float(a)
+            command_string = command_string + ' --version-cache-ttl ' + a
+        elif o in ("--no-plots"):
+          plotsOn = False
+          command_string = command_string + ' --no-plots '
+        elif o in ("--plots-dir"):
+            plots_dir = a
+            command_string = command_string + ' --plots-dir ' + a
+        elif o in ("--stats-json"):
+            stats_file = a
+            command_string = command_string + ' --stats-json ' + a
+        else:
+            print >> sys.stderr, "Unknown option:", o
+            usage()
+            sys.exit(1)
 
-if verbose is True:
-    intro = """\
-          This is a flexible tool to generate cache files from local datasources and ESGF nodes.
-          This makes use of synda for querying ESGF nodes as well.
-          For problems or queries, email valeriu.predoi@ncas.ac.uk. Have fun!
-          
-          Code functionality:
-          1. Given a command line set of arguments or an input file, the code looks for cmip5
-          files locally and returns the physical paths to the found files;
-          2. If files are not found, the user has the option to download missing files from ESGF
-          nodes via synda;
-          3. Finally, the code writes cache files:
-           - cache_cmip5_[SERVER].txt local cache file
-           - cache_cmip5_combined_[SERVER].txt combined cache file (synda+local)
-           - cache_cmip5_synda_[SERVER].txt synda cache file
-           - cache_err.out error out while caching
-           - missing_cache_cmip5_[SERVER].txt local missing files
-           - missing_cache_cmip5_combined_[SERVER].txt missing files (synda+local)
-           - missing_cache_cmip5_synda_[SERVER].txt synda missing files
-
-          Example run:
-          (with param file) python cmip5datafinder.py -p perfmetrics.txt --download --dryrun --verbose --datasource badc
-          (with command line args) python cmip5datafinder.py --user-input --fileparams CMIP5 --fileparams bcc-csm1-1 --fileparams --fileparams Amon
-          --fileparams historical --fileparams r1i1p1 --fileparams 1982 --fileparams 2014 --uservars clt --uservars tro3 --uservars pr --datasource badc
-          --verbose
-          """
-    print >> sys.stdout, intro
-    print >> sys.stdout
-    print >> sys.stdout, "####################################################"
-    print >> sys.stdout, "#                 CMIP5 Data Finder                #"
-    print >> sys.stdout, "####################################################"
-    print >> sys.stdout
-    print >> sys.stdout, "Parsed input arguments:"
-    print >> sys.stdout
-    if params_file:
-        print >> sys.stdout,"Running with parameters file:", params_file
-    else:
-        if len(fpars) < 7:
-            print >> sys.stderr, "Too few file parameters (CMIP5 needs exacly 7: e.g. CMIP5 MPI-ESM-LR Amon historical r1i1p1 1980 2005)"
+    # ---- a manifest stands in for the params file: one row per filedescriptor
+    manifest_index = None
+    if manifest_in:
+        if params_file or userVars:
+            print >> sys.stderr, "Use --use-manifest OR --params-file/--user-input, not both. Exiting."
+            sys.exit(1)
+        if not os.path.exists(manifest_in):
+            print >> sys.stderr, "Manifest file %s does not exist. Exiting." % manifest_in
+            sys.exit(1)
+        manifest_index = {}
+        for entry in manifest.read_manifest(manifest_in):
+            manifest_index.setdefault(entry[0], []).append(entry)
+        params_file = os.path.basename(manifest_in) + '.txt'
+
+    # ---- Check that all required arguments are specified, else exit.
+    if not params_file:
+        if not userVars:
+            print >> sys.stderr, "No parameter file specified and no user file definitions"
+            print >> sys.stderr, "Use --params-file to specify the parameter file or --user-vars followed"
+            print >> sys.stderr, "by command-line options for file parameters. Exiting."
             sys.exit(1)
         else:
-            print >> sys.stdout,"Running with user-defined file parameters and variables     "
-            print >> sys.stdout,"File      :", fpars[0]
-            print >> sys.stdout,"Experiment:", fpars[1]
-            print >> sys.stdout,"Medium    :", fpars[2]
-            print >> sys.stdout,"Type      :", fpars[3]
-            print >> sys.stdout,"Ensemble  :", fpars[4]
-            print >> sys.stdout,"Year1     :", fpars[5]
-            print >> sys.stdout,"Year2     :", fpars[6]
-            print >> sys.stdout,"Var(s)    :", vpars[0]
-    print >> sys.stdout
-
-# ---- if we are using synda
-# ---- Get the synda path or exit here
-if syndacall is True:
-    if verbose is True:
-        print('You are going to use SYNDA to download data...')
-        print('Looking up synda executable...')
-    if which_synda('synda') is not None:
-        print >> sys.stdout, "Synda found...OK" 
-        print >> sys.stdout, which_synda('synda')
-    else:
-        print >> sys.stderr, "No synda executable found in path. Exiting."
+            print >> sys.stderr, "Using the user's specified file parameters"
+            if not fpars:
+                print >> sys.stderr, "You need to specify a number of file params e.g. CMIP5,MPI-ESM-LR,Amon,historical,r1i1p1,1910,1919"
+                print >> sys.stderr, "Use the --fileparams option for this"
+                sys.exit(1)
+            if not vpars:
+                print >> sys.stderr, "You need to specify a number of variables e.g. tro3"
+                print >> sys.stderr, "Use the --uservars option for this"
+                sys.exit(1)
+    if params_file and userVars:
+        print >> sys.stderr, "Use --params-file to specify the parameter file OR --user-input followed"
+        print >> sys.stderr, "by command-line options for file and variables parameters. Can not use both options! Exiting."
+        sys.exit(1)
+    if not db:
+        print >> sys.stderr, "No local datasource to search specified"
+        print >> sys.stderr, "Use --datasource to specify a valid datasource e.g. badc or dkrz. Exiting..."
         sys.exit(1)
+    for d in db:
+        if d not in DATASOURCES:
+            print >> sys.stderr, "Unknown datasource %s, available datasources: %s. Exiting..." % (d, ', '.join(sorted(DATASOURCES)))
+            sys.exit(1)
 
-    if verbose is True:
-        # ---- Have us some information from the synda configuration file
-        # ---- one can add more info if needed, currently just data server
-        print('\n---------------------------------------------')
-        print('Information about synda configuration:')
-        print('---------------------------------------------')
-        synda_conf_file = which_synda('synda').rsplit('/',2)[0] + '/conf/sdt.conf'
-        print ('Synda conf file %s' % synda_conf_file)
-        with open(synda_conf_file, 'r') as file:
-            for line in file:
-                if line.split('=')[0]=='indexes':
-                    data_server = line.split('=')[1]
-                    print('ESGF data node: %s' % data_server.split()[0])
-
-# ---- Write ASCII file holding cache_BADC.py command.
-pfile = open('cmip5datafinder.param','w')
-pfile.write(command_string + "\n")
-pfile.close()
-
-# ---- Write cache files ---- #
-# ---- hardcoded names so we standardize analyses
-# ---- start overall timing
-t10 = time.time()
-# ---- db is a list and we run on each called datasource
-for d in db:
-    # we need to firstly remove any pre existent cache dirs
-    drb = 'cache_files_' + d
-    print('Removing all pre-existent cache directories...')
-    if os.path.isdir(drb):
-        rrc = 'rm -r ' + drb
-        proc = subprocess.Popen(rrc, stdout=subprocess.PIPE, shell=True)
-        (out, err) = proc.communicate()
-    print('Polling %s datasource...' % d)
-    # ...then create new one, standard name cache_files_[SERVER] eg cache_files_badc
-    print('We will be writing all needed cache files to %s directory...' % drb)
-    mkc = 'mkdir -p ' + drb
-    proc = subprocess.Popen(mkc, stdout=subprocess.PIPE, shell=True)
-    (out, err) = proc.communicate()
-    # place the cache files
-    pfile2 = drb + '/cache_cmip5_' + d + '.txt'
-    pfile3 = drb + '/missing_cache_cmip5_' + d + '.txt'
-    if syndacall is True:
-        pfile4 = drb + '/cache_cmip5_synda_' + d + '.txt'
-        pfile5 = drb + '/missing_cache_cmip5_synda_' + d + '.txt'
-    errorfile = drb + '/cache_err.out'
-    if params_file:
-        nm = 'cache_' + params_file + '-' + d
-        if os.path.exists(nm):
-            os.remove(nm)
-    else:
-        nm = 'cache_user.txt-' + d
-        if os.path.exists(nm):
-            os.remove(nm)
+    # -------------------------------------------------------------------------
+    #      Status message.  Report all supplied arguments.
+    # -------------------------------------------------------------------------
 
-    # ---- get root directory
     if verbose is True:
-        print('Using %s as local searchable datasource' % d)
-    if d == 'badc':
-        rootp = '/badc/cmip5/data/cmip5/output1'
-        drs = 'BADC'
+        intro = """\
+              This is a flexible tool to generate cache files from local datasources and ESGF nodes.
+              This makes use of synda for querying ESGF nodes as well.
+              For problems or queries, email valeriu.predoi@ncas.ac.uk. Have fun!
+
+              Code functionality:
+              1. Given a command line set of arguments or an input file, the code looks for cmip5
+              files locally and returns the physical paths to the found files;
+              2. If files are not found, the user has the option to download missing files from ESGF
+              nodes via synda;
+              3. Finally, the code writes cache files:
+               - cache_cmip5_[SERVER].txt local cache file
+               - cache_cmip5_combined_[SERVER].txt combined cache file (synda+local)
+               - cache_cmip5_synda_[SERVER].txt synda cache file
+               - cache_err.out error out while caching
+               - missing_cache_cmip5_[SERVER].txt local missing files
+               - missing_cache_cmip5_combined_[SERVER].txt missing files (synda+local)
+               - missing_cache_cmip5_synda_[SERVER].txt synda missing files
+
+              Example run:
+              (with param file) python cmip5datafinder.py -p perfmetrics.txt --download --dryrun --verbose --datasource badc
+              (with command line args) python cmip5datafinder.py --user-input --fileparams CMIP5 --fileparams bcc-csm1-1 --fileparams --fileparams Amon
+              --fileparams historical --fileparams r1i1p1 --fileparams 1982 --fileparams 2014 --uservars clt --uservars tro3 --uservars pr --datasource badc
+              --verbose
+              """
+        print >> sys.stdout, intro
+        print >> sys.stdout
+        print >> sys.stdout, "####################################################"
+        print >> sys.stdout, "#                 CMIP5 Data Finder                #"
+        print >> sys.stdout, "####################################################"
+        print >> sys.stdout
+        print >> sys.stdout, "Parsed input arguments:"
+        print >> sys.stdout
+        if params_file:
+            print >> sys.stdout,"Running with parameters file:", params_file
+        else:
+            if len(fpars) < 7:
+                print >> sys.stderr, "Too few file parameters (CMIP5 needs exacly 7: e.g. CMIP5 MPI-ESM-LR Amon historical r1i1p1 1980 2005)"
+                sys.exit(1)
+            else:
+                print >> sys.stdout,"Running with user-defined file parameters and variables     "
+                print >> sys.stdout,"File      :", fpars[0]
+                print >> sys.stdout,"Experiment:", fpars[1]
+                print >> sys.stdout,"Medium    :", fpars[2]
+                print >> sys.stdout,"Type      :", fpars[3]
+                print >> sys.stdout,"Ensemble  :", fpars[4]
+                print >> sys.stdout,"Year1     :", fpars[5]
+                print >> sys.stdout,"Year2     :", fpars[6]
+                print >> sys.stdout,"Var(s)    :", vpars[0]
+        print >> sys.stdout
+
+    # ---- if we are using synda
+    # ---- Get the synda path or exit here
+    if syndacall is True:
+        if verbose is True:
+            print('You are going to use SYNDA to download data...')
+            print('Looking up synda executable...')
+        if which_synda(SYNDA) is not None:
+            print >> sys.stdout, "Synda found...OK" 
+            print >> sys.stdout, which_synda(SYNDA)
+        else:
+            print >> sys.stderr, "No synda executable found in path. Exiting."
+            sys.exit(1)
 
-    # ---- start timer
-    t1 = time.time()
-    
-    # ---- get the params file
-    if params_file:
+        if verbose is True:
+            # ---- Have us some information from the synda configuration file
+            # ---- one can add more info if needed, currently just data server
+            print('\n---------------------------------------------')
+            print('Information about synda configuration:')
+            print('---------------------------------------------')
+            synda_conf_file = which_synda(SYNDA).rsplit('/',2)[0] + '/conf/sdt.conf'
+            print ('Synda conf file %s' % synda_conf_file)
+            # a stand-in synda (--synda-exec) may have no conf file
+            if os.path.exists(synda_conf_file):
+                with open(synda_conf_file, 'r') as file:
+                    for line in file:
+                        if line.split('=')[0]=='indexes':
+                            data_server = line.split('=')[1]
+                            print('ESGF data node: %s' % data_server.split()[0])
+
+    # ---- checksums kept between manifests
+    checksum_cache = None
+    if checksum_file:
+        checksum_cache = manifest.ChecksumCache(checksum_file)
+
+    # ---- DKRZ latest versions kept between runs
+    if version_file:
+        df.use_version_cache(version_file, version_ttl)
+
+    # ---- Write ASCII file holding cache_BADC.py command.
+    # ---- (an --incremental run compares it against the previous one first)
+    previous_command = None
+    if os.path.exists('cmip5datafinder.param'):
+        with open('cmip5datafinder.param', 'r') as pfile:
+            previous_command = pfile.readline()
+    pfile = open('cmip5datafinder.param','w')
+    pfile.write(command_string + "\n")
+    pfile.close()
+
+    # ---- filedescriptors to look up
+    if manifest_index is not None:
+        descriptors = [header.split('_') for header in manifest_index]
+        name = params_file
+    elif params_file:
         paramfile, paramfile_extension = os.path.splitext(params_file)
-
-        # ---- txt
-        if paramfile_extension=='.txt':
-            # ---- Parse a generic text parameters file ---- #
-            # ---- with the specified variable(s) ---- #
-            ##############################################################
-            """
-            NOTE: for streamlining
-            Build a standardized .txt parameter file as follows:
-            each row must be a standard specific file descriptor e.g.
-            cmip  experiment type1 type2    ensemble yr1  yr2  variable
-            ----------------------------------------------------------
-            CMIP5 MPI-ESM-LR Amon historical r1i1p1  1900  1982   tro3 
-    
-            IT IS IMPORTANT TO KEEP THIS ORDER OTHERWISE THINGS CAN GET VERY MESSY !!!
-            """
-            if syndacall is True:
-                # first poll the local server
-                if verbose is True:
-                    #write_cache_direct(params_file,ls_host_root,host_root,pfile2,pfile3,errorfile,latestDir,verbose)
-                    write_cache_direct(params_file, rootp, pfile2, pfile3, errorfile, drs, verbose)
-                else:
-                    #write_cache_direct(params_file,ls_host_root,host_root,pfile2,pfile3,errorfile,latestDir,verbose=False)
-                    write_cache_direct(params_file, rootp, pfile2, pfile3, errorfile, drs, verbose=False)
-                print_stats(pfile2,pfile3)
-                # check for incomplete/missing filedescriptors
-                if os.path.exists(pfile3):
-                    ar = open(pfile3, 'r')
-                    lls = [line for line in ar if line.split()[0].split('_')[0] == 'CMIP5']
-                    lenitemlist = len(lls)
-                    cat11 = [(p.split()[0],'dope') for p in lls if p.split()[1] == 'ERROR-MISSING']
-                    cat21 = [(p.split()[0],p.split()[2]) for p in lls if p.split()[1] == 'INCOMPLETE']
-                    # construct two dictionaries:
-                    # A: contains all missing filedescriptors
-                    # B: contains the incomplete filedescriptors
-                    A = {}
-                    B = {}
-                    for item in cat21:
-                        A.setdefault(item[0],[]).append(item[1])
-                    for item in cat11:
-                        B.setdefault(item[0],[]).append(item[1])
-                    # convolve A and B so synda will download only the A's 'dope' (missing)
-                    # and the bits from B that are not already on disk
-                    Z = dict(A, **B)
-                    if verbose is True:
-                        print('\n-----------------------------------------------------------------------------------------------------')
-                        print('We parsed a missing LOCAL data param file. We have missing/incomplete files for %i filedescriptors: ' % lenitemlist)
-                        print('Calling SYNDA to look for data in /sdt/data or download what is not found...')
-                        print('-------------------------------------------------------------------------------------------------------')
-                    for it in lls:
-                        ite = it.split()[0].split('_')
-                        v1 = ite[7]
-                        header = it.split()[0]
-                        model_data = ite[0] + ' '+ ite[1] + ' ' + ite[2]\
-                                     + ' ' + ite[3] + ' ' + ite[4]
-                        yr1 = int(ite[5])
-                        yr2 = int(ite[6])
-                        # call synda search
-                        outpt = synda_search(model_data,v1)
-                        if download is True:
-                            if verbose is True:
-                                if dryrunOn:
-                                    s = synda_dll(outpt,v1,yr1,yr2,header,Z,pfile4,pfile5,download=True,dryrunOn=True,verbose=True)
-                                else:
-                                    s = synda_dll(outpt,v1,yr1,yr2,header,Z,pfile4,pfile5,download=True,dryrunOn=False,verbose=True)
-                            else:
-                                if dryrunOn:
-                                    s = synda_dll(outpt,v1,yr1,yr2,header,Z,pfile4,pfile5,download=True,dryrunOn=True,verbose=False)
-                                else:
-                                    s = synda_dll(outpt,v1,yr1,yr2,header,Z,pfile4,pfile5,download=True,dryrunOn=False,verbose=False)
-                        else:
-                            if verbose is True:
-                                s = synda_dll(outpt,v1,yr1,yr2,header,Z,pfile4,pfile5,download=False,dryrunOn=False,verbose=True)
-                            else:
-                                s = synda_dll(outpt,v1,yr1,yr2,header,Z,pfile4,pfile5,download=False,dryrunOn=False,verbose=False)
-                        if s == 0:
-                            with open(pfile5, 'a') as file:
-                                file.write(header + ' ' + 'ERROR-MISSING' + '\n')
-                                file.close()
-                    if os.path.exists(pfile4):
-                        fix_duplicate_entries(pfile4)
-                    if os.path.exists(errorfile):
-                        fix_duplicate_entries(errorfile)
-                    print_stats(pfile4,pfile5)
-
-                    # final cache merging and cleanup
-                    if os.path.exists(pfile2) and os.path.exists(pfile4):
-                        # create a composite file using caches from sever and synda
-                        compf = drb + '/cache_cmip5_combined_' + d + '.txt'
-                        cache_merge(pfile2,pfile4,compf)
-                        final_cache(params_file,compf,nm)
-                        print_final_stats(nm)
-                        plotter(nm,drb)
-                    else:
-                        # looks like synda didnt find anything extra
-                        if os.path.exists(pfile2):
-                            cpc = 'cp ' + pfile2 + ' ' + drb + '/cache_cmip5_combined_' + d + '.txt'
-                            proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                            (out, err) = proc.communicate()
-                            final_cache(params_file,pfile2,nm)
-                            print_final_stats(nm)
-                            plotter(nm,drb)
-                        else:
-                            # looks like there is nothing in local but synda found extra
-                            if os.path.exists(pfile4):
-                                cpc = 'cp ' + pfile4 + ' ' + drb + '/cache_cmip5_combined_' + d + '.txt'
-                                proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                                (out, err) = proc.communicate()
-                                final_cache(params_file,pfile4,nm)
-                                print_final_stats(nm)
-                                plotter(nm,drb)
-                    # in case synda missed some filedescriptors
-                    if os.path.exists(pfile5):
-                        fix_duplicate_entries(pfile5)
-                        cpc = 'cp ' + pfile5 + ' ' + drb + '/missing_cache_cmip5_combined_' + d + '.txt'
-                        proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                        (out, err) = proc.communicate()
-                else:
-                    # no need to call synda if we found all needed filedescriptors on server
-                    print('Cached all needed data from local datasource %s' % d)
-                    if os.path.exists(pfile2):
-                        cpc = 'cp ' + pfile2 + ' ' + drb + '/cache_cmip5_combined_' + d + '.txt'
-                        proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                        (out, err) = proc.communicate()
-                        final_cache(params_file,pfile2,nm)
-                        print_final_stats(nm)
-                        plotter(nm,drb)
-                    #sys.exit(0)
-            else:
-                # not calling synda at all
-                if verbose is True:
-                    print('\n-------------------------------------------------------------------------------------')
-                    print('We have looked at existing files LOCALLY only: ')
-                    print('Here is what we found:')
-                    print('---------------------------------------------------------------------------------------')
-                    #write_cache_direct(params_file,ls_host_root,host_root,pfile2,pfile3,errorfile,latestDir,verbose)
-                    write_cache_direct(params_file, rootp, pfile2, pfile3, errorfile, drs, verbose)
-                else:
-                    #write_cache_direct(params_file,ls_host_root,host_root,pfile2,pfile3,errorfile,latestDir,verbose=False)
-                    write_cache_direct(params_file, rootp, pfile2, pfile3, errorfile, drs, verbose=False)
-                if os.path.exists(errorfile):
-                    fix_duplicate_entries(errorfile)
-                print_stats(pfile2,pfile3)
-                if os.path.exists(pfile2):
-                    cpc = 'cp ' + pfile2 + ' ' + drb + '/cache_cmip5_combined_' + d + '.txt'
-                    proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                    (out, err) = proc.communicate()
-                    final_cache(params_file,pfile2,nm)
-                    print_final_stats(nm)
-                    plotter(nm,drb)
-                if os.path.exists(pfile3):
-                    cpc = 'cp ' + pfile3 + ' ' + drb + '/missing_cache_cmip5_combined_' + d + '.txt'
-                    proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                    (out, err) = proc.communicate()
-
-
-    elif userVars:
-    
-        # ---- user command line arguments parsed here
-        for vi in vpars:
-            if os.path.exists('prepended_temp.txt'):
-                os.remove('prepended_temp.txt')
-            #if os.path.exists('temp.txt'):
-            #    os.remove('temp.txt')
-            header = fpars[0] + '_'+ fpars[1] + '_' + fpars[2]\
-                     + '_' + fpars[3] + '_' + fpars[4] + '_' + str(fpars[5])+ '_' + str(fpars[6])\
-                     + '_' + vi
-            model_data = fpars[0] + ' '+ fpars[1] + ' ' + fpars[2]\
-                     + ' ' + fpars[3] + ' ' + fpars[4]
-            if verbose is True:
-                print('Looking at variable %s' % vi)
-                print('Model data for: ', model_data + '\n')
-            yr1 = fpars[5]
-            yr2 = fpars[6]
-            tempfile = open('temp.txt', 'a')
-            templine = model_data + ' ' + str(yr1) + ' ' + str(yr2) + ' ' + vi + '\n'
-            tempfile.write(templine)
-            tempfile.close()
-            if verbose is True:
-                write_cache_direct('temp.txt',ls_host_root,host_root,pfile2,pfile3,errorfile,latestDir,verbose)
-            else:
-                write_cache_direct('temp.txt',ls_host_root,host_root,pfile2,pfile3,errorfile,latestDir,verbose=False)
-            print_stats(pfile2,pfile3)
-            if syndacall is True:
-                if os.path.exists(pfile3):
-                    if verbose is True:
-                        print('\n-------------------------------------------------------------------------------------')
-                        print('We are missing files for our needed filedescriptor: %s' % model_data + ' ' + str(yr1) + ' ' + str(yr2) + ' ' + vi)
-                        print('Calling SYNDA to look for data in /sdt/data or download what is not found...')
-                        print('---------------------------------------------------------------------------------------')
-                    ar = open(pfile3, 'r')
-                    lls = [line for line in ar if line.split()[0].split('_')[0] == 'CMIP5']
-                    lenitemlist = len(lls)
-                    cat11 = [(p.split()[0],'dope') for p in lls if p.split()[1] == 'ERROR-MISSING']
-                    cat21 = [(p.split()[0],p.split()[2]) for p in lls if p.split()[1] == 'INCOMPLETE']
-                    A = {}
-                    B = {}
-                    for item in cat21:
-                        A.setdefault(item[0],[]).append(item[1])
-                    for item in cat11:
-                        B.setdefault(item[0],[]).append(item[1])
-                    Z = dict(A, **B)
-                    outpt = synda_search(model_data,vi)
-                    if download is True:
-                        if verbose is True:
-                            if dryrunOn:
-                                s = synda_dll(outpt,vi,yr1,yr2,header,Z,pfile4,pfile5,download=True,dryrunOn=True,verbose=True)
-                            else:
-                                s = synda_dll(outpt,vi,yr1,yr2,header,Z,pfile4,pfile5,download=True,dryrunOn=False,verbose=True)
-                        else:
-                            if dryrunOn:
-                                s = synda_dll(outpt,vi,yr1,yr2,header,Z,pfile4,pfile5,download=True,dryrunOn=True,verbose=False)
-                            else:
-                                s = synda_dll(outpt,vi,yr1,yr2,header,Z,pfile4,pfile5,download=True,dryrunOn=False,verbose=False)
-                    else:
-                        if verbose is True:
-                            s = synda_dll(outpt,vi,yr1,yr2,header,Z,pfile4,pfile5,download=False,dryrunOn=False,verbose=True)
-                        else:
-                            s = synda_dll(outpt,vi,yr1,yr2,header,Z,pfile4,pfile5,download=False,dryrunOn=False,verbose=False)
-                    if s == 0:
-                        with open(pfile5, 'a') as file:
-                            file.write(header + ' ' + 'ERROR-MISSING' + '\n')
-                            file.close()
-                    if os.path.exists(pfile4):
-                        fix_duplicate_entries(pfile4)
-                    if os.path.exists(errorfile):
-                        fix_duplicate_entries(errorfile)
-                    print_stats(pfile4,pfile5)
-                    # final cache merging and cleanup
-                    if os.path.exists(pfile2) and os.path.exists(pfile4):
-                        # create a composite file using caches from sever and synda
-                        compf = drb + '/cache_cmip5_combined_' + d + '.txt'
-                        cache_merge(pfile2,pfile4,compf)
-                        final_cache('temp.txt',compf,nm)
-                        print_final_stats(nm)
-                    else:
-                        # looks like synda didnt find anything extra
-                        if os.path.exists(pfile2):
-                            cpc = 'cp ' + pfile2 + ' ' + drb + '/cache_cmip5_combined_' + d + '.txt'
-                            proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                            (out, err) = proc.communicate()
-                            final_cache('temp.txt',pfile2,nm)
-                            print_final_stats(nm)
-                        else:
-                            # looks like there is nothing in local but synda found extra
-                            if os.path.exists(pfile4):
-                                cpc = 'cp ' + pfile4 + ' ' + drb + '/cache_cmip5_combined_' + d + '.txt'
-                                proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                                (out, err) = proc.communicate()
-                                final_cache('temp.txt',pfile4,nm)
-                                print_final_stats(nm)
-                    # in case synda missed some filedescriptors
-                    if os.path.exists(pfile5):
-                        fix_duplicate_entries(pfile5)
-                        cpc = 'cp ' + pfile5 + ' ' + drb + '/missing_cache_cmip5_combined_' + d + '.txt'
-                        proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                        (out, err) = proc.communicate()
-                else:
-                    # no need to call synda if we found all needed filedescriptors on server
-                    print('Cached all data from local datasource %s' % d)
-                    if os.path.exists(pfile2):
-                        cpc = 'cp ' + pfile2 + ' ' + drb + '/cache_cmip5_combined_' + d + '.txt'
-                        proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                        (out, err) = proc.communicate()
-                        final_cache('temp.txt',pfile2,nm)
-                        print_final_stats(nm)
-            # not calling synda at all
-            if verbose is True:
-                print('\n-------------------------------------------------------------------------------------')
-                print('We have looked at existing files LOCALLY only: ')
-                print('Here is what we found:')
-                print('---------------------------------------------------------------------------------------')
-            if os.path.exists(errorfile):
-                fix_duplicate_entries(errorfile)
-                print_stats(pfile2,pfile3)
-            if os.path.exists(pfile2):
-                cpc = 'cp ' + pfile2 + ' ' + drb + '/cache_cmip5_combined_' + d + '.txt'
-                proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                (out, err) = proc.communicate()
-                final_cache('temp.txt',pfile2,nm)
-                print_final_stats(nm)
-            if os.path.exists(pfile3):
-                cpc = 'cp ' + pfile3 + ' ' + drb + '/missing_cache_cmip5_combined_' + d + '.txt'
-                proc = subprocess.Popen(cpc, stdout=subprocess.PIPE, shell=True)
-                (out, err) = proc.communicate()
-            #os.remove('temp.txt')
-            os.remove('prepended_temp.txt')
-
-    # ---- timing and exit
-    t2 = time.time()
-    dt = t2 - t1
+        if paramfile_extension != '.txt':
+            print >> sys.stderr, "Only text (.txt) parameter files are supported for now. Exiting."
+            sys.exit(1)
+        # ---- Parse a generic text parameters file ---- #
+        # ---- with the specified variable(s) ---- #
+        ##############################################################
+        """
+        NOTE: for streamlining
+        Build a standardized .txt parameter file as follows:
+        each row must be a standard specific file descriptor e.g.
+        cmip  experiment type1 type2    ensemble yr1  yr2  variable
+        ----------------------------------------------------------
+        CMIP5 MPI-ESM-LR Amon historical r1i1p1  1900  1982   tro3 
+
+        IT IS IMPORTANT TO KEEP THIS ORDER OTHERWISE THINGS CAN GET VERY MESSY !!!
+        """
+        descriptors = unique_lines(params_file)
+        name = os.path.basename(params_file)
+    else:
+        # ---- user command line arguments: one filedescriptor per variable
+        descriptors = [fpars[:7] + [vi] for vi in vpars]
+        name = 'user.txt'
+
+    # ---- Write cache files ---- #
+    # ---- hardcoded names so we standardize analyses
+    # ---- start overall timing
+    t10 = time.time()
+    results = find_data(descriptors, db, synda=syndacall, download=download, dryrun=dryrunOn,
+                        federated=federated, jobs=jobs, verbose=verbose, name=name,
+                        binary_cache=binaryCache, plots=plotsOn, plots_dir=plots_dir,
+                        index_file=index_file, manifest_index=manifest_index,
+                        verify_manifest=verifyManifest, manifest_out=manifest_out,
+                        checksum_cache=checksum_cache, incremental=incremental,
+                        command_line=command_string, previous_command=previous_command)
+
+    # ---- finish, cleanup and exit
+    if version_file:
+        df.LATEST_VERSIONS.save()
+    if checksum_cache is not None:
+        n = checksum_cache.evict()
+        if verbose is True:
+            print('Dropped %i checksums of files that are gone from %s' % (n, checksum_file))
+        checksum_cache.close()
+    t20 = time.time()
+    dt0 = t20 - t10
+    if stats_file:
+        # ---- final stats for headless runs
+        run_stats = dict((d, results[d]['stats']) for d in results)
+        with open(stats_file, 'w') as sf:
+            json.dump({'command': command_string, 'time_elapsed': dt0,
+                       'datasources': run_stats}, sf, indent=1, sort_keys=True)
     if verbose is True:
-        print('=================================')
-        print('DONE! with datasource %s' % d)
-        print('Time elapsed: %.1f seconds' % dt)
-        print('=================================')
-    print('Time elapsed: %.1f s' % dt)
-
-# ---- finish, cleanup and exit
-if params_file:
-    prp = 'prepended_' + params_file
-    os.remove(prp)
-if userVars:
-    os.remove('temp.txt')
-t20 = time.time()
-dt0 = t20 - t10
-if verbose is True:
-    print('==================================================')
-    print('DONE! with all datasources')
-    print('Time elapsed: %.1f seconds' % dt0)
-    print('If your data is fully cached, you deserve a beer :)')
-    print('==================================================')
-print('Time elapsed: %.1f s' % dt0)
+        print('==================================================')
+        print('DONE! with all datasources')
+        print('Time elapsed: %.1f seconds' % dt0)
+        print('If your data is fully cached, you deserve a beer :)')
+        print('==================================================')
+    print('Time elapsed: %.1f s' % dt0)
+
+if __name__ == '__main__':
+    main()
 
 # ---- end of code
@@ -7,113 +7,280 @@ Authors: Valeriu Predoi, University of Reading, valeriu.predoi@ncas.ac.uk
 # ---- Import standard modules to the python path.
 import sys, os
 import subprocess
-from datetime import datetime
+import json, threading, time
+import file_dates
 #import logging
 
 # start the logging procedure
 #logger = logging.getLogger('ESMValTool')
 
-def cmip5_model2inst(model): ## CHECK-ME: A dictionary is preferred to avoid using find, which causes some issues on some machines in the past (too slow)
+# persistent DRS index (drs_index.DRSIndex) to query instead of calling find;
+# set it with use_drs_index(), None means we look for files with find
+DRS_INDEX = None
+
+def use_drs_index(index):
+    """
+    Make find_files and veto_files query the given drs_index.DRSIndex
+    instead of walking the datasource with find; pass None to go back to find
+    """
+    global DRS_INDEX
+    DRS_INDEX = index
+
+def indexed(dirname):
+    """
+    True if dirname is the root of the DRS index in use or below it
+    (a sibling of the root that only shares its prefix is not)
+    """
+    if DRS_INDEX is None:
+        return False
+    dirname = dirname.rstrip('/')
+    return dirname == DRS_INDEX.rootpath or dirname.startswith(DRS_INDEX.rootpath + '/')
+
+# ---- CMIP5 lookup tables, built once at import; treat them as read-only
+# ---- CHECK-ME: A dictionary is preferred to avoid using find, which causes some issues on some machines in the past (too slow)
+CMIP5_MODEL2INST = {
+    'HadGEM2-CC': 'MOHC',
+    'HadGEM2-A': 'MOHC',
+    'HadCM3': 'MOHC',
+    'HadGEM2-ES': 'MOHC',
+    'FIO-ESM': 'FIO',
+    'fio-esm': 'FIO',
+    'CCSM4': 'NCAR',
+    'GEOS-5': 'NASA-GMAO',
+    'inmcm4': 'INM',
+    'CanESM2': 'CCCma',
+    'CanCM4': 'CCCma',
+    'CanAM4': 'CCCma',
+    'GISS-E2-R': 'NASA-GISS',
+    'GISS-E2-R-CC': 'NASA-GISS',
+    'GISS-E2-H-CC': 'NASA-GISS',
+    'GISS-E2-H': 'NASA-GISS',
+    'CNRM-CM5': 'CNRM-CERFACS',
+    'CNRM-CM5-2': 'CNRM-CERFACS',
+    'NICAM-09': 'NICAM',
+    'IPSL-CM5A-LR': 'IPSL',
+    'IPSL-CM5A-MR': 'IPSL',
+    'IPSL-CM5B-LR': 'IPSL',
+    'CSIRO-Mk3-6-0': 'CSIRO-QCCCE',
+    'CESM1-CAM5': 'NSF-DOE-NCAR',
+    'CESM1-CAM5-1-FV2': 'NSF-DOE-NCAR',
+    'CESM1-BGC': 'NSF-DOE-NCAR',
+    'CESM1-WACCM': 'NSF-DOE-NCAR',
+    'CESM1-FASTCHEM': 'NSF-DOE-NCAR',
+    'NorESM1-M': 'NCC',
+    'NorESM1-ME': 'NCC',
+    #'CFSv2-2011': 'NOAA-NCEP', (same model as COLA-CFS below)
+    'ACCESS1-3': 'CSIRO-BOM',
+    'ACCESS1-0': 'CSIRO-BOM',
+    'CMCC-CM': 'CMCC',
+    'CMCC-CESM': 'CMCC',
+    'CMCC-CMS': 'CMCC',
+    'FGOALS-g2': 'LASG-CESS',
+    'FGOALS-s2': 'LASG-IAP',
+    'FGOALS-gl': 'LASG-IAP',
+    'GFDL-HIRAM-C180': 'NOAA-GFDL',
+    'GFDL-ESM2G': 'NOAA-GFDL',
+    'GFDL-CM2p1': 'NOAA-GFDL',
+    'GFDL-CM3': 'NOAA-GFDL',
+    'GFDL-ESM2M': 'NOAA-GFDL',
+    'GFDL-HIRAM-C360': 'NOAA-GFDL',
+    'EC-EARTH': 'ICHEC',
+    'BNU-ESM': 'BNU',
+    'CFSv2-2011': 'COLA-CFS',
+    'HadGEM2-AO': 'NIMR-KMA',
+    'MIROC4h': 'MIROC',
+    'MIROC5': 'MIROC',
+    'MIROC-ESM': 'MIROC',
+    'MIROC-ESM-CHEM': 'MIROC',
+    'bcc-csm1-1': 'BCC',
+    'bcc-csm1-1-m': 'BCC',
+    #'HadGEM2-ES': 'INPE',
+    'MPI-ESM-LR': 'MPI-M',
+    'MPI-ESM-MR': 'MPI-M',
+    'MPI-ESM-P': 'MPI-M',
+    'MRI-AGCM3-2H': 'MRI',
+    'MRI-CGCM3': 'MRI',
+    'MRI-ESM1': 'MRI',
+    'MRI-AGCM3-2S': 'MRI',
+}
+
+# ---- CHECK-ME: I wrote this based on the DKRZ data, some entries might be missing
+CMIP5_MIP2REALM_FREQ = {
+    'Amon': ['atmos', 'mon'],
+    'Omon': ['ocean', 'mon'],
+    'Lmon': ['land', 'mon'],
+    'LImon': ['landIce', 'mon'],
+    'OImon': ['seaIce', 'mon'],
+    'aero': ['aerosol', 'mon'],
+#    '3hr': ???
+    'cfDay': ['atmos', 'day'],
+    'cfMon': ['atmos', 'mon'],
+    'day': ['atmos', 'day'],
+    'fx': ['*', 'fx'],
+}
+
+# ---- CMIP5 DRS layouts: directory holding the files of a variable,
+# ---- below the root path; {version} is the latest version directory,
+# ---- looked up on disk (DKRZ has no /latest/ link)
+CMIP5_DRS_TEMPLATES = {
+    'BADC': '{root}/{institute}/{model}/{exp}/{freq}/{realm}/{mip}/{ensemble}/latest/{variable}',
+    'DKRZ': '{root}/{institute}/{model}/{exp}/{realm}/{freq}/{mip}/{ensemble}/{version}/{variable}',
+    'ETHZ': '{root}/{exp}/{mip}/{variable}/{model}/{ensemble}/',
+    'SMHI': '{root}/{model}/{ensemble}/{exp}/{freq}',
+    # synda local data (/sdt/data): BADC order, versioned dirs, no /latest/
+    'SDT': '{root}/{institute}/{model}/{exp}/{freq}/{realm}/{mip}/{ensemble}/{version}/{variable}',
+}
+
+def cmip5_model2inst(model):
     """
     Return the institute given the model name in CMIP5
     """
+    return CMIP5_MODEL2INST[model]
+
 
-    instdict = {}
-    instdict['HadGEM2-CC'] = 'MOHC'
-    instdict['HadGEM2-A'] = 'MOHC'
-    instdict['HadCM3'] = 'MOHC'
-    instdict['HadGEM2-ES'] = 'MOHC'
-    instdict['FIO-ESM'] = 'FIO'
-    instdict['fio-esm'] = 'FIO'
-    instdict['CCSM4'] = 'NCAR'
-    instdict['GEOS-5'] = 'NASA-GMAO'
-    instdict['inmcm4'] = 'INM'
-    instdict['CanESM2'] = 'CCCma'
-    instdict['CanCM4'] = 'CCCma'
-    instdict['CanAM4'] = 'CCCma'
-    instdict['GISS-E2-R'] = 'NASA-GISS'
-    instdict['GISS-E2-R-CC'] = 'NASA-GISS'
-    instdict['GISS-E2-H-CC'] = 'NASA-GISS'
-    instdict['GISS-E2-H'] = 'NASA-GISS'
-    instdict['CNRM-CM5'] = 'CNRM-CERFACS'
-    instdict['CNRM-CM5-2'] = 'CNRM-CERFACS'
-    instdict['NICAM-09'] = 'NICAM'
-    instdict['IPSL-CM5A-LR'] = 'IPSL'
-    instdict['IPSL-CM5A-MR'] = 'IPSL'
-    instdict['IPSL-CM5B-LR'] = 'IPSL'
-    instdict['CSIRO-Mk3-6-0'] = 'CSIRO-QCCCE'
-    instdict['CESM1-CAM5'] = 'NSF-DOE-NCAR'
-    instdict['CESM1-CAM5-1-FV2'] = 'NSF-DOE-NCAR'
-    instdict['CESM1-BGC'] = 'NSF-DOE-NCAR'
-    instdict['CESM1-WACCM'] = 'NSF-DOE-NCAR'
-    instdict['CESM1-FASTCHEM'] = 'NSF-DOE-NCAR'
-    instdict['NorESM1-M'] = 'NCC'
-    instdict['NorESM1-ME'] = 'NCC'
-    instdict['CFSv2-2011'] = 'NOAA-NCEP'
-    instdict['ACCESS1-3'] = 'CSIRO-BOM'
-    instdict['ACCESS1-0'] = 'CSIRO-BOM'
-    instdict['CMCC-CM'] = 'CMCC'
-    instdict['CMCC-CESM'] = 'CMCC'
-    instdict['CMCC-CMS'] = 'CMCC'
-    instdict['FGOALS-g2'] = 'LASG-CESS'
-    instdict['FGOALS-s2'] = 'LASG-IAP'
-    instdict['FGOALS-gl'] = 'LASG-IAP'
-    instdict['GFDL-HIRAM-C180'] = 'NOAA-GFDL'
-    instdict['GFDL-ESM2G'] = 'NOAA-GFDL'
-    instdict['GFDL-CM2p1'] = 'NOAA-GFDL'
-    instdict['GFDL-CM3'] = 'NOAA-GFDL'
-    instdict['GFDL-ESM2M'] = 'NOAA-GFDL'
-    instdict['GFDL-HIRAM-C360'] = 'NOAA-GFDL'
-    instdict['EC-EARTH'] = 'ICHEC'
-    instdict['BNU-ESM'] = 'BNU'
-    instdict['CFSv2-2011'] = 'COLA-CFS'
-    instdict['HadGEM2-AO'] = 'NIMR-KMA'
-    instdict['MIROC4h'] = 'MIROC'
-    instdict['MIROC5'] = 'MIROC'
-    instdict['MIROC-ESM'] = 'MIROC'
-    instdict['MIROC-ESM-CHEM'] = 'MIROC'
-    instdict['bcc-csm1-1'] = 'BCC'
-    instdict['bcc-csm1-1-m'] = 'BCC'
-    #instdict['HadGEM2-ES'] = 'INPE'
-    instdict['MPI-ESM-LR'] = 'MPI-M'
-    instdict['MPI-ESM-MR'] = 'MPI-M'
-    instdict['MPI-ESM-P'] = 'MPI-M'
-    instdict['MRI-AGCM3-2H'] = 'MRI'
-    instdict['MRI-CGCM3'] = 'MRI'
-    instdict['MRI-ESM1'] = 'MRI'
-    instdict['MRI-AGCM3-2S'] = 'MRI'
-
-    return instdict[model]
-
-
-def cmip5_mip2realm_freq(mip): ## CHECK-ME: Same as above
+def cmip5_mip2realm_freq(mip):
     """
     Returns realm and frequency given the mip in CMIP5
     """
-
-    mipdict = {} ## CHECK-ME: I wrote this based on the DKRZ data, some entries might be missing
-    mipdict['Amon'] = ['atmos', 'mon']
-    mipdict['Omon'] = ['ocean', 'mon']
-    mipdict['Lmon'] = ['land', 'mon']
-    mipdict['LImon'] = ['landIce', 'mon']
-    mipdict['OImon'] = ['seaIce', 'mon']
-    mipdict['aero'] = ['aerosol', 'mon']
-#    mipdict['3hr'] = ???
-    mipdict['cfDay'] = ['atmos', 'day'] 
-    mipdict['cfMon'] = ['atmos', 'mon'] 
-    mipdict['day'] = ['atmos', 'day'] 
-    mipdict['fx'] = ['*', 'fx']
-
-    if mip in mipdict.keys():
-        return mipdict[mip]
+    if mip in CMIP5_MIP2REALM_FREQ:
+        return CMIP5_MIP2REALM_FREQ[mip]
     else:
         print("ERROR - CMIP5: can not map mip to realm. Exiting")
+
+
+class DRSResolver:
+    """
+    Maps a CMIP5 model and variable to the exact directory of its files
+    in one of the CMIP5_DRS_TEMPLATES layouts; the template is split
+    once here so resolving a filedescriptor is a few dictionary lookups
+    and a string format (plus a listdir for the DKRZ version).
+    rootpath: root of the DRS tree e.g. /badc/cmip5/data/cmip5/output1
+    drs: one of CMIP5_DRS_TEMPLATES
+    """
+
+    def __init__(self, rootpath, drs):
+        if drs not in CMIP5_DRS_TEMPLATES:
+            raise ValueError('Unknown DRS layout %s' % drs)
+        self.rootpath = rootpath.rstrip('/')
+        self.drs = drs
+        template = CMIP5_DRS_TEMPLATES[drs]
+        if '{version}' in template:
+            self.ensemble_template, rest = template.split('/{version}')
+            self.version_template = '{version}' + rest
+        else:
+            self.ensemble_template, self.version_template = template, None
+        self.need_institute = '{institute}' in template
+        self.need_realm_freq = '{realm}' in template or '{freq}' in template
+
+    def latest_version(self, ensemble_dir):
+        """
+        Automatically find the latest version by sorting;
+        the result is shared by all the variables, see LATEST_VERSIONS
+        """
+        return LATEST_VERSIONS.get(ensemble_dir)
+
+    def directory(self, model, var):
+        """
+        Directory of the files of variable var['name'] of the model
+        (a model dictionary, see get_input_filelist)
+        """
+        facets = {'root': self.rootpath,
+                  'model': model['name'],
+                  'exp': model['exp'],
+                  'mip': model['mip'],
+                  'ensemble': model['ensemble'],
+                  'variable': var['name']}
+        if self.need_institute:
+            facets['institute'] = CMIP5_MODEL2INST[model['name']]
+        if self.need_realm_freq:
+            realm_freq = cmip5_mip2realm_freq(model['mip'])
+            if realm_freq is None:
+                raise ValueError('Can not map CMIP5 mip %s to realm' % model['mip'])
+            facets['realm'], facets['freq'] = realm_freq
+        dirname = self.ensemble_template.format(**facets)
+        if self.version_template is not None:
+            facets['version'] = self.latest_version(dirname)
+            dirname = dirname + '/' + self.version_template.format(**facets)
+        return dirname
+
+class LatestVersions:
+    """
+    Memo of the latest version directory of each ensemble directory
+    (DKRZ layout), so the many variables of a model/exp/mip/ensemble
+    list their versions directory once instead of once each.
+    path: optional JSON file the memo is loaded from and saved to,
+          so it carries over to the next runs
+    ttl: seconds after which an entry is looked up on disk again
+         (None: never, which is fine within a single run)
+    """
+
+    def __init__(self, path=None, ttl=None):
+        self.path = path
+        self.ttl = ttl
+        self.versions = {}
+        self.lock = threading.Lock()
+        if path is not None and os.path.exists(path):
+            with open(path, 'r') as vfile:
+                self.versions = dict((k, tuple(v)) for k, v in json.load(vfile).items())
+
+    def get(self, ensemble_dir):
+        now = time.time()
+        with self.lock:
+            entry = self.versions.get(ensemble_dir)
+        if entry is not None and (self.ttl is None or now - entry[1] < self.ttl):
+            return entry[0]
+        list_versions = os.listdir(ensemble_dir)
+        list_versions.sort()
+        latest = os.path.basename(list_versions[-1])
+        with self.lock:
+            self.versions[ensemble_dir] = (latest, now)
+        return latest
+
+    def save(self):
+        """
+        Writes the memo to path (if any), dropping expired entries
+        """
+        if self.path is None:
+            return
+        now = time.time()
+        with self.lock:
+            versions = dict((k, v) for k, v in self.versions.items()
+                            if self.ttl is None or now - v[1] < self.ttl)
+        tmp_path = self.path + '.part'
+        with open(tmp_path, 'w') as vfile:
+            json.dump(versions, vfile)
+        os.rename(tmp_path, self.path)
+
+# latest versions found so far in this run; replace it with
+# use_version_cache() to keep them on disk between runs
+LATEST_VERSIONS = LatestVersions()
+
+def use_version_cache(path, ttl=None):
+    """
+    Keep the DKRZ latest versions in the JSON file path between runs,
+    looking them up on disk again after ttl seconds; call
+    LATEST_VERSIONS.save() at the end of the run
+    """
+    global LATEST_VERSIONS
+    LATEST_VERSIONS = LatestVersions(path, ttl)
+
+# ---- one resolver per (root path, DRS) for the whole run
+_RESOLVERS = {}
+
+def get_drs_resolver(rootpath, drs):
+    """
+    Returns the (cached) DRSResolver of a root path and DRS layout
+    """
+    key = (rootpath, drs)
+    if key not in _RESOLVERS:
+        _RESOLVERS[key] = DRSResolver(rootpath, drs)
+    return _RESOLVERS[key]
     
 
 def get_input_filelist(rootpath, model, var, drs):
 
     # if drs at all
-    if drs == 'BADC' or drs == 'DKRZ':
+    if drs in ('BADC', 'DKRZ', 'SDT'):
         root = rootpath
         #print("Root path set to: %s" % root)
 
@@ -174,6 +341,10 @@ def find_files(dirname, filename):
     """
     flist = []
 
+    # files below an indexed root are looked up in the DRS index
+    if indexed(dirname):
+        return DRS_INDEX.find(dirname, filename)
+
     # work only with existing dirs or allowed permission dirs
     strfindic = 'find ' + dirname +' -follow -type f -iname ' + '*' + filename + '*'
     print(strfindic)
@@ -190,6 +361,11 @@ def veto_files(model, dirname, filename):
 
     """
 
+    # the index knows the years of each file already
+    if indexed(dirname):
+        return DRS_INDEX.find(dirname, filename,
+                              model['start_year'], model['end_year'])
+
     arname = find_files(dirname, filename)
     fs = []
 
@@ -207,71 +383,11 @@ class CMIP5(DataFinder):
 
     def infile_path(self, rootpath, model, var, drs):
 
-        if (drs == 'BADC'):
-
-            #print('Getting CMIP5 data from BADC')
-
-            # Latest version is always called 'latest' at BADC
-            latest = 'latest'
-
-            dirname = '/'.join([rootpath,              # CHECK-ME
-                                cmip5_model2inst(model['name']),
-                                model['name'],
-                                model['exp'],
-                                cmip5_mip2realm_freq(model['mip'])[1],
-                                cmip5_mip2realm_freq(model['mip'])[0],
-                                model['mip'],
-                                model['ensemble'],
-                                latest,
-                                var['name']])
-
-        elif (drs == 'DKRZ'):
-
-            #print('Getting CMIP5 data from DKRZ')
-
-            ## host_root = '/mnt/lustre01/work/kd0956/CMIP5/data/cmip5/output1/'  ## must be given in config, not here
-
-            # Automatically find the latest version by sorting
-            dirname = '/'.join([rootpath,
-                                cmip5_model2inst(model['name']),
-                                model['name'],
-                                model['exp'],
-                                cmip5_mip2realm_freq(model['mip'])[0],
-                                cmip5_mip2realm_freq(model['mip'])[1],
-                                model['mip'],
-                                model['ensemble']])
-
-            list_versions = os.listdir(dirname)
-            list_versions.sort()
-            latest = os.path.basename(list_versions[-1])
-
-            dirname = '/'.join([rootpath,
-                                cmip5_model2inst(model['name']),
-                                model['name'],
-                                model['exp'],
-                                cmip5_mip2realm_freq(model['mip'])[0],
-                                cmip5_mip2realm_freq(model['mip'])[1],
-                                model['mip'],
-                                model['ensemble'],
-                                latest,
-                                var['name']])
-
-        elif (drs == 'ETHZ'):
-
-            print('Getting CMIP5 data with ETHZ root format')
-
-            dirname = '/'.join([rootpath, 
-                                model['exp'], 
-                                model['mip'], 
-                                var, model['name'], 
-                                model['ensemble']]) + '/'
-
-        elif (drs == 'SMHI'):
-            dirname = '/'.join([rootpath,
-                                model["name"],
-                                model["ensemble"],
-                                model["exp"],
-                                cmip5_mip2realm_freq(model['mip'])[1]])
+        if drs in CMIP5_DRS_TEMPLATES:
+
+            # BADC: latest version is always called 'latest'
+            # DKRZ, SDT: the latest version is found by sorting
+            dirname = get_drs_resolver(rootpath, drs).directory(model, var)
 
         elif drs is None:
 
@@ -388,29 +504,10 @@ def date_handling(time1,time2):
     time1 = 198204 or
     time1 = 19820422 or
     time1 = 198204220511 etc
-    More formats can be coded in at this stage.
+    More formats can be coded in at file_dates.py.
     Returns year 1 and year 2
     """
-    # yyyymm
-    if len(list(time1)) == 6 and len(list(time2)) == 6:
-        y1 = datetime.strptime(time1, '%Y%m')
-        year1 = y1.year
-        y2 = datetime.strptime(time2, '%Y%m')
-        year2 = y2.year
-    else:
-        # yyyymmdd
-        if len(list(time1)) == 8 and len(list(time2)) == 8:
-            y1 = datetime.strptime(time1, '%Y%m%d')
-            year1 = y1.year
-            y2 = datetime.strptime(time2, '%Y%m%d')
-            year2 = y2.year
-        # yyyymmddHHMM
-        if len(list(time1)) == 12 and len(list(time2)) == 12:
-            y1 = datetime.strptime(time1, '%Y%m%d%H%M')
-            year1 = y1.year
-            y2 = datetime.strptime(time2, '%Y%m%d%H%M')
-            year2 = y2.year
-    return year1,year2
+    return file_dates.date_years(time1, time2)
 
 # ---- function that does time checking on a file
 def time_check(fpath, yr1, yr2):
@@ -418,15 +515,11 @@ def time_check(fpath, yr1, yr2):
     fpath: full path to file
     yr1, yr2: model['start_year'], model['end_year']
     """
-    ssp = fpath.split('/')
-    av = ssp[-1]
-    time_range = av.split('_')[-1].strip('.nc')
-    time1 = time_range.split('-')[0]
-    time2 = time_range.split('-')[1]
-    year1 = date_handling(time1,time2)[0]
-    year2 = date_handling(time1,time2)[1]
+    years = file_dates.parse_years(fpath)
+    if years is None:
+        return False
+    year1, year2 = years
     if time_handling(year1, yr1, year2, yr2) is True:
         return True
     else:
         return False
-
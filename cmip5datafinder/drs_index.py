@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+
+"""
+drs_index.py
+Persistent on-disk index of a CMIP5 DRS tree (e.g. the BADC archive in
+/badc/cmip5/data/cmip5/output1) so the datafinder does not have to
+shell out to `find' once per filedescriptor.
+
+The index is a small SQLite database built by a single crawl of the
+DRS tree; every .nc file is stored together with its DRS facets
+(institute, model, experiment, frequency, realm, mip, ensemble, version,
+variable) and the start/end years parsed from its file name. Every
+directory is stored with its mtime so that a refresh only needs to
+re-list the directories that actually changed since the last crawl.
+
+Example (nightly cron job):
+python drs_index.py --root /badc/cmip5/data/cmip5/output1 --drs BADC --index badc_index.sqlite
+
+"""
+
+# ---- Import standard modules to the python path.
+import sys, os, getopt, fnmatch, re, sqlite3, time, threading
+import file_dates
+
+try:
+    from os import scandir as _scandir
+except ImportError:
+    try:
+        from scandir import scandir as _scandir
+    except ImportError:
+        _scandir = None
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+# ---- order of the DRS facets below the root path
+# BADC keeps a /latest/ symlink next to the versioned dirs,
+# DKRZ swaps frequency and realm and only has the versioned dirs,
+# SDT (synda local data) has the BADC order and only versioned dirs
+DRS_LAYOUTS = {
+    'BADC': ('institute', 'model', 'exp', 'freq', 'realm',
+             'mip', 'ensemble', 'version', 'variable'),
+    'SDT': ('institute', 'model', 'exp', 'freq', 'realm',
+            'mip', 'ensemble', 'version', 'variable'),
+    'DKRZ': ('institute', 'model', 'exp', 'realm', 'freq',
+             'mip', 'ensemble', 'version', 'variable'),
+}
+
+FACETS = ('institute', 'model', 'exp', 'freq', 'realm',
+          'mip', 'ensemble', 'version', 'variable')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS dirs (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    depth INTEGER,
+    mtime REAL
+);
+CREATE INDEX IF NOT EXISTS dirs_parent ON dirs (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    dirpath TEXT,
+    name TEXT,
+    institute TEXT,
+    model TEXT,
+    exp TEXT,
+    freq TEXT,
+    realm TEXT,
+    mip TEXT,
+    ensemble TEXT,
+    version TEXT,
+    variable TEXT,
+    start_year INTEGER,
+    end_year INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_dirpath ON files (dirpath);
+CREATE INDEX IF NOT EXISTS files_facets ON files
+    (model, exp, mip, ensemble, variable, version);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+"""
+
+# ---- list a directory: (subdirectories, files)
+def _list_dir(dirname):
+    """
+    Returns two lists of names: subdirectories and regular files.
+    Symlinks are followed (same as find -follow), since at BADC
+    both /latest/ and the files themselves are symlinks.
+    """
+    subdirs = []
+    files = []
+    if _scandir is not None:
+        for entry in _scandir(dirname):
+            try:
+                if entry.is_dir():
+                    subdirs.append(entry.name)
+                elif entry.is_file():
+                    files.append(entry.name)
+            except OSError:
+                # dangling symlink or permission denied
+                continue
+    else:
+        for name in os.listdir(dirname):
+            fpath = os.path.join(dirname, name)
+            if os.path.isdir(fpath):
+                subdirs.append(name)
+            elif os.path.isfile(fpath):
+                files.append(name)
+    return subdirs, files
+
+# ---- shell wildcards in directory names
+_GLOB_CHARS = re.compile(r'[*?[]')
+
+def _below(dirparts, parts):
+    """
+    True if the directory split in dirparts is the one matched by the
+    shell pattern split in parts, or below it
+    """
+    if len(dirparts) < len(parts):
+        return False
+    for dirpart, part in zip(dirparts, parts):
+        if not fnmatch.fnmatchcase(dirpart, part):
+            return False
+    return True
+
+# ---- years from a CMIP5 file name
+def _file_years(fname):
+    """
+    Returns (start_year, end_year) from a CMIP5 file name of the form
+    var_mip_model_exp_ens_date1-date2.nc or (None, None) if the
+    file name does not carry a (parsable) time range e.g. fx files
+    """
+    years = file_dates.parse_years(fname)
+    if years is None:
+        return None, None
+    return years
+
+
+class DRSIndex:
+    """
+    Class holding the SQLite index of a DRS tree.
+    index_file: path to the SQLite database (created if needed)
+    rootpath: root of the DRS tree e.g. /badc/cmip5/data/cmip5/output1;
+              an index built for another root (or layout) is emptied
+    drs: layout of the DRS tree, one of DRS_LAYOUTS (BADC, DKRZ or SDT)
+    """
+
+    def __init__(self, index_file, rootpath=None, drs='BADC'):
+        self.index_file = index_file
+        # queries may come from the write_cache_direct thread pool (--jobs)
+        self.conn = sqlite3.connect(index_file, check_same_thread=False)
+        self.lock = threading.Lock()
+        # plain str paths, same as what find returns
+        self.conn.text_factory = str
+        self.conn.executescript(_SCHEMA)
+        # root and layout are stored so a query-only user
+        # does not need to know how the index was built
+        if rootpath is None:
+            rootpath = self._get_meta('rootpath')
+            drs = self._get_meta('drs') or drs
+        if rootpath is None:
+            raise ValueError('No root path given for new index %s' % index_file)
+        if drs not in DRS_LAYOUTS:
+            raise ValueError('Unknown DRS layout %s' % drs)
+        self.rootpath = rootpath.rstrip('/')
+        self.drs = drs
+        self.layout = DRS_LAYOUTS[drs]
+        # an index built for another tree is of no use for this one:
+        # start afresh rather than keep entries no refresh would drop
+        if (self._get_meta('rootpath') not in (None, self.rootpath) or
+                self._get_meta('drs') not in (None, self.drs)):
+            self.conn.execute('DELETE FROM dirs')
+            self.conn.execute('DELETE FROM files')
+        self._set_meta('rootpath', self.rootpath)
+        self._set_meta('drs', self.drs)
+        self.conn.commit()
+
+    def _get_meta(self, key):
+        row = self.conn.execute('SELECT value FROM meta WHERE key = ?',
+                                (key,)).fetchone()
+        if row is None:
+            return None
+        return row[0]
+
+    def _set_meta(self, key, value):
+        self.conn.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)',
+                          (key, value))
+
+    def close(self):
+        self.conn.close()
+
+    # ---- crawl
+    def refresh(self, verbose=False):
+        """
+        (Re)builds the index with a single crawl of the DRS tree.
+        Directories whose mtime did not change since the last crawl are
+        not listed again: their known subdirectories are only stat-ed
+        and their files are kept as they are. On a fresh index this is
+        a full crawl. Returns the number of directories that were listed.
+        """
+        t1 = time.time()
+        known = dict((row[0], row[1]) for row in
+                     self.conn.execute('SELECT path, mtime FROM dirs'))
+        listed = 0
+        stack = [(self.rootpath, None, 0)]
+        while stack:
+            dirname, parent, depth = stack.pop()
+            try:
+                mtime = os.stat(dirname).st_mtime
+            except OSError:
+                self._drop_tree(dirname)
+                continue
+            if known.get(dirname) == mtime:
+                # unchanged: reuse the subdirectories we know of
+                for row in self.conn.execute(
+                        'SELECT path FROM dirs WHERE parent = ?',
+                        (dirname,)).fetchall():
+                    stack.append((row[0], dirname, depth + 1))
+                continue
+            try:
+                subdirs, files = _list_dir(dirname)
+            except OSError:
+                # permission denied, same as find: skip it
+                continue
+            listed += 1
+            self.conn.execute('INSERT OR REPLACE INTO dirs VALUES (?, ?, ?, ?)',
+                              (dirname, parent, depth, mtime))
+            # directories that disappeared since the last crawl
+            subpaths = set(os.path.join(dirname, s) for s in subdirs)
+            for row in self.conn.execute('SELECT path FROM dirs WHERE parent = ?',
+                                         (dirname,)).fetchall():
+                if row[0] not in subpaths:
+                    self._drop_tree(row[0])
+            for subpath in sorted(subpaths):
+                stack.append((subpath, dirname, depth + 1))
+            self._index_files(dirname, files)
+        self.conn.commit()
+        if verbose is True:
+            print('DRS index %s: listed %i directories in %.1f s'
+                  % (self.index_file, listed, time.time() - t1))
+        return listed
+
+    def _index_files(self, dirname, files):
+        """
+        Replaces the files of a single directory in the index
+        """
+        self.conn.execute('DELETE FROM files WHERE dirpath = ?', (dirname,))
+        facets = dirname[len(self.rootpath):].strip('/').split('/')
+        if len(facets) < len(self.layout):
+            return
+        facet_dict = dict(zip(self.layout, facets))
+        rows = []
+        for name in files:
+            if not name.endswith('.nc'):
+                continue
+            y1, y2 = _file_years(name)
+            rows.append((os.path.join(dirname, name), dirname, name)
+                        + tuple(facet_dict[f] for f in FACETS) + (y1, y2))
+        self.conn.executemany('INSERT OR REPLACE INTO files VALUES '
+                              '(?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', rows)
+
+    def _drop_tree(self, dirname):
+        """
+        Removes a vanished directory and everything below it
+        """
+        pattern = dirname.replace('%', '\\%').replace('_', '\\_') + '/%'
+        self.conn.execute('DELETE FROM dirs WHERE path = ? OR path LIKE ? ESCAPE ?',
+                          (dirname, pattern, '\\'))
+        self.conn.execute('DELETE FROM files WHERE dirpath = ? OR dirpath LIKE ? ESCAPE ?',
+                          (dirname, pattern, '\\'))
+
+    # ---- queries
+    def find(self, dirname, filename, yr1=None, yr2=None):
+        """
+        Drop-in for data_finder.find_files: returns the indexed files
+        below dirname whose name matches *filename* (case insensitive,
+        same as find -iname). If yr1 and yr2 are given, only files that
+        overlap the yr1-yr2 period are returned (see time_handling).
+        dirname may hold shell wildcards (*?[) as the shell would expand
+        them, one directory level each e.g. .../fx/*/fx/r0i0p0/latest/sftlf
+        """
+        dirname = dirname.rstrip('/')
+        parts = dirname.split('/')
+        wild = [i for i, part in enumerate(parts) if _GLOB_CHARS.search(part)]
+        if wild:
+            # query below the part without wildcards, match the rest here
+            prefix = '/'.join(parts[:wild[0]])
+        else:
+            prefix = dirname
+        pattern = prefix.replace('%', '\\%').replace('_', '\\_') + '/%'
+        sql = 'SELECT path, name, dirpath FROM files WHERE (dirpath = ? OR dirpath LIKE ? ESCAPE ?)'
+        args = [prefix, pattern, '\\']
+        if yr1 is not None and yr2 is not None:
+            sql += ' AND end_year >= ? AND start_year <= ?'
+            args += [int(yr1), int(yr2)]
+        sql += ' ORDER BY path'
+        match = '*' + filename.lower() + '*'
+        with self.lock:
+            rows = self.conn.execute(sql, args).fetchall()
+        if wild:
+            rows = [row for row in rows if _below(row[2].split('/'), parts)]
+        return [row[0] for row in rows
+                if fnmatch.fnmatchcase(row[1].lower(), match)]
+
+    def query(self, yr1=None, yr2=None, **facets):
+        """
+        Returns the list of (path, start_year, end_year) for the files
+        matching the given DRS facets e.g.
+        query(model='MPI-ESM-LR', exp='historical', mip='Amon',
+              ensemble='r1i1p1', version='latest', variable='tro3')
+        """
+        sql = 'SELECT path, start_year, end_year FROM files WHERE 1'
+        args = []
+        for key in sorted(facets):
+            if key not in FACETS:
+                raise ValueError('Unknown DRS facet %s' % key)
+            sql += ' AND %s = ?' % key
+            args.append(facets[key])
+        if yr1 is not None and yr2 is not None:
+            sql += ' AND end_year >= ? AND start_year <= ?'
+            args += [int(yr1), int(yr2)]
+        sql += ' ORDER BY path'
+        with self.lock:
+            return self.conn.execute(sql, args).fetchall()
+
+# ---- Function usage.
+def usage():
+    msg = """\
+Builds or refreshes the persistent DRS index used by cmip5datafinder_v2.py --drs-index
+
+Usage:
+  drs_index.py [options]
+  --index <file>              SQLite index file [REQUIRED]
+  --root <dir>                Root of the DRS tree e.g. /badc/cmip5/data/cmip5/output1
+                              [REQUIRED when the index is first built]
+  --drs <layout>              DRS layout of the tree: BADC (default), DKRZ or SDT
+  --verbose                   Flag to show timing information
+  -h, --help                  Display this message and exit
+"""
+    print >> sys.stderr, msg
+
+if __name__ == '__main__':
+    index_file = None
+    rootpath = None
+    drs = 'BADC'
+    verbose = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'h',
+                                   ['help', 'index=', 'root=', 'drs=', 'verbose'])
+    except getopt.GetoptError:
+        usage()
+        sys.exit(1)
+    for o, a in opts:
+        if o in ('-h', '--help'):
+            usage()
+            sys.exit(0)
+        elif o == '--index':
+            index_file = a
+        elif o == '--root':
+            rootpath = a
+        elif o == '--drs':
+            drs = a
+        elif o == '--verbose':
+            verbose = True
+    if not index_file:
+        print >> sys.stderr, "No index file specified. Use --index. Exiting."
+        sys.exit(1)
+    index = DRSIndex(index_file, rootpath, drs)
+    n = index.refresh(verbose)
+    print('Indexed %s (%i directories re-listed)' % (index.rootpath, n))
+    index.close()
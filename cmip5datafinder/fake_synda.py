@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+
+"""
+fake_synda.py
+Offline stand-in for the synda executable, for testing and benchmarking
+the synda path of cmip5datafinder_v2.py without ESGF access, e.g.
+
+python cmip5datafinder_v2.py -p example.txt --datasource badc --synda --download --dryrun --synda-exec ./fake_synda.py
+
+(or put it in PATH as `synda'). It answers the synda commands the
+datafinder uses (search -f, install, queue, watch) from recordings:
+
+FAKE_SYNDA_RECORDINGS  directory of recorded outputs, one file per command
+                       line (see recording_name); missing recordings of
+                       search are made up: one file per decade of
+                       FAKE_SYNDA_YEARS, every other one already done
+FAKE_SYNDA_LATENCY     seconds each call sleeps before answering, to mimic
+                       the ESGF index round trip (default 0)
+FAKE_SYNDA_YEARS       years of the made up search outputs (default 1850-2009)
+FAKE_SYNDA_REAL        path to a real synda: the command is passed on to it
+                       and its output is recorded in FAKE_SYNDA_RECORDINGS
+
+"""
+
+# ---- Import standard modules to the python path.
+import sys, os, time, re, subprocess
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+# ---- same tables the datafinder uses for the made up dataset names
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import data_finder as df
+
+# ---- file holding the recorded output of a command line
+def recording_name(args):
+    """
+    e.g. search -f CMIP5 MPI-ESM-LR Amon historical r1i1p1 tas ->
+    search_-f_CMIP5_MPI-ESM-LR_Amon_historical_r1i1p1_tas.txt
+    (install is recorded without its file names)
+    """
+    if args and args[0] == 'install':
+        args = args[:1]
+    return re.sub(r'[^A-Za-z0-9_.+-]', '_', '_'.join(args)) + '.txt'
+
+# ---- made up synda search output
+def fake_search(args):
+    """
+    Output of synda search -f CMIP5 model mip exp ensemble variable
+    in the same format as the real one e.g.
+    new   221.2 MB  cmip5.output1.MPI-M.MPI-ESM-LR.historical.mon.atmos.Amon.r1i1p1.v20120315.tro3_Amon_MPI-ESM-LR_historical_r1i1p1_195001-195912.nc
+    """
+    facets = [a for a in args[1:] if not a.startswith('-')]
+    if len(facets) < 6:
+        return ''
+    project, model, mip, exp, ensemble, variable = facets[:6]
+    inst = df.CMIP5_MODEL2INST.get(model, 'UNKNOWN')
+    realm, freq = df.CMIP5_MIP2REALM_FREQ.get(mip, ['atmos', 'mon'])
+    dataset = '.'.join([project.lower(), 'output1', inst, model, exp,
+                        freq, realm, mip, ensemble, 'v20120315'])
+    year1, year2 = [int(y) for y in os.environ.get('FAKE_SYNDA_YEARS', '1850-2009').split('-')]
+    lines = []
+    for n, decade in enumerate(range(year1, year2 + 1, 10)):
+        status = 'done' if n % 2 == 0 else 'new'
+        fname = '%s_%s_%s_%s_%s_%i01-%i12.nc' % (variable, mip, model, exp, ensemble,
+                                                decade, min(decade + 9, year2))
+        lines.append('%-5s 221.2 MB  %s.%s' % (status, dataset, fname))
+    return '\n'.join(lines) + '\n'
+
+def fake_output(args):
+    """
+    Output of a synda command line when there is no recording of it
+    """
+    command = args[0] if args else ''
+    if command == 'search':
+        return fake_search(args)
+    elif command == 'install':
+        nfiles = len([a for a in args[1:] if not a.startswith('-')])
+        return '%i file(s) will be added to the download queue.\n' % nfiles
+    elif command == 'queue':
+        return 'waiting 0 0.00\n'
+    elif command == 'watch':
+        return 'No current download\n'
+    return ''
+
+if __name__ == '__main__':
+    args = sys.argv[1:]
+    latency = float(os.environ.get('FAKE_SYNDA_LATENCY', '0'))
+    recordings = os.environ.get('FAKE_SYNDA_RECORDINGS')
+    real_synda = os.environ.get('FAKE_SYNDA_REAL')
+    if args and args[0] == 'install':
+        # the datafinder answers the confirmation prompt on stdin
+        sys.stdin.read()
+    if real_synda:
+        # record mode: run the real synda and keep its answer
+        proc = subprocess.Popen([real_synda] + args, stdout=subprocess.PIPE,
+                                stderr=subprocess.PIPE, stdin=subprocess.PIPE,
+                                universal_newlines=True)
+        (out, err) = proc.communicate(input='\n')
+        if recordings and proc.returncode == 0:
+            with open(os.path.join(recordings, recording_name(args)), 'w') as rec:
+                rec.write(out)
+        sys.stdout.write(out)
+        sys.stderr.write(err)
+        sys.exit(proc.returncode)
+    if latency > 0:
+        time.sleep(latency)
+    recorded = None
+    if recordings:
+        rec_file = os.path.join(recordings, recording_name(args))
+        if os.path.exists(rec_file):
+            with open(rec_file, 'r') as rec:
+                recorded = rec.read()
+    if recorded is None:
+        recorded = fake_output(args)
+    sys.stdout.write(recorded)
@@ -0,0 +1,120 @@
+"""
+file_dates.py
+Shared parsing of the time range that ends every CMIP file name e.g.
+
+tro3_Amon_MPI-ESM-LR_historical_r1i1p1_195001-195912.nc
+pr_day_MIROC5_historical_r1i1p1_19800101-19891231.nc
+va_6hrPlev_HadGEM2-ES_historical_r1i1p1_198001010600-198101010000.nc
+
+Used by data_finder, drs_index and cmip5datafinder_v2 instead of
+calling datetime.strptime twice per file name. Dates are matched with a
+single precompiled regex (yyyymm, yyyymmdd or yyyymmddHHMM, both dates
+in the same format) and results are kept in a small LRU cache keyed by
+the time range suffix, since the same suffixes come up over and over
+(every variable of a model shares them).
+
+"""
+import re
+import threading
+from collections import OrderedDict
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+# yyyy mm [dd [HHMM]] - yyyy mm [dd [HHMM]]
+_TIME_RANGE = re.compile(r'^(\d{4})(0[1-9]|1[0-2])(\d{2}(?:\d{4})?)?'
+                         r'-(\d{4})(0[1-9]|1[0-2])(\d{2}(?:\d{4})?)?$')
+
+# number of distinct time range suffixes to remember
+CACHE_SIZE = 65536
+
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+# ---- the time range suffix of a file name or path
+def time_range_suffix(filename):
+    """
+    Returns the date1-date2 bit of a file name or full path
+    e.g. 195001-195912 for .../tro3_Amon_MPI-ESM-LR_historical_r1i1p1_195001-195912.nc
+    """
+    suffix = filename.rsplit('/', 1)[-1].rsplit('_', 1)[-1]
+    if suffix.endswith('.nc'):
+        suffix = suffix[:-3]
+    return suffix
+
+# ---- parse a date1-date2 suffix
+def _parse_suffix(suffix):
+    """
+    Returns ((year1, month1), (year2, month2)) or None
+    if the suffix is not a valid time range
+    """
+    m = _TIME_RANGE.match(suffix)
+    if m is None:
+        return None
+    # both dates must have the same format
+    if len(m.group(3) or '') != len(m.group(6) or ''):
+        return None
+    return ((int(m.group(1)), int(m.group(2))),
+            (int(m.group(4)), int(m.group(5))))
+
+def parse_suffix(suffix):
+    """
+    LRU cached version of _parse_suffix; safe to call from threads
+    """
+    with _cache_lock:
+        if suffix in _cache:
+            result = _cache.pop(suffix)
+            _cache[suffix] = result
+            return result
+    result = _parse_suffix(suffix)
+    with _cache_lock:
+        _cache[suffix] = result
+        if len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+    return result
+
+# ---- public API
+def parse_time_range(filename):
+    """
+    Returns ((year1, month1), (year2, month2)) for a CMIP file name
+    or path, or None if it does not end in a valid date1-date2.nc
+    """
+    return parse_suffix(time_range_suffix(filename))
+
+def parse_years(filename):
+    """
+    Returns (year1, year2) for a CMIP file name or path,
+    or None if it does not end in a valid date1-date2.nc
+    """
+    tr = parse_suffix(time_range_suffix(filename))
+    if tr is None:
+        return None
+    return tr[0][0], tr[1][0]
+
+def date_years(time1, time2):
+    """
+    Returns (year1, year2) from the two dates of a time range
+    e.g. time1 = 198204, 19820422 or 198204220511;
+    raises ValueError if they are not valid dates of the same format
+    """
+    tr = parse_suffix(time1 + '-' + time2)
+    if tr is None:
+        raise ValueError('Can not parse time range %s-%s' % (time1, time2))
+    return tr[0][0], tr[1][0]
+
+def parse_years_array(filenames):
+    """
+    Batch version of parse_years for many file names at once;
+    returns two numpy int arrays (year1, year2) with -1 for
+    file names without a valid time range
+    """
+    import numpy as np
+    suffixes = np.array([time_range_suffix(f) for f in filenames], dtype=str)
+    # each distinct suffix is parsed once, then broadcast back
+    uniq, inverse = np.unique(suffixes, return_inverse=True)
+    table = np.full((len(uniq), 2), -1, dtype=int)
+    for i, suffix in enumerate(uniq):
+        tr = parse_suffix(str(suffix))
+        if tr is not None:
+            table[i] = tr[0][0], tr[1][0]
+    years = table[inverse]
+    return years[:, 0], years[:, 1]
@@ -0,0 +1,339 @@
+"""
+manifest.py
+Manifest of exactly which files were cached for which filedescriptor
+(see TODO.txt, --produce-manifest and --use-manifest).
+
+Every line of a manifest is
+
+filedescriptor | path | size | mtime | tracking_id | algorithm:checksum
+
+e.g.
+CMIP5_MPI-ESM-LR_Amon_historical_r1i1p1_1990_1999_tas | /badc/cmip5/data/.../tas_Amon_MPI-ESM-LR_historical_r1i1p1_185001-200512.nc | 1137502868 | 1331813425 | 2cbac9fb-... | md5:d41d8cd98f00b204e9800998ecf8427e
+
+tracking_id is the netCDF global attribute of the same name (read with
+netCDF4 if available, else UNKNOWN). Checksums are computed in a pool of
+processes, each file read in mmap-ed chunks; every finished file is
+appended to the manifest right away, so a killed run is resumed from
+where it stopped: files already in the manifest with the same size and
+mtime are not read again.
+
+Checksums can also be kept across manifests in a ChecksumCache (SQLite,
+keyed by device/inode, size and mtime), so building manifests for
+overlapping params files only costs a stat per file already seen; the
+/latest/ symlink and the versioned path of a file share one entry.
+
+"""
+import os
+import re
+import sys
+import hashlib
+import mmap
+import sqlite3
+from multiprocessing import Pool
+import cache_io
+
+try:
+    import netCDF4
+except ImportError:
+    netCDF4 = None
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+HEADER = '#%cmip5datafinder-manifest 1\n'
+COLUMNS = '# filedescriptor | path | size | mtime | tracking_id | algorithm:checksum\n'
+
+# bytes hashed at a time
+CHUNK_SIZE = 1 << 24
+
+# ---- netCDF tracking_id
+def read_tracking_id(path):
+    """
+    Returns the tracking_id global attribute of a netCDF file,
+    or UNKNOWN if it has none or netCDF4 is not installed
+    """
+    if netCDF4 is None:
+        return 'UNKNOWN'
+    try:
+        dataset = netCDF4.Dataset(path, 'r')
+    except (IOError, OSError, RuntimeError):
+        return 'UNKNOWN'
+    try:
+        return str(getattr(dataset, 'tracking_id', 'UNKNOWN')).replace('|', '_').strip() or 'UNKNOWN'
+    finally:
+        dataset.close()
+
+# ---- checksum of a single file
+def file_checksum(path, algorithm='md5', chunk_size=CHUNK_SIZE):
+    """
+    Returns the hex digest of a file, reading it through mmap
+    one chunk at a time (no full copy of the file in memory)
+    """
+    digest = hashlib.new(algorithm)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            # empty files can not be mmap-ed
+            return digest.hexdigest()
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            for offset in range(0, size, chunk_size):
+                digest.update(mm[offset:offset + chunk_size])
+        finally:
+            mm.close()
+    return digest.hexdigest()
+
+def _manifest_entry(args):
+    """
+    Pool worker: (filedescriptor, path, algorithm) -> (manifest entry
+    tuple, os.stat result), or ((filedescriptor, path, None, error
+    message), None) if the file could not be read
+    """
+    header, path, algorithm = args
+    try:
+        st = os.stat(path)
+        checksum = file_checksum(path, algorithm)
+    except (IOError, OSError) as exc:
+        return (header, path, None, str(exc)), None
+    return (header, path, st.st_size, int(st.st_mtime),
+            read_tracking_id(path), algorithm + ':' + checksum), st
+
+
+class ChecksumCache:
+    """
+    Persistent cache of file checksums (and tracking_ids) in SQLite.
+    An entry is used only if the file still has the same device, inode,
+    size and mtime; it is only read and written by the main process.
+    db_file: path to the SQLite database (created if needed)
+    """
+
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.conn = sqlite3.connect(db_file)
+        self.conn.text_factory = str
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS checksums (
+                                 dev INTEGER,
+                                 ino INTEGER,
+                                 algorithm TEXT,
+                                 size INTEGER,
+                                 mtime REAL,
+                                 checksum TEXT,
+                                 tracking_id TEXT,
+                                 path TEXT,
+                                 PRIMARY KEY (dev, ino, algorithm))""")
+        self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+    def lookup(self, st, algorithm):
+        """
+        Returns (checksum, tracking_id) for a file given its os.stat
+        result, or None if it is not cached or has changed since
+        """
+        row = self.conn.execute('SELECT size, mtime, checksum, tracking_id FROM checksums '
+                                'WHERE dev = ? AND ino = ? AND algorithm = ?',
+                                (st.st_dev, st.st_ino, algorithm)).fetchone()
+        if row is None or row[0] != st.st_size or row[1] != st.st_mtime:
+            return None
+        return row[2], row[3]
+
+    def store(self, path, st, algorithm, checksum, tracking_id):
+        self.conn.execute('INSERT OR REPLACE INTO checksums VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                          (st.st_dev, st.st_ino, algorithm, st.st_size, st.st_mtime,
+                           checksum, tracking_id, path))
+
+    def evict(self):
+        """
+        Drops the entries of files that vanished (or were replaced by
+        another file) since they were cached; returns how many
+        """
+        gone = []
+        for dev, ino, algorithm, path in self.conn.execute(
+                'SELECT dev, ino, algorithm, path FROM checksums').fetchall():
+            try:
+                st = os.stat(path)
+            except OSError:
+                st = None
+            if st is None or st.st_dev != dev or st.st_ino != ino:
+                gone.append((dev, ino, algorithm))
+        self.conn.executemany('DELETE FROM checksums WHERE dev = ? AND ino = ? AND algorithm = ?', gone)
+        self.conn.commit()
+        return len(gone)
+
+# ---- manifest lines
+HEX_DIGEST = re.compile(r'^[0-9a-f]+$')
+
+def _full_checksum(field):
+    """
+    True if field is algorithm:checksum with a hex digest of the full
+    length of algorithm (not cut short by a killed run)
+    """
+    algorithm, _, checksum = field.partition(':')
+    try:
+        size = hashlib.new(algorithm).digest_size
+    except ValueError:
+        return False
+    return len(checksum) == 2 * size and HEX_DIGEST.match(checksum) is not None
+
+def format_entry(entry):
+    return ' | '.join(str(field) for field in entry) + '\n'
+
+def parse_entry(line):
+    """
+    Manifest line -> (filedescriptor, path, size, mtime, tracking_id,
+    algorithm:checksum), or None for comments, blank lines and lines
+    that were not written out completely (no newline at the end or
+    a truncated checksum)
+    """
+    if line.startswith('#') or not line.strip() or not line.endswith('\n'):
+        return None
+    fields = [field.strip() for field in line.split('|')]
+    if len(fields) != 6 or not _full_checksum(fields[5]):
+        return None
+    try:
+        return (fields[0], fields[1], int(fields[2]), int(fields[3]),
+                fields[4], fields[5])
+    except ValueError:
+        return None
+
+def read_manifest(manifest_file):
+    """
+    Returns the list of entries of a (possibly partial) manifest
+    """
+    entries = []
+    if not os.path.exists(manifest_file):
+        return entries
+    with open(manifest_file, 'r') as mf:
+        for line in mf:
+            entry = parse_entry(line)
+            if entry is not None:
+                entries.append(entry)
+    return entries
+
+# ---- --produce-manifest
+def cached_files(cache_file):
+    """
+    (filedescriptor, path) of every file on disk in a combined cache
+    file (lines: filedescriptor path [INSTALLED|NOT-YET-INSTALLED])
+    """
+    files = []
+    with open(cache_file, 'r') as cf:
+        for line in cf:
+            fields = line.split()
+            if len(fields) < 2 or 'NOT-YET-INSTALLED' in fields[2:]:
+                continue
+            files.append((fields[0], fields[1]))
+    return sorted(set(files))
+
+def produce_manifest(cache_file, manifest_file, jobs=1, algorithm='md5', verbose=False,
+                     checksum_cache=None):
+    """
+    Writes the manifest of all the files in cache_file; the checksums are
+    computed by jobs processes. Entries of an existing (partial) manifest
+    are kept for files with the same size and mtime. checksum_cache: a
+    ChecksumCache consulted before, and updated after, hashing a file.
+    Returns the number of files that were checksummed in this run.
+    """
+    done = {}
+    for entry in read_manifest(manifest_file):
+        done[(entry[0], entry[1])] = entry
+    entries = []
+    todo = []
+    for header, path in cached_files(cache_file):
+        old = done.get((header, path))
+        try:
+            st = os.stat(path)
+        except OSError:
+            st = None
+        if st is not None and old is not None and old[5].startswith(algorithm + ':'):
+            if old[2] == st.st_size and old[3] == int(st.st_mtime):
+                entries.append(old)
+                continue
+        if st is not None and checksum_cache is not None:
+            hit = checksum_cache.lookup(st, algorithm)
+            if hit is not None:
+                entries.append((header, path, st.st_size, int(st.st_mtime),
+                                hit[1], algorithm + ':' + hit[0]))
+                continue
+        todo.append((header, path, algorithm))
+    if verbose is True:
+        print('Manifest %s: %i files already done, %i to checksum'
+              % (manifest_file, len(entries), len(todo)))
+    if jobs > 1:
+        pool = Pool(jobs)
+        # one file per task: files are big and of very different sizes
+        results = pool.imap_unordered(_manifest_entry, todo, 1)
+    else:
+        pool = None
+        results = (_manifest_entry(args) for args in todo)
+    # append as we go so a killed run can be resumed
+    if not os.path.exists(manifest_file):
+        with open(manifest_file, 'w') as mf:
+            mf.write(HEADER)
+            mf.write(COLUMNS)
+    with open(manifest_file, 'rb') as mf:
+        mf.seek(0, os.SEEK_END)
+        if mf.tell() > 0:
+            mf.seek(-1, os.SEEK_END)
+            partial = mf.read(1) != b'\n'
+        else:
+            partial = False
+    with open(manifest_file, 'a') as mf:
+        if partial:
+            # end the line a killed run was writing, do not append onto it
+            mf.write('\n')
+        for entry, st in results:
+            if st is None:
+                print >> sys.stderr, 'WARNING: could not checksum %s: %s' % (entry[1], entry[3])
+                continue
+            mf.write(format_entry(entry))
+            mf.flush()
+            entries.append(entry)
+            if checksum_cache is not None:
+                checksum_cache.store(entry[1], st, algorithm, entry[5].split(':', 1)[1], entry[4])
+            if verbose is True:
+                print('Checksummed %s' % entry[1])
+    if pool is not None:
+        pool.close()
+        pool.join()
+    if checksum_cache is not None:
+        checksum_cache.conn.commit()
+    # final manifest: sorted, only the files of this cache
+    cache_io.write_lines(manifest_file, [HEADER, COLUMNS]
+                         + [format_entry(entry) for entry in sorted(entries)])
+    return len(todo)
+
+# ---- --use-manifest
+def resolve_manifest_item(item, entries_by_header, verify=False):
+    """
+    Drop-in for resolve_local_item: the files of a params file row are
+    exactly the ones in the manifest (whatever their version), found
+    at their recorded path with their recorded size (and checksum, if
+    verify); returns cache lines, missing cache lines and messages.
+    """
+    header = "_".join(item)
+    cached = []
+    missing = []
+    messages = []
+    found = []
+    lost = []
+    for entry in entries_by_header.get(header, []):
+        path = entry[1]
+        ok = os.path.isfile(path) and os.path.getsize(path) == entry[2]
+        if ok and verify is True:
+            algorithm, checksum = entry[5].split(':', 1)
+            ok = file_checksum(path, algorithm) == checksum
+        if ok:
+            found.append(path)
+            cached.append(header + ' ' + path + '\n')
+            messages.append('Cached file from manifest: ' + path)
+        else:
+            lost.append(path)
+            messages.append('WARNING: manifest file missing or changed: ' + path)
+    if len(found) == 0:
+        missing.append(header + ' ERROR-MISSING' + '\n')
+    elif len(lost) > 0:
+        for path in found:
+            missing.append(header + ' INCOMPLETE ' + os.path.basename(path) + '\n')
+    return cached, missing, messages
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+"""
+test_cache_io.py
+Tests of cache_io; run with
+python -m unittest test_cache_io
+
+The .npz final cache written under Python 2 holds byte strings and
+the one written under Python 3 unicode strings: both must load the
+same under either version.
+
+"""
+
+# ---- Import standard modules to the python path.
+import os, shutil, tempfile, unittest
+import cache_io
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+HEADER = 'CMIP5_MIROC5_Amon_historical_r1i1p1_2003_2010_hus'
+FILES = ['/badc/cmip5/data/hus_Amon_MIROC5_historical_r1i1p1_200001-200512.nc',
+         '/badc/cmip5/data/hus_Amon_MIROC5_historical_r1i1p1_200601-201012.nc']
+RECORDS = [(HEADER, 'complete', 1.0, FILES),
+           ('CMIP5_MIROC5_Amon_historical_r1i1p1_2003_2010_tas', 'missing', 0.0, [])]
+
+@unittest.skipIf(np is None, 'numpy is not installed')
+class TestFinalCache(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'cache_final.npz')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def _save(self, kind):
+        """
+        Writes RECORDS as save_final_cache does, with kind ('S' or 'U')
+        strings whatever the Python version, i.e. as Python 2 ('S')
+        or Python 3 ('U') would
+        """
+        def encoded(text):
+            return text.encode('utf-8') if kind == 'S' else u'%s' % text
+        rows = [(encoded(RECORDS[0][0]), encoded('complete'), 1.0, 0, 2),
+                (encoded(RECORDS[1][0]), encoded('missing'), 0.0, 2, 0)]
+        rec = np.array(rows, dtype=[('header', '%s64' % kind), ('status', '%s16' % kind),
+                                    ('coverage', 'f8'), ('first', 'i8'), ('nfiles', 'i8')])
+        fil = np.array([encoded(f) for f in FILES], dtype='%s128' % kind)
+        with open(self.path, 'wb') as f:
+            np.savez(f, records=rec, files=fil)
+
+    def _check(self, cache):
+        self.assertEqual(len(cache), 2)
+        status, coverage, files = cache.lookup(HEADER)
+        self.assertEqual((status, coverage, files), ('complete', 1.0, FILES))
+        self.assertTrue(all(isinstance(f, str) for f in [status] + files))
+        self.assertEqual(cache.lookup(RECORDS[1][0]), ('missing', 0.0, []))
+        self.assertEqual(cache.lookup('CMIP5_no_such_filedescriptor'), None)
+
+    def test_round_trip(self):
+        cache_io.save_final_cache(self.path, RECORDS)
+        self._check(cache_io.load_final_cache(self.path))
+
+    def test_load_python2_cache(self):
+        self._save('S')
+        self._check(cache_io.load_final_cache(self.path))
+
+    def test_load_python3_cache(self):
+        self._save('U')
+        self._check(cache_io.load_final_cache(self.path))
+
+if __name__ == '__main__':
+    unittest.main()
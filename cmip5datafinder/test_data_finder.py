@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+
+"""
+test_data_finder.py
+Tests of the DRS directory resolution of data_finder; run with
+python -m unittest test_data_finder
+
+"""
+
+# ---- Import standard modules to the python path.
+import os, shutil, tempfile, unittest
+import data_finder as df
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+MODEL = {'project': 'CMIP5',
+         'name': 'MPI-ESM-LR',
+         'mip': 'Amon',
+         'exp': 'historical',
+         'ensemble': 'r1i1p1',
+         'start_year': '1980',
+         'end_year': '2005'}
+VAR = {'name': 'tas'}
+
+class TestDRSResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.rootpath = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.rootpath)
+
+    def _versions(self, ensemble_dir):
+        for version in ('v20110101', 'v20120101'):
+            os.makedirs(os.path.join(self.rootpath, ensemble_dir, version, 'tas'))
+
+    def test_badc(self):
+        resolver = df.get_drs_resolver('/badc/cmip5/data/cmip5/output1/', 'BADC')
+        self.assertEqual(resolver.directory(MODEL, VAR),
+                         '/badc/cmip5/data/cmip5/output1/MPI-M/MPI-ESM-LR/'
+                         'historical/mon/atmos/Amon/r1i1p1/latest/tas')
+
+    def test_dkrz(self):
+        # the latest version directory is part of the path
+        self._versions('MPI-M/MPI-ESM-LR/historical/atmos/mon/Amon/r1i1p1')
+        resolver = df.DRSResolver(self.rootpath, 'DKRZ')
+        self.assertEqual(resolver.directory(MODEL, VAR),
+                         self.rootpath + '/MPI-M/MPI-ESM-LR/historical/'
+                         'atmos/mon/Amon/r1i1p1/v20120101/tas')
+
+    def test_sdt(self):
+        self._versions('MPI-M/MPI-ESM-LR/historical/mon/atmos/Amon/r1i1p1')
+        resolver = df.DRSResolver(self.rootpath, 'SDT')
+        self.assertEqual(resolver.directory(MODEL, VAR),
+                         self.rootpath + '/MPI-M/MPI-ESM-LR/historical/'
+                         'mon/atmos/Amon/r1i1p1/v20120101/tas')
+
+    def test_unknown_drs(self):
+        self.assertRaises(ValueError, df.DRSResolver, self.rootpath, 'NONE')
+
+if __name__ == '__main__':
+    unittest.main()
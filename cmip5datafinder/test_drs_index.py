@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+
+"""
+test_drs_index.py
+Tests of the file lookups of data_finder through a drs_index.DRSIndex;
+run with
+python -m unittest test_drs_index
+
+"""
+
+# ---- Import standard modules to the python path.
+import os, shutil, tempfile, unittest
+import data_finder as df
+import drs_index
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+FX_FILE = 'sftlf_fx_MPI-ESM-LR_historical_r0i0p0.nc'
+TAS_FILE = 'tas_Amon_MPI-ESM-LR_historical_r1i1p1_198001-200512.nc'
+
+class TestIndexedLookups(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.rootpath = os.path.join(self.tmpdir, 'output1')
+        model_dir = os.path.join(self.rootpath, 'MPI-M', 'MPI-ESM-LR', 'historical')
+        for dirname, fname in [('fx/atmos/fx/r0i0p0/latest/sftlf', FX_FILE),
+                               ('mon/atmos/Amon/r1i1p1/latest/tas', TAS_FILE)]:
+            os.makedirs(os.path.join(model_dir, dirname))
+            open(os.path.join(model_dir, dirname, fname), 'w').close()
+        self.model_dir = model_dir
+        self.index = drs_index.DRSIndex(os.path.join(self.tmpdir, 'index.sqlite'),
+                                        self.rootpath, 'BADC')
+        self.index.refresh()
+        df.use_drs_index(self.index)
+
+    def tearDown(self):
+        df.use_drs_index(None)
+        self.index.close()
+        shutil.rmtree(self.tmpdir)
+
+    def test_exact_directory(self):
+        dirname = self.model_dir + '/mon/atmos/Amon/r1i1p1/latest/tas/'
+        self.assertEqual(df.find_files(dirname, 'tas_Amon_MPI-ESM-LR_historical_r1i1p1*.nc'),
+                         [dirname + TAS_FILE])
+
+    def test_wildcard_directory(self):
+        # the fx realm is not known, same result as find
+        dirname = self.model_dir + '/fx/*/fx/r0i0p0/latest/sftlf/'
+        expected = [self.model_dir + '/fx/atmos/fx/r0i0p0/latest/sftlf/' + FX_FILE]
+        self.assertEqual(df.find_files(dirname, 'sftlf_fx*.nc'), expected)
+        df.use_drs_index(None)
+        self.assertEqual(df.find_files(dirname, 'sftlf_fx*.nc'), expected)
+
+    def test_wildcard_is_one_level(self):
+        dirname = self.model_dir + '/*/fx/r0i0p0/latest/sftlf/'
+        self.assertEqual(df.find_files(dirname, 'sftlf_fx*.nc'), [])
+
+    def test_sibling_of_root(self):
+        # shares the prefix of the root but is not indexed: find is used
+        sibling = self.rootpath + '_extra/tas/'
+        os.makedirs(sibling)
+        open(sibling + TAS_FILE, 'w').close()
+        self.assertFalse(df.indexed(sibling))
+        self.assertTrue(df.indexed(self.rootpath))
+        self.assertEqual(df.find_files(sibling, 'tas_Amon*.nc'), [sibling + TAS_FILE])
+
+if __name__ == '__main__':
+    unittest.main()
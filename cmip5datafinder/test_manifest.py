@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+
+"""
+test_manifest.py
+Tests of resuming manifest.produce_manifest after a killed run; run with
+python -m unittest test_manifest
+
+"""
+
+# ---- Import standard modules to the python path.
+import os, shutil, tempfile, unittest
+import manifest
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+class Killed(Exception):
+    pass
+
+class KillingCache(object):
+    """
+    ChecksumCache that never hits and kills the run once the first
+    entry is appended to the manifest
+    """
+    def lookup(self, st, algorithm):
+        return None
+    def store(self, path, st, algorithm, checksum, tracking_id):
+        raise Killed()
+
+HEADER = 'CMIP5_MPI-ESM-LR_Amon_historical_r1i1p1_1980_2005_tas'
+FILES = ['tas_Amon_MPI-ESM-LR_historical_r1i1p1_198001-199212.nc',
+         'tas_Amon_MPI-ESM-LR_historical_r1i1p1_199301-200512.nc']
+
+class TestResume(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.cache_file = os.path.join(self.tmpdir, 'cache.txt')
+        self.manifest_file = os.path.join(self.tmpdir, 'manifest.txt')
+        with open(self.cache_file, 'w') as cf:
+            for i, fname in enumerate(FILES):
+                path = os.path.join(self.tmpdir, fname)
+                with open(path, 'w') as f:
+                    f.write('data %i\n' % i)
+                cf.write('%s %s INSTALLED\n' % (HEADER, path))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_truncated_last_line(self):
+        self.assertEqual(manifest.produce_manifest(self.cache_file, self.manifest_file), 2)
+        with open(self.manifest_file, 'r') as mf:
+            complete = mf.read()
+        # killed while writing the last entry: checksum cut short, no newline
+        with open(self.manifest_file, 'w') as mf:
+            mf.write(complete[:complete.rindex(':') + 9])
+        self.assertEqual(len(manifest.read_manifest(self.manifest_file)), 1)
+        self.assertEqual(manifest.produce_manifest(self.cache_file, self.manifest_file), 1)
+        with open(self.manifest_file, 'r') as mf:
+            self.assertEqual(mf.read(), complete)
+
+    def test_unterminated_line_is_not_appended_to(self):
+        manifest.produce_manifest(self.cache_file, self.manifest_file)
+        entries = manifest.read_manifest(self.manifest_file)
+        # complete checksum but the newline was never written
+        with open(self.manifest_file, 'w') as mf:
+            mf.write(manifest.HEADER + manifest.COLUMNS
+                     + manifest.format_entry(entries[0]).rstrip('\n'))
+        self.assertEqual(manifest.read_manifest(self.manifest_file), [])
+        self.assertRaises(Killed, manifest.produce_manifest, self.cache_file,
+                          self.manifest_file, checksum_cache=KillingCache())
+        # the unterminated line was ended before appending: two whole lines
+        self.assertEqual(manifest.read_manifest(self.manifest_file), [entries[0]] * 2)
+        self.assertEqual(manifest.produce_manifest(self.cache_file, self.manifest_file), 1)
+        self.assertEqual(manifest.read_manifest(self.manifest_file), entries)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,84 @@
+"""
+time_coverage.py
+Coverage and gap analysis of the files found for a filedescriptor.
+
+Every file covers a closed interval of months (from the time range in its
+name, see file_dates.py); the intervals are sorted once and merged in a
+single sweep, so this is O(n log n) in the number of files and copes
+with the hundreds of files of daily or 6-hourly data. Returns the exact
+fraction of the needed years that is covered plus the gaps and
+overlaps, all at month resolution.
+
+"""
+
+__author__ = "Valeriu Predoi <valeriu.predoi@ncas.ac.uk>"
+
+def _month(ym):
+    """
+    (year, month) -> months since year 0
+    """
+    return ym[0] * 12 + ym[1] - 1
+
+def _ym(month):
+    """
+    months since year 0 -> (year, month)
+    """
+    return month // 12, month % 12 + 1
+
+
+class Coverage:
+    """
+    Result of get_coverage:
+    fraction: fraction (0 to 1) of the needed months covered by data
+    gaps: list of ((year, month), (year, month)) month ranges (inclusive)
+          inside the needed period not covered by any file
+    data_gaps: the gaps that sit between two files, i.e. gaps minus the
+          missing data at the start or end of the needed period
+    overlaps: list of ((year, month), (year, month)) month ranges (inclusive)
+          inside the needed period covered by more than one file
+    """
+
+    def __init__(self, fraction, gaps, data_gaps, overlaps):
+        self.fraction = fraction
+        self.gaps = gaps
+        self.data_gaps = data_gaps
+        self.overlaps = overlaps
+
+    def is_complete(self):
+        return len(self.gaps) == 0
+
+
+def get_coverage(ranges, year1, year2):
+    """
+    ranges: list of ((year1, month1), (year2, month2)) time ranges of
+    the files (e.g. from file_dates.parse_time_range), in any order
+    year1, year2: needed years (inclusive, January of year1
+    to December of year2)
+    Returns a Coverage
+    """
+    start = year1 * 12
+    end = year2 * 12 + 11
+    needed = end - start + 1
+    # clip to the needed period and sort once
+    intervals = sorted((max(_month(r[0]), start), min(_month(r[1]), end))
+                       for r in ranges)
+    intervals = [i for i in intervals if i[0] <= i[1]]
+    covered = 0
+    gaps = []
+    data_gaps = []
+    overlaps = []
+    last = start - 1
+    for lo, hi in intervals:
+        if lo > last + 1:
+            gaps.append((_ym(last + 1), _ym(lo - 1)))
+            # between two files, not before the first one
+            if last >= start:
+                data_gaps.append(gaps[-1])
+        elif lo <= last:
+            overlaps.append((_ym(lo), _ym(min(hi, last))))
+        if hi > last:
+            covered += hi - max(lo, last + 1) + 1
+            last = hi
+    if last < end:
+        gaps.append((_ym(last + 1), _ym(end)))
+    return Coverage(float(covered) / needed, gaps, data_gaps, overlaps)